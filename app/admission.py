@@ -0,0 +1,236 @@
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Dict, Iterable
+from fastapi import HTTPException, status
+from app import metrics
+from .database import DATABASE_POOL_SIZE
+
+# Gravações de ingestão simultâneas (0 desliga o limite). O padrão deixa o overflow do pool para consultas e health.
+INGEST_MAX_CONCURRENCY = int(os.getenv("INGEST_MAX_CONCURRENCY", str(DATABASE_POOL_SIZE)))
+# Requisições esperando uma vaga; acima disso, ou depois de esperar INGEST_QUEUE_TIMEOUT_SECONDS, a resposta é 429.
+INGEST_MAX_QUEUE = int(os.getenv("INGEST_MAX_QUEUE", "100"))
+INGEST_QUEUE_TIMEOUT_SECONDS = float(os.getenv("INGEST_QUEUE_TIMEOUT_SECONDS", "1"))
+# Leituras por segundo por usuário do token e por server_ulid (0 desliga); o burst é em segundos de taxa.
+INGEST_RATE_LIMIT_PER_USER = float(os.getenv("INGEST_RATE_LIMIT_PER_USER", "0"))
+INGEST_RATE_LIMIT_PER_SERVER = float(os.getenv("INGEST_RATE_LIMIT_PER_SERVER", "0"))
+INGEST_RATE_LIMIT_BURST_SECONDS = float(os.getenv("INGEST_RATE_LIMIT_BURST_SECONDS", "2"))
+INGEST_RATE_LIMIT_MAX_KEYS = int(os.getenv("INGEST_RATE_LIMIT_MAX_KEYS", "100000"))
+
+def too_many_requests(reason: str, retry_after: float, detail: str):
+    metrics.INGEST_ADMISSION_REJECTED.labels(reason).inc()
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail=detail,
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+    )
+
+class RateLimiter:
+    """Token bucket por chave, medido em leituras por segundo.
+
+    Um pedido maior que a capacidade do bucket passa quando o bucket está
+    cheio e deixa o saldo negativo, então lotes grandes não ficam bloqueados
+    para sempre e a taxa média continua valendo.
+    """
+
+    def __init__(self, rate: float, burst_seconds: float, max_keys: int):
+        self.enabled = rate > 0
+        self.rate = rate
+        self.capacity = max(rate * burst_seconds, 1.0)
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets: Dict[str, list] = {}
+
+    def take(self, counts: Dict[str, int]) -> float:
+        """Consome `counts` leituras de cada chave, tudo ou nada.
+
+        Retorna 0 se coube ou, caso contrário, quantos segundos faltam para caber.
+        """
+        if not self.enabled:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            wait = 0.0
+            for key, count in counts.items():
+                bucket = self._buckets.get(key)
+                tokens = self.capacity if bucket is None else min(self.capacity, bucket[0] + (now - bucket[1]) * self.rate)
+                needed = min(count, self.capacity)
+                if tokens < needed:
+                    wait = max(wait, (needed - tokens) / self.rate)
+            if wait:
+                return wait
+            for key, count in counts.items():
+                bucket = self._buckets.get(key)
+                tokens = self.capacity if bucket is None else min(self.capacity, bucket[0] + (now - bucket[1]) * self.rate)
+                self._buckets[key] = [tokens - count, now]
+            if len(self._buckets) > self.max_keys:
+                self._prune(now)
+            return 0.0
+
+    def _prune(self, now: float):
+        # Buckets já cheios de novo equivalem a não ter bucket; se não bastar, saem os mais antigos.
+        full_after = self.capacity / self.rate
+        self._buckets = {key: bucket for key, bucket in self._buckets.items() if now - bucket[1] < full_after}
+        if len(self._buckets) > self.max_keys:
+            newest = sorted(self._buckets.items(), key=lambda item: item[1][1])[-(self.max_keys // 2):]
+            self._buckets = dict(newest)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._buckets)
+
+class IngestAdmission:
+    """Controle de admissão das rotas de ingestão.
+
+    Limita quantas requisições de ingestão estão em andamento ao mesmo tempo
+    e quantas esperam por uma vaga; quem não cabe na fila ou espera demais
+    recebe 429 com Retry-After antes de ocupar uma sessão ou uma thread do
+    threadpool (ver ingest_slot). Os limites de taxa por usuário e por
+    server_ulid dependem das leituras e são verificados depois de ler o corpo,
+    já com a vaga. Como os demais estados em memória, vale por processo.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        max_queue: int,
+        queue_timeout: float,
+        user_rate: float,
+        server_rate: float,
+        burst_seconds: float,
+        max_keys: int
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.users = RateLimiter(user_rate, burst_seconds, max_keys)
+        self.servers = RateLimiter(server_rate, burst_seconds, max_keys)
+        self._lock = threading.Lock()
+        self._waiters = deque()
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = {"queue_full": 0, "queue_timeout": 0, "user_rate": 0, "server_rate": 0}
+
+    def _reject(self, reason: str, retry_after: float, detail: str):
+        with self._lock:
+            self.rejected[reason] += 1
+        return too_many_requests(reason, retry_after, detail)
+
+    def check_rate(self, username: str, server_ulids: Iterable[str]):
+        """Aplica os limites de taxa a uma requisição com estas leituras; 429 se algum estourar."""
+        server_counts = {}
+        for server_ulid in server_ulids:
+            server_counts[server_ulid] = server_counts.get(server_ulid, 0) + 1
+        if not server_counts:
+            return
+        wait = self.users.take({username: sum(server_counts.values())})
+        if wait:
+            raise self._reject("user_rate", wait, "Limite de leituras por segundo do usuário excedido.")
+        wait = self.servers.take(server_counts)
+        if wait:
+            raise self._reject("server_rate", wait, "Limite de leituras por segundo do servidor excedido.")
+
+    async def acquire(self):
+        if self.max_concurrency <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self.in_flight < self.max_concurrency and not self._waiters:
+                self.in_flight += 1
+                self.admitted += 1
+                metrics.INGEST_IN_FLIGHT.set(self.in_flight)
+                return
+            queue_full = len(self._waiters) >= self.max_queue
+            if not queue_full:
+                future = loop.create_future()
+                self._waiters.append((loop, future))
+        if queue_full:
+            raise self._reject("queue_full", self.queue_timeout, "Ingestão sobrecarregada, tente novamente.")
+        try:
+            await asyncio.wait_for(future, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._abandon(loop, future)
+            raise self._reject("queue_timeout", self.queue_timeout, "Ingestão sobrecarregada, tente novamente.")
+        except asyncio.CancelledError:
+            self._abandon(loop, future)
+            raise
+
+    def _abandon(self, loop, future):
+        with self._lock:
+            try:
+                self._waiters.remove((loop, future))
+            except ValueError:
+                # A vaga já foi passada para esta requisição; _grant devolve se o future foi cancelado.
+                if future.done() and not future.cancelled():
+                    self._release_locked()
+
+    def _grant(self, future):
+        if future.cancelled():
+            self.release()
+        else:
+            future.set_result(None)
+
+    def _release_locked(self):
+        while self._waiters:
+            loop, future = self._waiters.popleft()
+            try:
+                # A vaga passa direto para o próximo da fila, sem voltar ao contador.
+                loop.call_soon_threadsafe(self._grant, future)
+            except RuntimeError:
+                continue
+            self.admitted += 1
+            return
+        self.in_flight -= 1
+        metrics.INGEST_IN_FLIGHT.set(self.in_flight)
+
+    def release(self):
+        if self.max_concurrency <= 0:
+            return
+        with self._lock:
+            self._release_locked()
+
+    @asynccontextmanager
+    async def slot(self):
+        """Uma vaga de gravação durante o bloco."""
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": self.in_flight,
+                "queued": len(self._waiters),
+                "max_concurrency": self.max_concurrency,
+                "max_queue": self.max_queue,
+                "admitted": self.admitted,
+                "rejected": dict(self.rejected),
+                "user_rate_limit": self.users.rate,
+                "server_rate_limit": self.servers.rate,
+                "rate_limited_keys": len(self.users) + len(self.servers),
+            }
+
+async def ingest_slot():
+    """Dependência das rotas de ingestão: ocupa uma vaga antes de ler o corpo e a devolve no fim da requisição.
+
+    Declarada antes das demais dependências, recusa com 429 sem ler o corpo,
+    sem ocupar o threadpool com a decodificação e sem abrir sessão.
+    """
+    async with controller.slot():
+        yield
+
+controller = IngestAdmission(
+    max_concurrency=INGEST_MAX_CONCURRENCY,
+    max_queue=INGEST_MAX_QUEUE,
+    queue_timeout=INGEST_QUEUE_TIMEOUT_SECONDS,
+    user_rate=INGEST_RATE_LIMIT_PER_USER,
+    server_rate=INGEST_RATE_LIMIT_PER_SERVER,
+    burst_seconds=INGEST_RATE_LIMIT_BURST_SECONDS,
+    max_keys=INGEST_RATE_LIMIT_MAX_KEYS,
+)
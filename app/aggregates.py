@@ -0,0 +1,230 @@
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set
+from sqlalchemy.orm import Session
+from app import crud, database
+from .cache import TTLCache
+
+# Quantidade máxima de intervalos guardados (0 desliga o cache) e por quanto tempo cada um vale.
+AGGREGATE_CACHE_MAX_BUCKETS = int(os.getenv("AGGREGATE_CACHE_MAX_BUCKETS", "100000"))
+AGGREGATE_CACHE_TTL_SECONDS = float(os.getenv("AGGREGATE_CACHE_TTL_SECONDS", "3600"))
+# Consultas que cobririam mais intervalos fechados do que isto vão direto ao banco.
+AGGREGATE_CACHE_MAX_QUERY_BUCKETS = int(os.getenv("AGGREGATE_CACHE_MAX_QUERY_BUCKETS", "10000"))
+
+class AggregateCache:
+    """Linhas de get_aggregated_sensor_data guardadas por intervalo de tempo fechado.
+
+    A chave de cada entrada é o escopo normalizado da consulta (servidor,
+    sensor_type, largura do intervalo, estatísticas e agrupamento) mais o
+    início do intervalo, então consultas com janelas diferentes reaproveitam
+    os intervalos em comum. Só intervalos que já terminaram e estão inteiros
+    dentro de [start_time, end_time] são guardados; a ponta inicial parcial e
+    tudo a partir do intervalo atual são sempre consultados no banco.
+
+    Leituras gravadas invalidam apenas os intervalos que elas tocam nos
+    escopos daquele servidor e nos escopos de todos os servidores; os escopos
+    ficam indexados por servidor e um escopo sai do índice quando o último
+    intervalo dele sai do cache, então a memória acompanha
+    AGGREGATE_CACHE_MAX_BUCKETS por mais variados que sejam os server_ulid
+    consultados. Intervalos com leituras reescritas que o refresher ainda não
+    recalculou não são guardados, já que os rollups deles ainda têm os valores
+    antigos. Só consultas feitas no primário guardam intervalos: uma
+    sessão roteada a uma réplica aproveita o que já está no cache, mas o que
+    falta vai ao banco sem ser guardado. Cada processo tem o seu cache e só
+    enxerga as leituras que ele mesmo gravou; o TTL limita quanto tempo um
+    intervalo alterado por outro worker pode ficar desatualizado.
+    """
+
+    def __init__(self, max_buckets: int, ttl: float, max_query_buckets: int):
+        self.enabled = max_buckets > 0
+        self.max_query_buckets = max_query_buckets
+        self.buckets = TTLCache(max_size=max(max_buckets, 1), ttl=ttl, on_evict=self._evicted)
+        # Reentrante: uma entrada que sai por LRU dentro de buckets.set chama _evicted na mesma thread.
+        self._lock = threading.RLock()
+        self._scopes: Dict[tuple, timedelta] = {}
+        self._versions: Dict[tuple, int] = {}
+        self._by_server: Dict[Optional[str], Set[tuple]] = {}
+        # Intervalos guardados e consultas em andamento de cada escopo; sem nenhum dos dois o escopo é descartado.
+        self._sizes: Dict[tuple, int] = {}
+        self._readers: Dict[tuple, int] = {}
+        self.bypassed = 0
+        self.replica_reads = 0
+        self.invalidated = 0
+
+    def get_aggregated_sensor_data(
+        self,
+        db: Session,
+        server_ulid: Optional[str] = None,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+        sensor_type: Optional[str] = None,
+        aggregation: Optional[str] = None,
+        stats: Optional[List[str]] = None,
+        group_by_server: bool = False
+    ):
+        width = crud.parse_interval(aggregation)
+        start_time = crud.naive_utc(start_time)
+        end_time = crud.naive_utc(end_time)
+        params = dict(
+            server_ulid=server_ulid,
+            sensor_type=sensor_type,
+            aggregation=aggregation,
+            stats=stats,
+            group_by_server=group_by_server
+        )
+
+        body_start = body_end = None
+        if self.enabled and start_time is not None:
+            body_start = crud.bin_timestamp(start_time, width)
+            if body_start < start_time:
+                body_start += width
+            body_end = crud.bin_timestamp(datetime.utcnow(), width)
+            if end_time is not None:
+                body_end = min(body_end, crud.bin_timestamp(end_time, width))
+        if body_start is None or body_start >= body_end or (body_end - body_start) / width > self.max_query_buckets:
+            with self._lock:
+                self.bypassed += 1
+            return crud.get_aggregated_sensor_data(db, start_time=start_time, end_time=end_time, **params)
+
+        scope = (
+            server_ulid or None,
+            sensor_type if sensor_type in crud.SENSOR_FIELDS else None,
+            width,
+            tuple(stats) if stats else None,
+            group_by_server
+        )
+        buckets = [body_start + index * width for index in range((body_end - body_start) // width)]
+        cached = [self.buckets.get((scope, bucket)) for bucket in buckets]
+
+        if any(bucket_rows is None for bucket_rows in cached) and not database.reads_primary(db):
+            # Uma réplica atrasada guardaria intervalos anteriores a escritas já invalidadas, servidos a todos até o TTL.
+            with self._lock:
+                self.replica_reads += 1
+            return crud.get_aggregated_sensor_data(db, start_time=start_time, end_time=end_time, **params)
+
+        if any(bucket_rows is None for bucket_rows in cached):
+            version = self._register(scope, width)
+            try:
+                # Intervalos com leituras reescritas ainda não recalculadas vêm dos rollups antigos; não são guardados.
+                # A verificação vem antes da consulta para que um recálculo no meio dela não esconda o intervalo.
+                stale = set()
+                if crud.SENSOR_DATA_CONFLICT_POLICY == "update":
+                    stale = {
+                        crud.bin_timestamp(timestamp, width)
+                        for timestamp in crud.get_rewritten_timestamps(db, server_ulid, body_start, body_end)
+                    }
+                rows = [tuple(row) for row in crud.get_aggregated_sensor_data(db, start_time=start_time, end_time=end_time, **params)]
+                by_bucket = {bucket: [] for bucket in buckets if bucket not in stale}
+                for row in rows:
+                    if row[0] in by_bucket:
+                        by_bucket[row[0]].append(row)
+                with self._lock:
+                    # Se uma leitura alterou um intervalo fechado deste escopo durante a consulta, nada é guardado.
+                    if self._versions[scope] == version:
+                        for bucket, bucket_rows in by_bucket.items():
+                            if self.buckets.set((scope, bucket), tuple(bucket_rows)):
+                                self._sizes[scope] += 1
+            finally:
+                self._unregister(scope)
+            return rows
+
+        rows = []
+        if start_time < body_start:
+            head = crud.get_aggregated_sensor_data(db, start_time=start_time, end_time=body_start, **params)
+            rows.extend(tuple(row) for row in head if row[0] < body_start)
+        for bucket_rows in cached:
+            rows.extend(bucket_rows)
+        tail = crud.get_aggregated_sensor_data(db, start_time=body_end, end_time=end_time, **params)
+        rows.extend(tuple(row) for row in tail)
+        return rows
+
+    def _register(self, scope: tuple, width: timedelta) -> int:
+        with self._lock:
+            if scope not in self._scopes:
+                self._scopes[scope] = width
+                self._versions[scope] = 0
+                self._sizes[scope] = 0
+                self._readers[scope] = 0
+                self._by_server.setdefault(scope[0], set()).add(scope)
+            self._readers[scope] += 1
+            return self._versions[scope]
+
+    def _unregister(self, scope: tuple):
+        with self._lock:
+            self._readers[scope] -= 1
+            self._discard_if_empty(scope)
+
+    def _discard_if_empty(self, scope: tuple):
+        if self._sizes.get(scope, 0) > 0 or self._readers.get(scope, 0) > 0 or scope not in self._scopes:
+            return
+        del self._scopes[scope], self._versions[scope], self._sizes[scope], self._readers[scope]
+        server_scopes = self._by_server[scope[0]]
+        server_scopes.discard(scope)
+        if not server_scopes:
+            del self._by_server[scope[0]]
+
+    def _evicted(self, key):
+        scope = key[0]
+        with self._lock:
+            if scope in self._sizes:
+                self._sizes[scope] -= 1
+                self._discard_if_empty(scope)
+
+    def invalidate(self, readings):
+        """Descarta os intervalos fechados tocados pelas leituras, nos escopos de cada servidor."""
+        if not self.enabled:
+            return
+        touched: Dict[str, set] = {}
+        for reading in readings:
+            touched.setdefault(reading.server_ulid, set()).add(crud.naive_utc(reading.timestamp))
+        if not touched:
+            return
+
+        now = datetime.utcnow()
+        with self._lock:
+            visits = [(scope, touched[server]) for server in touched for scope in self._by_server.get(server, ())]
+            if None in self._by_server:
+                every_timestamp = set().union(*touched.values())
+                visits.extend((scope, every_timestamp) for scope in self._by_server[None])
+            emptied = []
+            for scope, timestamps in visits:
+                width = self._scopes[scope]
+                closed = {crud.bin_timestamp(timestamp, width) for timestamp in timestamps}
+                closed = [bucket for bucket in closed if bucket + width <= now]
+                if not closed:
+                    continue
+                self._versions[scope] += 1
+                for bucket in closed:
+                    if self.buckets.invalidate((scope, bucket)):
+                        self.invalidated += 1
+                        self._sizes[scope] -= 1
+                        emptied.append(scope)
+            for scope in emptied:
+                self._discard_if_empty(scope)
+
+    def clear(self):
+        with self._lock:
+            self.buckets.clear()
+            self._scopes.clear()
+            self._versions.clear()
+            self._by_server.clear()
+            self._sizes.clear()
+            self._readers.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "scopes": len(self._scopes),
+                "bypassed": self.bypassed,
+                "replica_reads": self.replica_reads,
+                "invalidated": self.invalidated,
+                **self.buckets.stats(),
+            }
+
+cache = AggregateCache(
+    max_buckets=AGGREGATE_CACHE_MAX_BUCKETS,
+    ttl=AGGREGATE_CACHE_TTL_SECONDS,
+    max_query_buckets=AGGREGATE_CACHE_MAX_QUERY_BUCKETS,
+)
@@ -0,0 +1,279 @@
+"""Estatísticas móveis por servidor e sensor e alertas avaliados na ingestão.
+
+Cada leitura aceita atualiza, em O(1) amortizado, uma janela por
+(server_ulid, sensor) com média, variância, mínimo e máximo; as regras de
+ALERT_RULES são avaliadas contra a janela antes de a leitura entrar nela.
+GET /monitoring lê só este estado, sem consultar sensor_data. Como os demais
+estados em memória, vale por processo e começa vazio a cada inicialização.
+"""
+import logging
+import math
+import os
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from pydantic import TypeAdapter
+from app import crud, metrics, schemas
+
+logger = logging.getLogger(__name__)
+
+# Regras em JSON, ex: [{"sensor": "temperature", "max": 80}, {"sensor": "current", "zscore": 4}].
+ALERT_RULES = os.getenv("ALERT_RULES", "[]")
+# A janela guarda as leituras dos últimos ALERT_WINDOW_SECONDS (pelo timestamp da leitura), até ALERT_WINDOW_MAX_READINGS.
+ALERT_WINDOW_SECONDS = float(os.getenv("ALERT_WINDOW_SECONDS", "300"))
+ALERT_WINDOW_MAX_READINGS = int(os.getenv("ALERT_WINDOW_MAX_READINGS", "1000"))
+# Servidores acompanhados; acima disso sai o que está há mais tempo sem leituras.
+ALERT_MAX_SERVERS = int(os.getenv("ALERT_MAX_SERVERS", "10000"))
+
+class RollingWindow:
+    """Janela deslizante de valores de um sensor de um servidor.
+
+    Soma e soma dos quadrados são mantidas deslocadas pelo primeiro valor da
+    janela, o que evita o cancelamento numérico da variância quando os valores
+    são grandes e próximos entre si (ex: tensão em torno de 220). Mínimo e
+    máximo vêm de deques monotônicas, então nada é percorrido por leitura.
+    As leituras saem na ordem em que chegaram, quando passam de
+    `max_readings` ou ficam mais antigas que a janela em relação à leitura
+    mais recente ou ao instante passado a `expire`; uma leitura mais antiga
+    que a janela em relação à mais recente já vista é ignorada.
+    """
+
+    def __init__(self, window: float, max_readings: int):
+        self.window = window
+        self.max_readings = max_readings
+        self._values = deque()
+        self._mins = deque()
+        self._maxs = deque()
+        self._seq = 0
+        self._shift = 0.0
+        self._sum = 0.0
+        self._sum_squares = 0.0
+        self.latest: Optional[datetime] = None
+        self.last_value: Optional[float] = None
+
+    def __len__(self):
+        return len(self._values)
+
+    def add(self, timestamp: datetime, value: float) -> bool:
+        if self.latest is not None and (self.latest - timestamp).total_seconds() > self.window:
+            return False
+        if not self._values:
+            self._shift = value
+            self._sum = self._sum_squares = 0.0
+        self._seq += 1
+        self._values.append((self._seq, timestamp, value))
+        delta = value - self._shift
+        self._sum += delta
+        self._sum_squares += delta * delta
+        while self._mins and self._mins[-1][1] >= value:
+            self._mins.pop()
+        self._mins.append((self._seq, value))
+        while self._maxs and self._maxs[-1][1] <= value:
+            self._maxs.pop()
+        self._maxs.append((self._seq, value))
+        if self.latest is None or timestamp > self.latest:
+            self.latest = timestamp
+        self.last_value = value
+        self._evict(self.latest)
+        return True
+
+    def expire(self, now: datetime):
+        """Tira as leituras que já saíram da janela em `now`, sem esperar a próxima leitura."""
+        self._evict(now if self.latest is None or now > self.latest else self.latest)
+
+    def _evict(self, reference: datetime):
+        while self._values and (
+            len(self._values) > self.max_readings
+            or (reference - self._values[0][1]).total_seconds() > self.window
+        ):
+            seq, _, value = self._values.popleft()
+            delta = value - self._shift
+            self._sum -= delta
+            self._sum_squares -= delta * delta
+            if self._mins[0][0] == seq:
+                self._mins.popleft()
+            if self._maxs[0][0] == seq:
+                self._maxs.popleft()
+
+    def mean(self) -> Optional[float]:
+        if not self._values:
+            return None
+        return self._shift + self._sum / len(self._values)
+
+    def stddev(self) -> Optional[float]:
+        count = len(self._values)
+        if count < 2:
+            return None
+        variance = (self._sum_squares - self._sum * self._sum / count) / (count - 1)
+        return math.sqrt(max(variance, 0.0))
+
+    def zscore(self, value: float) -> Optional[float]:
+        stddev = self.stddev()
+        if not stddev:
+            return None
+        return (value - self.mean()) / stddev
+
+    def stats(self):
+        return {
+            "count": len(self._values),
+            "mean": self.mean(),
+            "stddev": self.stddev(),
+            "min": self._mins[0][1] if self._mins else None,
+            "max": self._maxs[0][1] if self._maxs else None,
+            "last_value": self.last_value,
+            "last_timestamp": self.latest,
+        }
+
+def parse_rules(raw: str) -> List[schemas.AlertRule]:
+    rules = TypeAdapter(List[schemas.AlertRule]).validate_json(raw)
+    for rule in rules:
+        if rule.sensor not in crud.SENSOR_FIELDS:
+            raise ValueError(f"Sensor inválido na regra {rule.name!r}: {rule.sensor!r}.")
+    return rules
+
+class AlertMonitor:
+    """Janelas de todos os servidores e os alertas ativos.
+
+    Um alerta é identificado por (regra, servidor, sensor): começa na
+    primeira leitura que viola a regra, acumula as leituras seguintes que
+    também violam e é resolvido pela primeira leitura que não viola. Janelas
+    sem leituras dentro do período, pelo relógio do servidor, saem de
+    `snapshot` e `stats` junto com os alertas delas; acima de `max_servers`
+    sai o servidor há mais tempo sem leituras.
+    """
+
+    def __init__(self, rules: List[schemas.AlertRule], window: float, max_readings: int, max_servers: int):
+        self.rules = rules
+        self.window = window
+        self.max_readings = max_readings
+        self.max_servers = max_servers
+        self._rules_by_sensor: Dict[str, List[schemas.AlertRule]] = {}
+        for rule in rules:
+            self._rules_by_sensor.setdefault(rule.sensor, []).append(rule)
+        self._lock = threading.Lock()
+        # Em ordem da leitura mais recente recebida, para descartar primeiro quem está parado há mais tempo.
+        self._windows: "OrderedDict[str, Dict[str, RollingWindow]]" = OrderedDict()
+        self._active: Dict[Tuple[str, str, str], dict] = {}
+        self.late = 0
+        self.fired = 0
+        self.resolved = 0
+        self.expired = 0
+
+    def _drop_server(self, server_ulid: str):
+        del self._windows[server_ulid]
+        for key in [key for key in self._active if key[1] == server_ulid]:
+            del self._active[key]
+            self.expired += 1
+
+    def _prune(self, now: datetime):
+        for server_ulid, windows in list(self._windows.items()):
+            for sensor, window in list(windows.items()):
+                window.expire(now)
+                if not len(window):
+                    del windows[sensor]
+                    for key in [key for key in self._active if key[1:] == (server_ulid, sensor)]:
+                        del self._active[key]
+                        self.expired += 1
+            if not windows:
+                self._drop_server(server_ulid)
+
+    def observe(self, readings):
+        with self._lock:
+            for reading in readings:
+                windows = self._windows.get(reading.server_ulid)
+                if windows is None:
+                    if len(self._windows) >= self.max_servers:
+                        self._prune(datetime.utcnow())
+                    if len(self._windows) >= self.max_servers:
+                        self._drop_server(next(iter(self._windows)))
+                    windows = self._windows[reading.server_ulid] = {}
+                else:
+                    self._windows.move_to_end(reading.server_ulid)
+                for sensor in crud.SENSOR_FIELDS:
+                    value = getattr(reading, sensor)
+                    if value is None:
+                        continue
+                    window = windows.get(sensor)
+                    if window is None:
+                        window = windows[sensor] = RollingWindow(self.window, self.max_readings)
+                    # Depois de um intervalo sem leituras, o z-score é calculado só contra o que ainda está na janela.
+                    window.expire(reading.timestamp)
+                    for rule in self._rules_by_sensor.get(sensor, ()):
+                        if rule.server_ulid is None or rule.server_ulid == reading.server_ulid:
+                            self._evaluate(rule, reading.server_ulid, window, reading.timestamp, value)
+                    if not window.add(reading.timestamp, value):
+                        self.late += 1
+
+    def _evaluate(self, rule: schemas.AlertRule, server_ulid: str, window: RollingWindow, timestamp: datetime, value: float):
+        violation = None
+        if rule.max is not None and value > rule.max:
+            violation = ("max", rule.max, None)
+        elif rule.min is not None and value < rule.min:
+            violation = ("min", rule.min, None)
+        elif rule.zscore is not None and len(window) >= rule.min_samples:
+            zscore = window.zscore(value)
+            if zscore is not None and abs(zscore) >= rule.zscore:
+                violation = ("zscore", rule.zscore, zscore)
+
+        key = (rule.name, server_ulid, rule.sensor)
+        alert = self._active.get(key)
+        if violation is None:
+            if alert is not None:
+                del self._active[key]
+                self.resolved += 1
+                logger.info("Alerta %s resolvido em %s/%s", rule.name, server_ulid, rule.sensor)
+            return
+
+        kind, threshold, zscore = violation
+        if alert is None:
+            alert = self._active[key] = {
+                "rule": rule.name,
+                "server_ulid": server_ulid,
+                "sensor": rule.sensor,
+                "started_at": timestamp,
+                "readings": 0,
+            }
+            self.fired += 1
+            metrics.ALERTS_FIRED.labels(rule.name).inc()
+            logger.warning("Alerta %s em %s/%s: %s=%s (limite %s)", rule.name, server_ulid, rule.sensor, kind, value, threshold)
+        alert.update(kind=kind, value=value, threshold=threshold, zscore=zscore, last_seen=timestamp)
+        alert["readings"] += 1
+
+    def snapshot(self, server_ulid: Optional[str] = None):
+        """Estatísticas atuais e alertas ativos, de um servidor ou de todos."""
+        with self._lock:
+            self._prune(datetime.utcnow())
+            servers = {
+                ulid: {sensor: window.stats() for sensor, window in windows.items()}
+                for ulid, windows in self._windows.items()
+                if server_ulid is None or ulid == server_ulid
+            }
+            active = [
+                dict(alert) for alert in self._active.values()
+                if server_ulid is None or alert["server_ulid"] == server_ulid
+            ]
+        return {"window_seconds": self.window, "servers": servers, "alerts": active}
+
+    def stats(self):
+        with self._lock:
+            self._prune(datetime.utcnow())
+            return {
+                "rules": len(self.rules),
+                "window_seconds": self.window,
+                "window_max_readings": self.max_readings,
+                "servers": len(self._windows),
+                "windows": sum(len(windows) for windows in self._windows.values()),
+                "active": len(self._active),
+                "fired": self.fired,
+                "resolved": self.resolved,
+                "expired": self.expired,
+                "late": self.late,
+            }
+
+monitor = AlertMonitor(
+    rules=parse_rules(ALERT_RULES),
+    window=ALERT_WINDOW_SECONDS,
+    max_readings=ALERT_WINDOW_MAX_READINGS,
+    max_servers=ALERT_MAX_SERVERS,
+)
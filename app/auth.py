@@ -1,17 +1,38 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordBearer
-from . import schemas, models, database
+from . import schemas, models, database, metrics
+from .cache import TTLCache
 from sqlalchemy.orm import Session
 
 SECRET_KEY = "sua_chave_secreta" 
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# "db" consulta o usuário a cada requisição, "cache" guarda o usuário resolvido por
+# USER_CACHE_TTL_SECONDS e "stateless" confia nas claims do token até ele expirar.
+AUTH_USER_MODE = os.getenv("AUTH_USER_MODE", "cache")
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "60"))
+USER_CACHE_MAX_SIZE = int(os.getenv("USER_CACHE_MAX_SIZE", "10000"))
+
+user_cache = TTLCache(max_size=USER_CACHE_MAX_SIZE, ttl=USER_CACHE_TTL_SECONDS)
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 1)))
+PASSWORD_HASH_QUEUE_LIMIT = int(os.getenv("PASSWORD_HASH_QUEUE_LIMIT", "64"))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+_hash_executor = None
+_hash_pending = 0
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login")
 
@@ -21,12 +42,71 @@ def verify_password(plain_password: str, hashed_password: str):
 def get_password_hash(password: str):
     return pwd_context.hash(password)
 
+def verify_and_update_password(plain_password: str, hashed_password: str):
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
+def _get_hash_executor():
+    global _hash_executor
+    if _hash_executor is None:
+        _hash_executor = ProcessPoolExecutor(
+            max_workers=PASSWORD_HASH_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _hash_executor
+
+def shutdown_hash_executor():
+    """Encerra os processos do bcrypt; o próximo hash cria um pool novo."""
+    global _hash_executor
+    executor, _hash_executor = _hash_executor, None
+    if executor is not None:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+async def _run_hash_job(func, *args):
+    """Executa o bcrypt no pool de processos, recusando com 503 quando a fila está cheia."""
+    global _hash_pending
+    if _hash_pending >= PASSWORD_HASH_QUEUE_LIMIT:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Muitas requisições de autenticação, tente novamente.",
+            headers={"Retry-After": "1"},
+        )
+    _hash_pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_get_hash_executor(), func, *args)
+    finally:
+        _hash_pending -= 1
+
+async def get_password_hash_async(password: str):
+    return await _run_hash_job(get_password_hash, password)
+
 def authenticate_user(db: Session, username: str, password: str):
     user = db.query(models.User).filter(models.User.username == username).first()
     if not user or not verify_password(password, user.hashed_password):
         return False
     return user
 
+def _update_password_hash(db: Session, user: models.User, hashed_password: str):
+    user.hashed_password = hashed_password
+    db.commit()
+
+async def authenticate_user_async(db: Session, username: str, password: str):
+    """Como authenticate_user, mas sem ocupar a thread da requisição com o bcrypt.
+
+    Se o hash foi gerado com outro custo que não BCRYPT_ROUNDS, ele é
+    regravado com o custo atual.
+    """
+    user = await run_in_threadpool(
+        lambda: db.query(models.User).filter(models.User.username == username).first()
+    )
+    if not user:
+        return False
+    valid, new_hash = await _run_hash_job(verify_and_update_password, password, user.hashed_password)
+    if not valid:
+        return False
+    if new_hash:
+        await run_in_threadpool(_update_password_hash, db, user, new_hash)
+    return user
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -37,6 +117,10 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+def invalidate_user(username: str):
+    user_cache.invalidate(username)
+
+@metrics.timed("auth")
 def get_current_user(db: Session = Depends(database.get_db), token: str = Depends(oauth2_scheme)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -50,7 +134,19 @@ def get_current_user(db: Session = Depends(database.get_db), token: str = Depend
             raise credentials_exception
     except JWTError:
         raise credentials_exception
+
+    if AUTH_USER_MODE == "stateless" and payload.get("uid") is not None:
+        return schemas.User(id=payload["uid"], username=username, is_active=True)
+
+    if AUTH_USER_MODE == "cache":
+        cached_user = user_cache.get(username)
+        if cached_user is not None:
+            return cached_user
+
     user = db.query(models.User).filter(models.User.username == username).first()
-    if user is None:
+    if user is None or not user.is_active:
         raise credentials_exception
-    return user
\ No newline at end of file
+    user = schemas.User.model_validate(user)
+    if AUTH_USER_MODE == "cache":
+        user_cache.set(username, user)
+    return user
@@ -0,0 +1,78 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, List, Optional
+
+_MISSING = object()
+
+class TTLCache:
+    """Cache LRU com expiração por tempo e contadores de acertos e falhas.
+
+    `on_evict` é chamado com a chave de cada entrada que saiu por LRU ou por
+    expiração, depois de soltar a trava do cache.
+    """
+
+    def __init__(self, max_size: int, ttl: float, on_evict: Optional[Callable[[Hashable], None]] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _notify(self, keys: List[Hashable]):
+        if self.on_evict is not None:
+            for key in keys:
+                self.on_evict(key)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        expired = []
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is _MISSING or entry[0] < time.monotonic():
+                if entry is not _MISSING:
+                    del self._entries[key]
+                    expired.append(key)
+                self.misses += 1
+                value = default
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                value = entry[1]
+        self._notify(expired)
+        return value
+
+    def set(self, key: Hashable, value: Any) -> bool:
+        """Guarda `value`; retorna True se a chave ainda não estava no cache."""
+        evicted = []
+        with self._lock:
+            added = key not in self._entries
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                evicted.append(self._entries.popitem(last=False)[0])
+                self.evictions += 1
+        self._notify(evicted)
+        return added
+
+    def invalidate(self, key: Hashable) -> bool:
+        with self._lock:
+            return self._entries.pop(key, _MISSING) is not _MISSING
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -1,106 +1,672 @@
+import base64
+import os
+import re
 from sqlalchemy.orm import Session
-from sqlalchemy import func
-from datetime import datetime, timedelta
-from typing import Optional
+from sqlalchemy import func, select, delete, update, or_, case, cast, literal, literal_column, union_all, BigInteger, Float
+from sqlalchemy.dialects import postgresql, sqlite
+from datetime import datetime, timedelta, timezone
+from typing import Optional, List, Tuple
 from ulid import new
-from app import models, schemas, auth
+from sqlalchemy.exc import IntegrityError, OperationalError
+from app import models, schemas, auth, partitions, sqlite_backend
+from .database import DATABASE_BACKEND
+
+# "nothing" ignora leituras repetidas para (server_ulid, timestamp); "update" sobrescreve os valores.
+SENSOR_DATA_CONFLICT_POLICY = os.getenv("SENSOR_DATA_CONFLICT_POLICY", "nothing")
+# Leituras brutas mais antigas que isso são apagadas depois de incorporadas aos rollups (0 guarda tudo).
+RAW_RETENTION_DAYS = float(os.getenv("RAW_RETENTION_DAYS", "0"))
+
+SENSOR_FIELDS = ["temperature", "humidity", "voltage", "current"]
+SENSOR_DATA_COLUMNS = ["timestamp"] + SENSOR_FIELDS
+
+ROLLUP_GRANULARITIES = {
+    "minute": timedelta(minutes=1),
+    "hour": timedelta(hours=1),
+    "day": timedelta(days=1),
+}
+ROLLUP_STATE_NAME = "sensor_data"
+
+# Intervalos de agregação são alinhados a esta origem, como no date_bin do Postgres.
+BUCKET_ORIGIN = datetime(2000, 1, 1)
+INTERVAL_UNITS = {
+    "s": timedelta(seconds=1),
+    "m": timedelta(minutes=1),
+    "h": timedelta(hours=1),
+    "d": timedelta(days=1),
+}
+# Intervalos maiores estouram as contas de datetime ao alinhar os limites da consulta.
+AGGREGATION_MAX_INTERVAL = timedelta(days=365)
+# INSERT ... ON CONFLICT e RETURNING existem nos dois backends, com a mesma API no SQLAlchemy.
+insert = sqlite.insert if DATABASE_BACKEND == "sqlite" else postgresql.insert
+
+AGGREGATION_STATS = ["avg", "min", "max", "count", "sum", "stddev"]
+# Estatísticas que os rollups conseguem responder; stddev e percentis exigem as leituras brutas.
+ROLLUP_STATS = {"avg", "min", "max", "count", "sum"}
+
+def _insert_sensor_data_stmt():
+    stmt = insert(models.SensorData)
+    index_elements = [models.SensorData.server_ulid, models.SensorData.timestamp]
+    if SENSOR_DATA_CONFLICT_POLICY == "update":
+        set_ = {field: stmt.excluded[field] for field in SENSOR_FIELDS}
+        # Uma leitura já incorporada volta com os valores antigos nos rollups; o refresher recalcula os intervalos dela.
+        set_["fold_status"] = case(
+            (models.SensorData.fold_status == models.FOLD_PENDING, models.FOLD_PENDING),
+            else_=models.FOLD_REWRITTEN
+        )
+        return stmt.on_conflict_do_update(index_elements=index_elements, set_=set_)
+    return stmt.on_conflict_do_nothing(index_elements=index_elements)
+
+def _execute_sensor_data_insert(db: Session, stmt, rows, timestamps):
+    # Com sensor_data particionada, cria antes as partições que faltarem; se outro processo
+    # apagou uma partição que este ainda achava existir, recarrega a lista e tenta de novo.
+    partitions.manager.ensure(timestamps)
+    try:
+        return db.execute(stmt, rows)
+    except IntegrityError as e:
+        if not partitions.manager.enabled or not partitions.is_missing_partition(e):
+            raise
+        db.rollback()
+        partitions.manager.forget()
+        partitions.manager.ensure(timestamps)
+        return db.execute(stmt, rows)
 
 def create_sensor_data(db: Session, data: schemas.SensorDataCreate):
-    db_data = models.SensorData(**data.dict())
-    db.add(db_data)
+    stmt = (
+        _insert_sensor_data_stmt()
+        .values(**data.model_dump())
+        .returning(*models.SensorData.__table__.c)
+    )
+    row = _execute_sensor_data_insert(db, stmt, None, [data.timestamp]).first()
     db.commit()
-    db.refresh(db_data)
-    return db_data
+    return row
 
-def get_sensor_data_by_server_ulid(db: Session, server_ulid: str):
-    return db.query(models.SensorData).filter(models.SensorData.server_ulid == server_ulid).first()
+def create_sensor_data_batch(db: Session, items: List[schemas.SensorDataCreate]):
+    """Grava as leituras em um único INSERT multi-linhas.
 
-def get_sensor_data(
-    db: Session,
+    Retorna, na ordem de `items`, o id gravado ou None para leituras
+    descartadas como duplicadas pela política de conflito.
+    """
+    positions = {}
+    for position, item in enumerate(items):
+        key = (item.server_ulid, item.timestamp)
+        if key not in positions or SENSOR_DATA_CONFLICT_POLICY == "update":
+            positions[key] = position
+
+    if not positions:
+        return []
+
+    rows = [items[position].model_dump() for position in sorted(positions.values())]
+    stmt = _insert_sensor_data_stmt().returning(
+        models.SensorData.id, models.SensorData.server_ulid, models.SensorData.timestamp
+    )
+    written = _execute_sensor_data_insert(db, stmt, rows, [row["timestamp"] for row in rows]).all()
+    db.commit()
+
+    ids = [None] * len(items)
+    for data_id, server_ulid, timestamp in written:
+        ids[positions[(server_ulid, timestamp)]] = data_id
+    return ids
+
+def naive_utc(value: Optional[datetime]):
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def _filter_sensor_data(
+    query,
     server_ulid: Optional[str] = None,
     start_time: Optional[datetime] = None,
     end_time: Optional[datetime] = None,
     sensor_type: Optional[str] = None
 ):
-    query = db.query(models.SensorData)
-
     if server_ulid:
         query = query.filter(models.SensorData.server_ulid == server_ulid)
     if start_time:
-        query = query.filter(models.SensorData.timestamp >= start_time)
+        query = query.filter(models.SensorData.timestamp >= naive_utc(start_time))
     if end_time:
-        query = query.filter(models.SensorData.timestamp <= end_time)
-
-    if sensor_type:
-        if sensor_type == "temperature":
-            query = query.filter(models.SensorData.temperature.isnot(None))
-        elif sensor_type == "humidity":
-            query = query.filter(models.SensorData.humidity.isnot(None))
-        elif sensor_type == "voltage":
-            query = query.filter(models.SensorData.voltage.isnot(None))
-        elif sensor_type == "current":
-            query = query.filter(models.SensorData.current.isnot(None))
+        query = query.filter(models.SensorData.timestamp <= naive_utc(end_time))
+
+    if sensor_type in SENSOR_FIELDS:
+        query = query.filter(getattr(models.SensorData, sensor_type).isnot(None))
+
+    return query
+
+def _paginate_sensor_data(query, limit: Optional[int], after: Optional[Tuple[datetime, int]]):
+    if limit is None and after is None:
+        return query
+
+    if after is not None:
+        after_timestamp, after_id = after
+        query = query.filter(
+            models.SensorData.timestamp >= after_timestamp,
+            or_(
+                models.SensorData.timestamp > after_timestamp,
+                models.SensorData.id > after_id
+            )
+        )
+    query = query.order_by(models.SensorData.timestamp, models.SensorData.id)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+def get_sensor_data(
+    db: Session,
+    server_ulid: Optional[str] = None,
+    start_time: Optional[datetime] = None,
+    end_time: Optional[datetime] = None,
+    sensor_type: Optional[str] = None,
+    limit: Optional[int] = None,
+    after: Optional[Tuple[datetime, int]] = None
+):
+    """Busca leituras; com `limit` ou `after` pagina por (timestamp, id).
 
+    `after` é a chave da última leitura da página anterior. A condição
+    `timestamp >= after_timestamp` mantém a busca no índice
+    (server_ulid, timestamp), então páginas profundas custam o mesmo que a primeira.
+    """
+    query = _filter_sensor_data(db.query(models.SensorData), server_ulid, start_time, end_time, sensor_type)
+    query = _paginate_sensor_data(query, limit, after)
     results = query.all()
     return results
 
-def get_aggregated_sensor_data(
+def get_sensor_data_rows(
     db: Session,
     server_ulid: Optional[str] = None,
     start_time: Optional[datetime] = None,
     end_time: Optional[datetime] = None,
     sensor_type: Optional[str] = None,
-    aggregation: Optional[str] = None
+    limit: Optional[int] = None,
+    after: Optional[Tuple[datetime, int]] = None
 ):
-    if aggregation not in ["minute", "hour", "day"]:
-        raise ValueError("Aggregation deve ser 'minute', 'hour' ou 'day'.")
-    
-    if aggregation == "minute":
-        time_trunc = func.date_trunc('minute', models.SensorData.timestamp)
-    elif aggregation == "hour":
-        time_trunc = func.date_trunc('hour', models.SensorData.timestamp)
-    elif aggregation == "day":
-        time_trunc = func.date_trunc('day', models.SensorData.timestamp)
-    else:
-        raise ValueError("Aggregation deve ser 'minute', 'hour' ou 'day'.")
+    """Como get_sensor_data, mas retorna tuplas (SENSOR_DATA_COLUMNS..., id) sem objetos ORM."""
+    stmt = select(
+        *[getattr(models.SensorData, column) for column in SENSOR_DATA_COLUMNS],
+        models.SensorData.id
+    )
+    stmt = _filter_sensor_data(stmt, server_ulid, start_time, end_time, sensor_type)
+    stmt = _paginate_sensor_data(stmt, limit, after)
+    return db.execute(stmt).all()
 
-    query = db.query(
-        time_trunc.label("timestamp"),
-        func.avg(models.SensorData.temperature).label("temperature"),
-        func.avg(models.SensorData.humidity).label("humidity"),
-        func.avg(models.SensorData.voltage).label("voltage"),
-        func.avg(models.SensorData.current).label("current")
+def encode_page_cursor(timestamp: datetime, data_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{timestamp.isoformat()}|{data_id}".encode()).decode()
+
+def decode_page_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        timestamp, data_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(timestamp), int(data_id)
+    except ValueError:
+        raise ValueError("Cursor de paginação inválido.")
+
+def iter_sensor_data(
+    db: Session,
+    server_ulid: Optional[str] = None,
+    start_time: Optional[datetime] = None,
+    end_time: Optional[datetime] = None,
+    sensor_type: Optional[str] = None,
+    chunk_size: int = 1000,
+    columns: Optional[List[str]] = None,
+    ordered: bool = False
+):
+    """Percorre as leituras com um cursor no servidor, `chunk_size` linhas por vez.
+
+    Produz tuplas na ordem de `columns` (por padrão `SENSOR_DATA_COLUMNS`)
+    sem montar objetos ORM. Com `ordered` as leituras vêm em ordem de timestamp.
+    """
+    columns = columns or SENSOR_DATA_COLUMNS
+    stmt = select(*[getattr(models.SensorData, column) for column in columns])
+    stmt = _filter_sensor_data(stmt, server_ulid, start_time, end_time, sensor_type)
+    if ordered:
+        stmt = stmt.order_by(models.SensorData.timestamp, models.SensorData.id)
+    result = db.execute(stmt.execution_options(yield_per=chunk_size))
+    for partition in result.partitions():
+        yield from partition
+
+def count_sensor_series(
+    db: Session,
+    server_ulid: Optional[str] = None,
+    start_time: Optional[datetime] = None,
+    end_time: Optional[datetime] = None,
+    sensor_type: Optional[str] = None
+):
+    """Quantidade de valores não nulos de cada sensor entre as leituras filtradas."""
+    query = db.query(*[func.count(getattr(models.SensorData, field)) for field in SENSOR_FIELDS])
+    query = _filter_sensor_data(query, server_ulid, start_time, end_time, sensor_type)
+    return dict(zip(SENSOR_FIELDS, query.one()))
+
+def _bucket_expr(granularity: str, column):
+    # Minuto, hora e dia alinhados a BUCKET_ORIGIN (meia-noite) são os mesmos do date_trunc.
+    return _bin_expr(ROLLUP_GRANULARITIES[granularity], column)
+
+def _sensor_mask_expr():
+    return sum(
+        case((getattr(models.SensorData, field).isnot(None), literal_column(str(1 << bit))), else_=literal_column("0"))
+        for bit, field in enumerate(SENSOR_FIELDS)
     )
 
-    if server_ulid:
-        query = query.filter(models.SensorData.server_ulid == server_ulid)
+def parse_interval(aggregation: str) -> timedelta:
+    """Largura do intervalo: 'minute', 'hour', 'day' ou um número com unidade, como '5m', '15m', '2h' ou '30s'."""
+    if aggregation in ROLLUP_GRANULARITIES:
+        return ROLLUP_GRANULARITIES[aggregation]
+    match = re.fullmatch(r"(\d+)([smhd])", aggregation or "")
+    if not match or int(match.group(1)) == 0:
+        raise ValueError("Aggregation deve ser 'minute', 'hour', 'day' ou um intervalo como '5m', '15m', '2h'.")
+    # Compara em segundos antes de montar o timedelta, que estoura com números muito grandes.
+    unit = INTERVAL_UNITS[match.group(2)]
+    if int(match.group(1)) * unit.total_seconds() > AGGREGATION_MAX_INTERVAL.total_seconds():
+        raise ValueError(f"Aggregation deve ser no máximo {AGGREGATION_MAX_INTERVAL.days}d.")
+    return int(match.group(1)) * unit
+
+def _percentile(stat: str) -> Optional[float]:
+    match = re.fullmatch(r"p(\d{1,2})", stat)
+    if match and int(match.group(1)) > 0:
+        return int(match.group(1)) / 100
+    return None
+
+def parse_stats(stats: Optional[str]) -> Optional[List[str]]:
+    """Lista de estatísticas separadas por vírgula, como 'min,max,avg,p95'."""
+    if not stats:
+        return None
+    parsed = list(dict.fromkeys(stat.strip() for stat in stats.split(",") if stat.strip()))
+    for stat in parsed:
+        if stat not in AGGREGATION_STATS and _percentile(stat) is None:
+            raise ValueError(f"Estatística inválida: '{stat}'. Use {', '.join(AGGREGATION_STATS)} ou percentis como p50, p95.")
+    return parsed or None
+
+def aggregation_columns(stats: Optional[List[str]] = None, group_by_server: bool = False) -> List[str]:
+    """Colunas das linhas de get_aggregated_sensor_data, na ordem em que vêm."""
+    columns = ["timestamp"] + (["server_ulid"] if group_by_server else [])
+    return columns + [label for _, _, label in _stat_columns(stats)]
+
+def _stat_columns(stats: Optional[List[str]]):
+    if stats is None:
+        return [(field, "avg", field) for field in SENSOR_FIELDS]
+    return [(field, stat, f"{field}_{stat}") for field in SENSOR_FIELDS for stat in stats]
+
+def _bin_expr(width: timedelta, column):
+    if DATABASE_BACKEND == "sqlite":
+        return sqlite_backend.bin_expr(int(width.total_seconds()), column, BUCKET_ORIGIN)
+    # Intervalo e origem vão como literais para que o SELECT e o GROUP BY usem a mesma expressão.
+    return func.date_bin(
+        literal_column(f"interval '{int(width.total_seconds())} seconds'"),
+        column,
+        literal_column(f"timestamp '{BUCKET_ORIGIN.isoformat(sep=' ')}'")
+    )
+
+def bin_timestamp(value: datetime, width: timedelta) -> datetime:
+    return BUCKET_ORIGIN + (value - BUCKET_ORIGIN) // width * width
+
+def _rollup_granularity(width: timedelta, stats: List[str]) -> Optional[str]:
+    """Maior granularidade de rollup que cabe inteira em cada intervalo pedido."""
+    if not set(stats) <= ROLLUP_STATS:
+        return None
+    for granularity, rollup_width in sorted(ROLLUP_GRANULARITIES.items(), key=lambda item: item[1], reverse=True):
+        if width % rollup_width == timedelta(0):
+            return granularity
+    return None
+
+def _sum(column):
+    # Com SENSOR_DATA_STORAGE=partitioned os valores são real; a soma é feita em double precision.
+    return func.sum(cast(column, Float))
+
+def _raw_stat_expr(stat: str, column):
+    if stat == "avg":
+        return func.avg(column)
+    if stat == "min":
+        return func.min(column)
+    if stat == "max":
+        return func.max(column)
+    if stat == "count":
+        return func.count(column)
+    if stat == "sum":
+        return _sum(column)
+    if stat == "stddev":
+        return func.stddev_samp(column)
+    if DATABASE_BACKEND == "sqlite":
+        return func.percentile_cont(column, literal(_percentile(stat)))
+    return func.percentile_cont(_percentile(stat)).within_group(column)
+
+def _least(left, right):
+    if DATABASE_BACKEND == "sqlite":
+        # min() com vários argumentos é NULL se algum for NULL; least() do Postgres ignora os NULL.
+        return func.min(func.coalesce(left, right), func.coalesce(right, left))
+    return func.least(left, right)
+
+def _greatest(left, right):
+    if DATABASE_BACKEND == "sqlite":
+        return func.max(func.coalesce(left, right), func.coalesce(right, left))
+    return func.greatest(left, right)
+
+def _merged_stat_expr(stat: str, parts, field: str):
+    if stat == "avg":
+        return func.sum(parts.c[f"{field}_sum"]) / func.nullif(func.sum(parts.c[f"{field}_count"]), 0)
+    if stat == "min":
+        return func.min(parts.c[f"{field}_min"])
+    if stat == "max":
+        return func.max(parts.c[f"{field}_max"])
+    if stat == "count":
+        return cast(func.coalesce(func.sum(parts.c[f"{field}_count"]), 0), BigInteger)
+    return func.sum(parts.c[f"{field}_sum"])
+
+def get_aggregated_sensor_data(
+    db: Session,
+    server_ulid: Optional[str] = None,
+    start_time: Optional[datetime] = None,
+    end_time: Optional[datetime] = None,
+    sensor_type: Optional[str] = None,
+    aggregation: Optional[str] = None,
+    stats: Optional[List[str]] = None,
+    group_by_server: bool = False
+):
+    """Estatísticas por intervalo de tempo (e opcionalmente por servidor) em uma consulta.
+
+    Sem `stats` devolve só a média de cada sensor, com as colunas de
+    SENSOR_DATA_COLUMNS; com `stats` devolve as colunas de aggregation_columns.
+    Quando todas as estatísticas são deriváveis de soma, contagem, mínimo e
+    máximo e o intervalo é múltiplo de minuto, hora ou dia, os intervalos
+    inteiramente dentro de [start_time, end_time] vêm de sensor_data_rollups e
+    só as pontas e as leituras ainda não incorporadas (fold_status pendente)
+    vêm de sensor_data. Uma leitura reescrita depois de incorporada aparece
+    com os valores antigos até o próximo ciclo do refresher. stddev e
+    percentis leem sensor_data.
+    """
+    width = parse_interval(aggregation)
+    stat_columns = _stat_columns(stats)
+    start_time = naive_utc(start_time)
+    end_time = naive_utc(end_time)
+    granularity = _rollup_granularity(width, [stat for _, stat, _ in stat_columns])
+
+    if granularity is None:
+        bucket = _bin_expr(width, models.SensorData.timestamp)
+        group = [bucket] + ([models.SensorData.server_ulid] if group_by_server else [])
+        query = db.query(
+            bucket.label("timestamp"),
+            *group[1:],
+            *[_raw_stat_expr(stat, getattr(models.SensorData, field)).label(label) for field, stat, label in stat_columns]
+        )
+        query = _filter_sensor_data(query, server_ulid, start_time, end_time, sensor_type)
+        return query.group_by(*group).order_by(*group).all()
+
+    rollup_width = ROLLUP_GRANULARITIES[granularity]
+    horizon = raw_retention_horizon(db)
+    full_start = None
+    full_end = None
+    # Antes do horizonte de retenção as leituras brutas podem já ter sido apagadas, então o
+    # intervalo da ponta vem inteiro dos rollups em vez de ser recortado em sensor_data.
     if start_time:
-        query = query.filter(models.SensorData.timestamp >= start_time)
+        full_start = bin_timestamp(start_time, rollup_width)
+        if full_start < start_time and not (horizon and start_time < horizon):
+            full_start += rollup_width
     if end_time:
-        query = query.filter(models.SensorData.timestamp <= end_time)
-
-    if sensor_type:
-        if sensor_type == "temperature":
-            query = query.filter(models.SensorData.temperature.isnot(None))
-        elif sensor_type == "humidity":
-            query = query.filter(models.SensorData.humidity.isnot(None))
-        elif sensor_type == "voltage":
-            query = query.filter(models.SensorData.voltage.isnot(None))
-        elif sensor_type == "current":
-            query = query.filter(models.SensorData.current.isnot(None))
-
-    query = query.group_by(time_trunc)
+        full_end = bin_timestamp(end_time, rollup_width)
+        if full_end < end_time and horizon and end_time < horizon:
+            full_end += rollup_width
+
+    partial_stats = ("sum", "count", "min", "max")
+    rollup = models.SensorDataRollup
+    rollup_part = select(
+        _bin_expr(width, rollup.bucket).label("bucket"),
+        *([rollup.server_ulid.label("server_ulid")] if group_by_server else []),
+        *[getattr(rollup, f"{field}_{stat}").label(f"{field}_{stat}") for field in SENSOR_FIELDS for stat in partial_stats]
+    ).where(rollup.granularity == granularity)
+    if server_ulid:
+        rollup_part = rollup_part.where(rollup.server_ulid == server_ulid)
+    if full_start:
+        rollup_part = rollup_part.where(rollup.bucket >= full_start)
+    if full_end:
+        rollup_part = rollup_part.where(rollup.bucket < full_end)
+    if sensor_type in SENSOR_FIELDS:
+        rollup_part = rollup_part.where(rollup.sensor_mask.op("&")(1 << SENSOR_FIELDS.index(sensor_type)) != 0)
+
+    pending = [models.SensorData.fold_status == models.FOLD_PENDING]
+    if full_start:
+        pending.append(models.SensorData.timestamp < full_start)
+    if full_end:
+        pending.append(models.SensorData.timestamp >= full_end)
+
+    raw_bucket = _bin_expr(width, models.SensorData.timestamp)
+    raw_group = [raw_bucket] + ([models.SensorData.server_ulid] if group_by_server else [])
+    raw_part = select(
+        raw_bucket.label("bucket"),
+        *([models.SensorData.server_ulid.label("server_ulid")] if group_by_server else []),
+        *[
+            _raw_stat_expr(stat, getattr(models.SensorData, field)).label(f"{field}_{stat}")
+            for field in SENSOR_FIELDS
+            for stat in partial_stats
+        ]
+    )
+    raw_part = _filter_sensor_data(raw_part, server_ulid, start_time, end_time, sensor_type)
+    raw_part = raw_part.where(or_(*pending)).group_by(*raw_group)
+
+    parts = union_all(rollup_part, raw_part).subquery()
+    group = [parts.c.bucket] + ([parts.c.server_ulid] if group_by_server else [])
+    query = db.query(
+        parts.c.bucket.label("timestamp"),
+        *group[1:],
+        *[_merged_stat_expr(stat, parts, field).label(label) for field, stat, label in stat_columns]
+    ).group_by(*group).order_by(*group)
     results = query.all()
     return results
 
-def create_user(db: Session, user: schemas.UserCreate):
-    hashed_password = auth.get_password_hash(user.password)
+def get_rewritten_timestamps(
+    db: Session,
+    server_ulid: Optional[str] = None,
+    start_time: Optional[datetime] = None,
+    end_time: Optional[datetime] = None
+) -> List[datetime]:
+    """Timestamps em [start_time, end_time) de leituras reescritas que o refresher ainda não recalculou.
+
+    Os intervalos dessas leituras saem de get_aggregated_sensor_data com os
+    valores antigos até o próximo ciclo do refresher.
+    """
+    stmt = select(models.SensorData.timestamp).where(models.SensorData.fold_status == models.FOLD_REWRITTEN)
+    if server_ulid:
+        stmt = stmt.where(models.SensorData.server_ulid == server_ulid)
+    if start_time:
+        stmt = stmt.where(models.SensorData.timestamp >= start_time)
+    if end_time:
+        stmt = stmt.where(models.SensorData.timestamp < end_time)
+    return db.execute(stmt).scalars().all()
+
+def _fold_rollups_stmt(granularity: str, *conditions):
+    rollup = models.SensorDataRollup
+    bucket = _bucket_expr(granularity, models.SensorData.timestamp)
+    mask = _sensor_mask_expr()
+
+    columns = ["granularity", "server_ulid", "bucket", "sensor_mask"]
+    values = [literal_column(f"'{granularity}'"), models.SensorData.server_ulid, bucket, mask]
+    for field in SENSOR_FIELDS:
+        column = getattr(models.SensorData, field)
+        columns += [f"{field}_sum", f"{field}_count", f"{field}_min", f"{field}_max"]
+        values += [_sum(column), func.count(column), func.min(column), func.max(column)]
+
+    source = (
+        select(*values)
+        .where(*conditions)
+        .group_by(models.SensorData.server_ulid, bucket, mask)
+    )
+    stmt = insert(rollup).from_select(columns, source)
+    updates = {}
+    for field in SENSOR_FIELDS:
+        updates[f"{field}_sum"] = getattr(rollup, f"{field}_sum") + stmt.excluded[f"{field}_sum"]
+        updates[f"{field}_count"] = getattr(rollup, f"{field}_count") + stmt.excluded[f"{field}_count"]
+        updates[f"{field}_min"] = _least(getattr(rollup, f"{field}_min"), stmt.excluded[f"{field}_min"])
+        updates[f"{field}_max"] = _greatest(getattr(rollup, f"{field}_max"), stmt.excluded[f"{field}_max"])
+    return stmt.on_conflict_do_update(
+        index_elements=[rollup.granularity, rollup.server_ulid, rollup.bucket, rollup.sensor_mask],
+        set_=updates
+    )
+
+def _ensure_rollup_state(db: Session):
+    db.execute(
+        insert(models.RollupState)
+        .values(name=ROLLUP_STATE_NAME, last_id=0)
+        .on_conflict_do_nothing(index_elements=[models.RollupState.name])
+    )
+    db.commit()
+
+def raw_retention_horizon(db: Session) -> Optional[datetime]:
+    """Instante antes do qual a retenção já pode ter apagado leituras brutas, ou None se nunca apagou.
+
+    Vem do corte gravado por quem aplicou a retenção (ver
+    set_raw_retention_horizon), não de RAW_RETENTION_DAYS deste processo.
+    """
+    state = models.RollupState
+    return db.execute(select(state.raw_deleted_before).where(state.name == ROLLUP_STATE_NAME)).scalar()
+
+def set_raw_retention_horizon(db: Session, older_than: datetime):
+    """Registra, antes de apagar, que leituras anteriores a `older_than` podem sair de sensor_data.
+
+    O corte só avança; esperar a trava da linha de estado garante que nenhum
+    lote do refresher em andamento recalcule intervalos com leituras que estão
+    para ser apagadas.
+    """
+    _ensure_rollup_state(db)
+    state = models.RollupState
+    db.execute(
+        update(state)
+        .where(
+            state.name == ROLLUP_STATE_NAME,
+            or_(state.raw_deleted_before.is_(None), state.raw_deleted_before < older_than)
+        )
+        .values(raw_deleted_before=older_than)
+    )
+    db.commit()
+
+def delete_compacted_sensor_data(db: Session, older_than: datetime, batch_size: int) -> int:
+    """Apaga até `batch_size` leituras anteriores a `older_than` já incorporadas aos rollups.
+
+    Só leituras marcadas como incorporadas pelo refresher são apagadas, então
+    nada sai de sensor_data antes de estar nas somas de minute, hour e day,
+    mesmo que a transação que a gravou tenha terminado depois de leituras com
+    id maior. Retorna a quantidade apagada; 0 indica que não há mais o que apagar.
+    """
+    batch = (
+        select(models.SensorData.id)
+        .where(models.SensorData.timestamp < older_than, models.SensorData.fold_status == models.FOLD_DONE)
+        .order_by(models.SensorData.timestamp)
+        .limit(batch_size)
+        .scalar_subquery()
+    )
+    result = db.execute(delete(models.SensorData).where(models.SensorData.id.in_(batch)))
+    db.commit()
+    return result.rowcount
+
+def delete_sensor_data_rollups(db: Session, granularity: str, older_than: datetime, batch_size: int) -> int:
+    """Apaga até `batch_size` rollups de `granularity` com intervalo anterior a `older_than`."""
+    rollup = models.SensorDataRollup
+    batch = (
+        select(rollup.id)
+        .where(rollup.granularity == granularity, rollup.bucket < older_than)
+        .limit(batch_size)
+        .scalar_subquery()
+    )
+    result = db.execute(delete(rollup).where(rollup.id.in_(batch)))
+    db.commit()
+    return result.rowcount
+
+def _fold_batch_end(db: Session, fold_status: int, batch_size: int) -> Optional[int]:
+    """Maior id entre as primeiras `batch_size` leituras com `fold_status`, ou None se não há nenhuma."""
+    batch = (
+        select(models.SensorData.id)
+        .where(models.SensorData.fold_status == fold_status)
+        .order_by(models.SensorData.id)
+        .limit(batch_size)
+        .subquery()
+    )
+    return db.execute(select(func.max(batch.c.id))).scalar()
+
+def _is_serialization_failure(error: OperationalError) -> bool:
+    return getattr(error.orig, "pgcode", None) == "40001"
+
+def _fold_batch(db: Session, batch_size: int) -> int:
+    if DATABASE_BACKEND == "postgresql":
+        # Todas as instruções do lote enxergam o mesmo snapshot.
+        db.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+    state = models.RollupState
+    # A primeira instrução é uma escrita: trava a linha de estado e, no SQLite, o arquivo, antes de qualquer leitura.
+    db.execute(update(state).where(state.name == ROLLUP_STATE_NAME).values(last_id=state.last_id))
+
+    data = models.SensorData
+    folded = 0
+    pending_end = _fold_batch_end(db, models.FOLD_PENDING, batch_size)
+    if pending_end is not None:
+        batch = [data.fold_status == models.FOLD_PENDING, data.id <= pending_end]
+        for granularity in ROLLUP_GRANULARITIES:
+            db.execute(_fold_rollups_stmt(granularity, *batch))
+        folded += db.execute(update(data).where(*batch).values(fold_status=models.FOLD_DONE)).rowcount
+        db.execute(update(state).where(state.name == ROLLUP_STATE_NAME).values(last_id=pending_end))
+
+    rewritten_end = _fold_batch_end(db, models.FOLD_REWRITTEN, batch_size)
+    if rewritten_end is not None:
+        batch = [data.fold_status == models.FOLD_REWRITTEN, data.id <= rewritten_end]
+        readings = db.query(data.server_ulid, data.timestamp).filter(*batch).all()
+        horizon = raw_retention_horizon(db)
+        rollup = models.SensorDataRollup
+        for granularity, width in ROLLUP_GRANULARITIES.items():
+            for server_ulid, bucket in {(server_ulid, bin_timestamp(timestamp, width)) for server_ulid, timestamp in readings}:
+                # Antes do horizonte de retenção parte das leituras brutas pode já ter saído; o intervalo fica como está.
+                if horizon and bucket < horizon:
+                    continue
+                key = [rollup.granularity == granularity, rollup.server_ulid == server_ulid, rollup.bucket == bucket]
+                db.execute(delete(rollup).where(*key))
+                db.execute(_fold_rollups_stmt(
+                    granularity,
+                    data.server_ulid == server_ulid,
+                    data.timestamp >= bucket,
+                    data.timestamp < bucket + width,
+                    data.fold_status != models.FOLD_PENDING
+                ))
+        folded += db.execute(update(data).where(*batch).values(fold_status=models.FOLD_DONE)).rowcount
+
+    db.commit()
+    return folded
+
+def refresh_sensor_data_rollups(db: Session, batch_size: int = 50000) -> int:
+    """Incorpora aos rollups as leituras pendentes, em lotes de até `batch_size`.
+
+    Cada lote é uma transação que trava a linha de rollup_state e lê um único
+    snapshot (REPEATABLE READ no Postgres; no SQLite a trava de escrita já
+    serializa tudo). As leituras pendentes desse snapshot entram nas somas e
+    são marcadas como incorporadas no mesmo commit, então uma transação de
+    ingestão que termina depois, com qualquer id, fica para o próximo lote.
+    Leituras reescritas depois de incorporadas têm seus intervalos de minute,
+    hour e day recalculados a partir de sensor_data. Retorna a quantidade de
+    leituras incorporadas.
+    """
+    _ensure_rollup_state(db)
+
+    folded = 0
+    while True:
+        try:
+            batch_folded = _fold_batch(db, batch_size)
+        except OperationalError as e:
+            db.rollback()
+            # Outro refresher ou uma reescrita alterou as mesmas linhas depois do snapshot; o lote fica para o próximo ciclo.
+            if _is_serialization_failure(e):
+                return folded
+            raise
+        folded += batch_folded
+        if batch_folded < batch_size:
+            return folded
+
+def create_user(db: Session, user: schemas.UserCreate, hashed_password: Optional[str] = None):
+    if hashed_password is None:
+        hashed_password = auth.get_password_hash(user.password)
     db_user = models.User(username=user.username, hashed_password=hashed_password)
     db.add(db_user)
     db.commit()
     db.refresh(db_user)
     return db_user
 
+def set_user_active(db: Session, username: str, is_active: bool):
+    db_user = db.query(models.User).filter(models.User.username == username).first()
+    if db_user is None:
+        return None
+    db_user.is_active = is_active
+    db.commit()
+    auth.invalidate_user(username)
+    return db_user
+
 def create_server(db: Session, server_name: str):
     server_ulid = str(new())
     created_at = datetime.utcnow()
@@ -115,51 +681,20 @@ def create_server(db: Session, server_name: str):
     db.refresh(db_server)
     return db_server
 
-def get_server_health(db: Session, server_ulid: str):
-    last_data = (
-        db.query(models.SensorData)
-        .filter(models.SensorData.server_ulid == server_ulid)
-        .order_by(models.SensorData.timestamp.desc())
-        .first()
+def get_servers_last_seen(db: Session):
+    # Servidores cujas leituras brutas já saíram pela retenção aparecem pelo último rollup diário.
+    last_seen = dict(
+        db.query(models.SensorDataRollup.server_ulid, func.max(models.SensorDataRollup.bucket))
+        .filter(models.SensorDataRollup.granularity == "day")
+        .group_by(models.SensorDataRollup.server_ulid)
+        .all()
     )
-
-    if not last_data:
-        return None
-
-    time_diff = datetime.utcnow() - last_data.timestamp
-    status = "online" if time_diff.total_seconds() <= 10 else "offline"
-
-    server = db.query(models.Server).filter(models.Server.server_ulid == server_ulid).first()
-
-    return {
-        "server_ulid": last_data.server_ulid,
-        "status": status,
-        "server_name": server.server_name
-    }
-
-def get_all_servers_health(db: Session):
-    servers = (
-        db.query(models.SensorData.server_ulid, models.SensorData.server_name)
-        .distinct()
+    last_seen.update(
+        db.query(models.SensorData.server_ulid, func.max(models.SensorData.timestamp))
+        .group_by(models.SensorData.server_ulid)
         .all()
     )
+    return last_seen
 
-    results = []
-    for server_ulid, server_name in servers:
-        last_data = (
-            db.query(models.SensorData)
-            .filter(models.SensorData.server_ulid == server_ulid)
-            .order_by(models.SensorData.timestamp.desc())
-            .first()
-        )
-
-        if last_data:
-            time_diff = datetime.utcnow() - last_data.timestamp
-            status = "online" if time_diff.total_seconds() <= 10 else "offline"
-            results.append({
-                "server_ulid": server_ulid,
-                "status": status,
-                "server_name": server_name or "Unknown"
-            })
-
-    return results
\ No newline at end of file
+def get_server_names(db: Session):
+    return dict(db.query(models.Server.server_ulid, models.Server.server_name).all())
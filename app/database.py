@@ -1,10 +1,307 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+import itertools
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import create_engine, event, exc, make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
+from sqlalchemy.orm import Session, sessionmaker, declarative_base
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from . import metrics, sqlite_backend
 
-DATABASE_URL = "postgresql://postgre:123@db:5432/dtLabs_database"
+logger = logging.getLogger(__name__)
 
-engine = create_engine(DATABASE_URL)
+DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://postgre:123@db:5432/dtLabs_database")
+# "postgresql" ou "sqlite" (backend embarcado, ver app/sqlite_backend.py), conforme DATABASE_URL.
+DATABASE_BACKEND = make_url(DATABASE_URL).get_backend_name()
+
+# "1" faz as rotas de dados usarem AsyncSession (asyncpg) em vez de sessões síncronas no threadpool.
+# Com SQLite não há ganho em usar a API assíncrona, então a opção é ignorada; não combina com SENSOR_DATA_STORAGE=partitioned.
+DATABASE_ASYNC = os.getenv("DATABASE_ASYNC", "0") == "1" and DATABASE_BACKEND == "postgresql"
+ASYNC_DATABASE_URL = os.getenv(
+    "ASYNC_DATABASE_URL",
+    DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1)
+)
+
+DATABASE_POOL_SIZE = int(os.getenv("DATABASE_POOL_SIZE", "5"))
+DATABASE_MAX_OVERFLOW = int(os.getenv("DATABASE_MAX_OVERFLOW", "10"))
+DATABASE_POOL_TIMEOUT_SECONDS = float(os.getenv("DATABASE_POOL_TIMEOUT_SECONDS", "30"))
+DATABASE_POOL_RECYCLE_SECONDS = int(os.getenv("DATABASE_POOL_RECYCLE_SECONDS", "-1"))
+DATABASE_POOL_PRE_PING = os.getenv("DATABASE_POOL_PRE_PING", "0") == "1"
+
+# Réplicas de leitura separadas por vírgula; sem nenhuma, as leituras usam o primário.
+DATABASE_READ_URLS = [url.strip() for url in os.getenv("DATABASE_READ_URLS", "").split(",") if url.strip()]
+# Por quanto tempo quem gravou continua lendo do primário, para enxergar a própria escrita (0 desliga).
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "5"))
+# Réplica que falhou fica fora da rotação por este tempo antes de ser tentada de novo.
+DATABASE_REPLICA_RETRY_SECONDS = float(os.getenv("DATABASE_REPLICA_RETRY_SECONDS", "30"))
+RECENT_WRITES_MAX_CLIENTS = 100000
+
+class PoolWaitStats:
+    """Tempo que as requisições esperam para obter uma conexão do pool."""
+
+    def __init__(self, pool_name: str):
+        self._lock = threading.Lock()
+        self._histogram = metrics.POOL_WAIT.labels(pool_name)
+        self.checkouts = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def record(self, seconds: float):
+        self._histogram.observe(seconds)
+        with self._lock:
+            self.checkouts += 1
+            self.total_wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "avg_wait_ms": (self.total_wait_seconds / self.checkouts * 1000) if self.checkouts else 0.0,
+                "max_wait_ms": self.max_wait_seconds * 1000,
+            }
+
+class TimedQueuePool(QueuePool):
+    pool_name = "sync"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_stats = PoolWaitStats(self.pool_name)
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            self.wait_stats.record(time.perf_counter() - started)
+
+class TimedAsyncAdaptedQueuePool(AsyncAdaptedQueuePool):
+    pool_name = "async"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_stats = PoolWaitStats(self.pool_name)
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            self.wait_stats.record(time.perf_counter() - started)
+
+def _pool_options(**overrides):
+    return {
+        "pool_size": DATABASE_POOL_SIZE,
+        "max_overflow": DATABASE_MAX_OVERFLOW,
+        "pool_timeout": DATABASE_POOL_TIMEOUT_SECONDS,
+        "pool_recycle": DATABASE_POOL_RECYCLE_SECONDS,
+        "pool_pre_ping": DATABASE_POOL_PRE_PING,
+        **overrides,
+    }
+
+def _create_engine(url: str, poolclass, **overrides):
+    if make_url(url).get_backend_name() != "sqlite":
+        return create_engine(url, poolclass=poolclass, **_pool_options(**overrides))
+    # As conexões do pool passam pelas threads do threadpool e dos workers de fundo.
+    sqlite_engine = create_engine(
+        url, poolclass=poolclass, connect_args={"check_same_thread": False}, **_pool_options(**overrides)
+    )
+    event.listen(sqlite_engine, "connect", sqlite_backend.configure_connection)
+    return sqlite_engine
+
+def _named_pool(poolclass, name: str):
+    return type(f"{poolclass.__name__}_{name}", (poolclass,), {"pool_name": name})
+
+def _async_url(url: str) -> str:
+    return url.replace("postgresql://", "postgresql+asyncpg://", 1)
+
+class RecentWrites:
+    """Momento da última escrita de cada cliente, para ler do primário logo depois dela."""
+
+    def __init__(self, window: float, max_clients: int):
+        self.window = window
+        self.max_clients = max_clients
+        self._lock = threading.Lock()
+        self._written_at: Dict[str, float] = {}
+
+    def note(self, client: Optional[str]):
+        if self.window <= 0 or client is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._written_at[client] = now
+            if len(self._written_at) > self.max_clients:
+                self._written_at = {
+                    key: written_at for key, written_at in self._written_at.items() if now - written_at < self.window
+                }
+
+    def pinned(self, client: Optional[str]) -> bool:
+        if self.window <= 0 or client is None:
+            return False
+        with self._lock:
+            written_at = self._written_at.get(client)
+        return written_at is not None and time.monotonic() - written_at < self.window
+
+class ReadRouter:
+    """Escolhe o engine de cada sessão de leitura: réplicas em rodízio e o primário por último.
+
+    Os pools das réplicas testam cada conexão no checkout (pool_pre_ping).
+    Uma réplica que falha ao conectar ou perde a conexão sai da rotação por
+    `retry_after` segundos, e a consulta que falhou é repetida uma vez no
+    primário (ver ReadSession). Réplicas podem estar atrasadas em relação ao
+    primário; quem precisa ver a própria escrita é fixado no primário por
+    RecentWrites.
+    """
+
+    def __init__(self, primary, replicas: List, retry_after: float):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self._rotation = itertools.count()
+        self._down_until: Dict[int, float] = {}
+        self.counts = {"primary": 0, "replica": 0, "pinned": 0, "replica_errors": 0, "replica_retries": 0}
+        for index, replica in enumerate(self.replicas):
+            sync_engine = getattr(replica, "sync_engine", replica)
+            event.listen(sync_engine, "handle_error", self._disconnect_listener(index))
+
+    def _disconnect_listener(self, index: int):
+        def listener(context):
+            # Sem context.connection o erro veio ao abrir a conexão (inclusive no pre_ping que reconecta).
+            if context.is_disconnect or context.connection is None:
+                self.mark_down(self.replicas[index])
+        return listener
+
+    @property
+    def primary_engine(self):
+        return getattr(self.primary, "sync_engine", self.primary)
+
+    def is_down(self, sync_engine) -> bool:
+        for index, replica in enumerate(self.replicas):
+            if getattr(replica, "sync_engine", replica) is sync_engine:
+                with self._lock:
+                    return self._down_until.get(index, 0) > time.monotonic()
+        return False
+
+    def _healthy_replicas(self) -> List:
+        if not self.replicas:
+            return []
+        now = time.monotonic()
+        start = next(self._rotation)
+        indexes = [(start + offset) % len(self.replicas) for offset in range(len(self.replicas))]
+        with self._lock:
+            return [self.replicas[index] for index in indexes if self._down_until.get(index, 0) <= now]
+
+    def mark_down(self, replica):
+        index = self.replicas.index(replica)
+        now = time.monotonic()
+        with self._lock:
+            if self._down_until.get(index, 0) > now:
+                return
+            self._down_until[index] = now + self.retry_after
+            self.counts["replica_errors"] += 1
+        logger.warning("Réplica de leitura %d indisponível; fora da rotação por %.0fs", index, self.retry_after)
+
+    def choose(self, pinned: bool):
+        """Engine síncrono para uma sessão: a próxima réplica fora de `_down_until` ou o primário."""
+        if pinned and self.replicas:
+            with self._lock:
+                self.counts["pinned"] += 1
+            return self.primary_engine
+        for replica in self._healthy_replicas():
+            with self._lock:
+                self.counts["replica"] += 1
+            return getattr(replica, "sync_engine", replica)
+        with self._lock:
+            self.counts["primary"] += 1
+        return self.primary_engine
+
+    def fall_back(self):
+        """Engine para repetir no primário uma consulta cuja réplica caiu."""
+        with self._lock:
+            self.counts["replica_retries"] += 1
+        return self.primary_engine
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "replicas": len(self.replicas),
+                "replicas_down": sorted(index for index, until in self._down_until.items() if until > now),
+                **self.counts,
+            }
+
+class ReadSession(Session):
+    """Session que pede o engine ao ReadRouter só quando a primeira consulta precisa de conexão.
+
+    Se a réplica escolhida cai durante uma consulta (conexão invalidada ou
+    recusada), a sessão passa para o primário e repete a consulta uma vez.
+    Consultas já em andamento com yield_per não são repetidas.
+    """
+
+    def __init__(self, router: ReadRouter, pinned: bool = False, **kwargs):
+        kwargs.setdefault("autoflush", False)
+        super().__init__(**kwargs)
+        self._router = router
+        self._pinned = pinned
+        self._chosen = None
+
+    def get_bind(self, *args, **kwargs):
+        if self._chosen is None:
+            self._chosen = self._router.choose(self._pinned)
+        return self._chosen
+
+    def reads_primary(self) -> bool:
+        return self.get_bind() is self._router.primary_engine
+
+    def execute(self, *args, **kwargs):
+        try:
+            return super().execute(*args, **kwargs)
+        except exc.DBAPIError as e:
+            chosen = self._chosen
+            if chosen is None or chosen is self._router.primary_engine:
+                raise
+            if not (e.connection_invalidated or self._router.is_down(chosen)):
+                raise
+            logger.warning("Consulta repetida no primário após falha da réplica: %s", e.orig)
+            self.rollback()
+            self._chosen = self._router.fall_back()
+        return super().execute(*args, **kwargs)
+
+def create_replica_engine(url: str, index: int):
+    # Sem pre_ping uma conexão parada no pool parece saudável até a consulta falhar.
+    return _create_engine(url, _named_pool(TimedQueuePool, f"read{index}"), pool_pre_ping=True)
+
+engine = _create_engine(DATABASE_URL, TimedQueuePool)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+recent_writes = RecentWrites(READ_YOUR_WRITES_SECONDS, RECENT_WRITES_MAX_CLIENTS)
+read_router = ReadRouter(
+    engine,
+    [create_replica_engine(url, index) for index, url in enumerate(DATABASE_READ_URLS)],
+    DATABASE_REPLICA_RETRY_SECONDS
+)
+
+async_engine = None
+AsyncSessionLocal = None
+async_read_router = None
+if DATABASE_ASYNC:
+    async_engine = create_async_engine(ASYNC_DATABASE_URL, poolclass=TimedAsyncAdaptedQueuePool, **_pool_options())
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+    async_read_router = ReadRouter(
+        async_engine,
+        [
+            create_async_engine(
+                _async_url(url),
+                poolclass=_named_pool(TimedAsyncAdaptedQueuePool, f"async_read{index}"),
+                **_pool_options(pool_pre_ping=True)
+            )
+            for index, url in enumerate(DATABASE_READ_URLS)
+        ],
+        DATABASE_REPLICA_RETRY_SECONDS
+    )
 
 Base = declarative_base()
 
@@ -13,4 +310,66 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+# Dependência das rotas de dados: AsyncSession com DATABASE_ASYNC=1, Session caso contrário.
+get_data_db = get_async_db if DATABASE_ASYNC else get_db
+
+def open_read_session(client: Optional[str] = None) -> Session:
+    """Sessão de leitura; réplica ou primário são escolhidos na primeira consulta.
+
+    `client` identifica quem está lendo (o usuário do token); quem gravou há
+    menos de READ_YOUR_WRITES_SECONDS lê do primário.
+    """
+    return ReadSession(router=read_router, pinned=recent_writes.pinned(client))
+
+def open_async_read_session(client: Optional[str] = None) -> AsyncSession:
+    return AsyncSession(
+        sync_session_class=ReadSession,
+        router=async_read_router,
+        pinned=recent_writes.pinned(client),
+        expire_on_commit=False
+    )
+
+def reads_primary(db: Session) -> bool:
+    """Se as consultas de `db` vão ao primário; falso para uma sessão de leitura roteada a uma réplica."""
+    return not isinstance(db, ReadSession) or db.reads_primary()
+
+async def run_db(db, func, *args, **kwargs):
+    """Executa uma função de crud sem bloquear o event loop.
+
+    Com AsyncSession a função roda sobre a conexão assíncrona via run_sync;
+    com Session ela roda no threadpool, como as rotas síncronas.
+    """
+    if isinstance(db, AsyncSession):
+        return await db.run_sync(func, *args, **kwargs)
+    return await run_in_threadpool(func, db, *args, **kwargs)
+
+async def dispose_async_engines():
+    """Fecha as conexões assíncronas do primário e das réplicas (ligadas ao event loop atual)."""
+    if async_engine is None:
+        return
+    await async_engine.dispose()
+    for replica in async_read_router.replicas:
+        await replica.dispose()
+
+def pool_stats():
+    stats = {"sync": {"status": engine.pool.status(), **engine.pool.wait_stats.stats()}}
+    if async_engine is not None:
+        pool = async_engine.sync_engine.pool
+        stats["async"] = {"status": pool.status(), **pool.wait_stats.stats()}
+    for router in (read_router, async_read_router):
+        for replica in router.replicas if router is not None else ():
+            pool = getattr(replica, "sync_engine", replica).pool
+            stats[pool.pool_name] = {"status": pool.status(), **pool.wait_stats.stats()}
+    return stats
+
+def read_routing_stats():
+    stats = read_router.stats()
+    if async_read_router is not None:
+        stats["async"] = async_read_router.stats()
+    return stats
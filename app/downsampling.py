@@ -0,0 +1,150 @@
+from datetime import datetime
+from typing import Dict, List, Optional
+import numpy as np
+from sqlalchemy.orm import Session
+from app import crud
+
+DOWNSAMPLE_CHUNK_ROWS = 10000
+
+class LTTBDownsampler:
+    """Largest-Triangle-Three-Buckets sobre uma série recebida em blocos.
+
+    `total` é a quantidade de pontos que a série vai receber. O primeiro e o
+    último ponto são sempre mantidos; os demais são divididos em
+    `threshold - 2` intervalos e de cada um fica o ponto que forma o maior
+    triângulo com o ponto escolhido antes e a média do intervalo seguinte.
+    Só os pontos de dois intervalos ficam em memória por vez.
+    """
+
+    def __init__(self, total: int, threshold: int):
+        self.total = total
+        self.threshold = threshold
+        self.passthrough = total <= threshold or threshold < 3
+        self._timestamps = np.empty(0, dtype="datetime64[us]")
+        self._values = np.empty(0, dtype=np.float64)
+        self._base = 0
+        self._received = 0
+        self._bucket = 0
+        self._origin = None
+        self._previous = None
+        self._last_index = -1
+        self._out_timestamps: List[datetime] = []
+        self._out_values: List[float] = []
+
+    def _bucket_range(self, bucket: int):
+        middle = self.total - 2
+        buckets = self.threshold - 2
+        return 1 + bucket * middle // buckets, 1 + (bucket + 1) * middle // buckets
+
+    def _seconds(self, timestamps: np.ndarray) -> np.ndarray:
+        return (timestamps - self._origin) / np.timedelta64(1, "s")
+
+    def _emit(self, index: int):
+        timestamp = self._timestamps[index - self._base]
+        value = self._values[index - self._base]
+        self._out_timestamps.append(timestamp.item())
+        self._out_values.append(float(value))
+        self._previous = (float(self._seconds(timestamp)), float(value))
+        self._last_index = index
+
+    def add(self, timestamps: np.ndarray, values: np.ndarray):
+        room = self.total - self._received
+        timestamps, values = timestamps[:room], values[:room]
+        if not len(values):
+            return
+        self._received += len(values)
+
+        if self.passthrough:
+            self._out_timestamps.extend(timestamps.tolist())
+            self._out_values.extend(values.tolist())
+            return
+
+        self._timestamps = np.concatenate([self._timestamps, timestamps])
+        self._values = np.concatenate([self._values, values])
+        if self._origin is None:
+            self._origin = self._timestamps[0]
+            self._emit(0)
+        self._select(final=False)
+
+    def _select(self, final: bool):
+        buffered_end = self._base + len(self._values)
+        while self._bucket < self.threshold - 2:
+            start, end = self._bucket_range(self._bucket)
+            if self._bucket == self.threshold - 3:
+                next_start, next_end = self.total - 1, self.total
+            else:
+                next_start, next_end = self._bucket_range(self._bucket + 1)
+
+            if buffered_end < next_end and not final:
+                return
+            next_start, next_end = min(next_start, buffered_end), min(next_end, buffered_end)
+            end = min(end, buffered_end)
+            if start >= end:
+                break
+
+            if next_end > next_start:
+                window = slice(next_start - self._base, next_end - self._base)
+                next_x = float(self._seconds(self._timestamps[window]).mean())
+                next_y = float(self._values[window].mean())
+            else:
+                next_x = float(self._seconds(self._timestamps[-1]))
+                next_y = float(self._values[-1])
+
+            segment = slice(start - self._base, end - self._base)
+            x = self._seconds(self._timestamps[segment])
+            y = self._values[segment]
+            previous_x, previous_y = self._previous
+            areas = np.abs((previous_x - next_x) * (y - previous_y) - (previous_x - x) * (next_y - previous_y))
+            self._emit(start + int(np.argmax(areas)))
+
+            self._timestamps = self._timestamps[end - self._base:]
+            self._values = self._values[end - self._base:]
+            self._base = end
+            self._bucket += 1
+
+    def result(self):
+        if not self.passthrough and self._origin is not None:
+            self._select(final=True)
+            last = self._base + len(self._values) - 1
+            if len(self._values) and last > self._last_index:
+                self._emit(last)
+        return {"timestamp": self._out_timestamps, "value": self._out_values}
+
+def downsample_sensor_data(
+    db: Session,
+    max_points: int,
+    server_ulid: str,
+    start_time: Optional[datetime] = None,
+    end_time: Optional[datetime] = None,
+    sensor_type: Optional[str] = None
+) -> Dict[str, dict]:
+    """Reduz cada série de sensor de `server_ulid` a no máximo `max_points` pontos com LTTB.
+
+    Faz uma contagem por série e depois percorre as leituras em ordem de
+    timestamp com um cursor no servidor, alimentando um LTTBDownsampler por
+    série; a memória usada não depende do tamanho do intervalo.
+    """
+    fields = [sensor_type] if sensor_type in crud.SENSOR_FIELDS else crud.SENSOR_FIELDS
+    filters = dict(server_ulid=server_ulid, start_time=start_time, end_time=end_time, sensor_type=sensor_type)
+    counts = crud.count_sensor_series(db, **filters)
+    samplers = {field: LTTBDownsampler(counts[field], max_points) for field in fields}
+
+    rows = crud.iter_sensor_data(db, chunk_size=DOWNSAMPLE_CHUNK_ROWS, ordered=True, **filters)
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= DOWNSAMPLE_CHUNK_ROWS:
+            _feed(samplers, chunk)
+            chunk = []
+    if chunk:
+        _feed(samplers, chunk)
+
+    return {field: sampler.result() for field, sampler in samplers.items()}
+
+def _feed(samplers: Dict[str, LTTBDownsampler], chunk):
+    timestamps = np.array([row[0] for row in chunk], dtype="datetime64[us]")
+    for field, sampler in samplers.items():
+        column = crud.SENSOR_DATA_COLUMNS.index(field)
+        values = np.array([row[column] for row in chunk], dtype=np.float64)
+        present = ~np.isnan(values)
+        sampler.add(timestamps[present], values[present])
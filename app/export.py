@@ -0,0 +1,89 @@
+import io
+from typing import Iterable, Optional, Sequence
+from app import crud
+from .database import open_read_session
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+EXPORT_FORMATS = {
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+EXPORT_COLUMNS = ["server_ulid"] + crud.SENSOR_DATA_COLUMNS
+EXPORT_BATCH_ROWS = 65536
+
+def _schema():
+    return pa.schema(
+        [("server_ulid", pa.string()), ("timestamp", pa.timestamp("us"))]
+        + [(field, pa.float64()) for field in crud.SENSOR_FIELDS]
+    )
+
+class _ChunkSink(io.RawIOBase):
+    """Destino de escrita que acumula bytes até serem enviados ao cliente."""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+def _to_batch(chunk, schema):
+    return pa.RecordBatch.from_arrays(
+        [pa.array(column, type=field.type) for column, field in zip(zip(*chunk), schema)],
+        schema=schema
+    )
+
+def _record_batches(rows: Iterable[Sequence], schema):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= EXPORT_BATCH_ROWS:
+            yield _to_batch(chunk, schema)
+            chunk = []
+    if chunk:
+        yield _to_batch(chunk, schema)
+
+def _encode(export_format: str, rows: Iterable[Sequence]):
+    schema = _schema()
+    sink = _ChunkSink()
+    if export_format == "parquet":
+        writer = pq.ParquetWriter(sink, schema)
+    else:
+        writer = pa.ipc.new_stream(sink, schema)
+
+    for batch in _record_batches(rows, schema):
+        writer.write_batch(batch)
+        data = sink.drain()
+        if data:
+            yield data
+    writer.close()
+    yield sink.drain()
+
+def iter_export(export_format: str, client: Optional[str] = None, **filters):
+    """Gera o arquivo em blocos de EXPORT_BATCH_ROWS linhas lidas de um cursor no servidor."""
+    db = open_read_session(client)
+    try:
+        rows = crud.iter_sensor_data(db=db, chunk_size=EXPORT_BATCH_ROWS, columns=EXPORT_COLUMNS, **filters)
+        yield from _encode(export_format, rows)
+    finally:
+        db.close()
@@ -0,0 +1,60 @@
+import os
+import threading
+from datetime import datetime
+from typing import Dict, Optional
+
+HEALTH_ONLINE_THRESHOLD_SECONDS = float(os.getenv("HEALTH_ONLINE_THRESHOLD_SECONDS", "10"))
+
+class LastSeenRegistry:
+    """Último timestamp recebido de cada servidor, mantido em memória.
+
+    É preenchido na inicialização com um único MAX(timestamp) agrupado e
+    atualizado pelo caminho de ingestão, então /health e /healths/all não
+    consultam o banco. Cada processo tem o seu registro: com vários workers,
+    cada um só enxerga as leituras que ele mesmo gravou desde a inicialização.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_seen: Dict[str, datetime] = {}
+        self._names: Dict[str, str] = {}
+
+    def seed(self, last_seen: Dict[str, datetime], names: Dict[str, str]):
+        with self._lock:
+            self._last_seen = dict(last_seen)
+            self._names = dict(names)
+
+    def touch(self, server_ulid: str, timestamp: datetime):
+        with self._lock:
+            current = self._last_seen.get(server_ulid)
+            if current is None or timestamp > current:
+                self._last_seen[server_ulid] = timestamp
+
+    def set_name(self, server_ulid: str, server_name: str):
+        with self._lock:
+            self._names[server_ulid] = server_name
+
+    def _status(self, server_ulid: str, last_seen: datetime, now: datetime):
+        time_diff = now - last_seen
+        return {
+            "server_ulid": server_ulid,
+            "status": "online" if time_diff.total_seconds() <= HEALTH_ONLINE_THRESHOLD_SECONDS else "offline",
+            "server_name": self._names.get(server_ulid) or "Unknown"
+        }
+
+    def get(self, server_ulid: str) -> Optional[dict]:
+        with self._lock:
+            last_seen = self._last_seen.get(server_ulid)
+            if last_seen is None:
+                return None
+            return self._status(server_ulid, last_seen, datetime.utcnow())
+
+    def all(self):
+        now = datetime.utcnow()
+        with self._lock:
+            return [
+                self._status(server_ulid, last_seen, now)
+                for server_ulid, last_seen in self._last_seen.items()
+            ]
+
+registry = LastSeenRegistry()
@@ -0,0 +1,180 @@
+import logging
+import os
+import queue
+import threading
+import time
+from typing import List
+from app import crud, schemas, health, aggregates, live, metrics, alerts
+from .database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+# "sync" grava cada leitura na própria requisição; "buffered" enfileira e responde 202.
+INGEST_MODE = os.getenv("INGEST_MODE", "sync")
+INGEST_QUEUE_MAX_SIZE = int(os.getenv("INGEST_QUEUE_MAX_SIZE", "10000"))
+INGEST_FLUSH_MAX_ITEMS = int(os.getenv("INGEST_FLUSH_MAX_ITEMS", "500"))
+INGEST_FLUSH_INTERVAL_SECONDS = float(os.getenv("INGEST_FLUSH_INTERVAL_SECONDS", "0.05"))
+# Um lote que falha é tentado de novo até INGEST_FLUSH_MAX_ATTEMPTS vezes, com espera que dobra a partir de
+# INGEST_FLUSH_RETRY_SECONDS; só depois disso as leituras são descartadas.
+INGEST_FLUSH_MAX_ATTEMPTS = int(os.getenv("INGEST_FLUSH_MAX_ATTEMPTS", "5"))
+INGEST_FLUSH_RETRY_SECONDS = float(os.getenv("INGEST_FLUSH_RETRY_SECONDS", "0.5"))
+
+def record_accepted(readings):
+    """Atualiza o estado em memória com as leituras que foram gravadas.
+
+    Roda fora do event loop (threadpool ou thread do buffer); o broker do
+    live entrega as mensagens ao loop de cada cliente com call_soon_threadsafe.
+    """
+    readings = list(readings)
+    metrics.INGEST_READINGS.labels("accepted").inc(len(readings))
+    for reading in readings:
+        health.registry.touch(reading.server_ulid, reading.timestamp)
+    aggregates.cache.invalidate(readings)
+    live.broker.publish(readings)
+    alerts.monitor.observe(readings)
+
+class IngestBuffer:
+    """Fila limitada em memória descarregada em lotes por uma thread de fundo.
+
+    Um lote é gravado quando atinge `flush_max_items` leituras ou quando
+    `flush_interval` segundos se passam desde a primeira leitura do lote. Se
+    a gravação falha (ex: banco fora do ar), o mesmo lote é tentado de novo
+    até `max_attempts` vezes com espera crescente; enquanto isso a fila
+    continua enchendo e, cheia, POST /data responde 503.
+    """
+
+    def __init__(self, max_size: int, flush_max_items: int, flush_interval: float, max_attempts: int, retry_delay: float):
+        self.queue = queue.Queue(maxsize=max_size)
+        self.flush_max_items = flush_max_items
+        self.flush_interval = flush_interval
+        self.max_attempts = max(max_attempts, 1)
+        self.retry_delay = retry_delay
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.enqueued = 0
+        self.flushed = 0
+        self.duplicates = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.flush_errors = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="ingest-buffer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Para a thread depois de gravar tudo o que ainda está na fila."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def put(self, data: schemas.SensorDataCreate) -> bool:
+        try:
+            self.queue.put_nowait(data)
+        except queue.Full:
+            metrics.INGEST_READINGS.labels("dropped").inc()
+            with self._lock:
+                self.dropped += 1
+            return False
+        with self._lock:
+            self.enqueued += 1
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "mode": INGEST_MODE,
+                "queue_depth": self.queue.qsize(),
+                "queue_capacity": self.queue.maxsize,
+                "enqueued": self.enqueued,
+                "flushed": self.flushed,
+                "duplicates": self.duplicates,
+                "dropped": self.dropped,
+                "flushes": self.flushes,
+                "flush_errors": self.flush_errors,
+                "last_flush_ms": self.last_flush_seconds * 1000,
+                "max_flush_ms": self.max_flush_seconds * 1000,
+                "avg_flush_ms": (self.total_flush_seconds / self.flushes * 1000) if self.flushes else 0.0,
+            }
+
+    def _run(self):
+        while not self._stop.is_set() or not self.queue.empty():
+            batch = self._collect()
+            if batch:
+                self._flush(batch)
+
+    def _collect(self) -> List[schemas.SensorDataCreate]:
+        batch = []
+        try:
+            batch.append(self.queue.get(timeout=self.flush_interval))
+        except queue.Empty:
+            return batch
+
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.flush_max_items:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch: List[schemas.SensorDataCreate]):
+        db = SessionLocal()
+        try:
+            return crud.create_sensor_data_batch(db, batch)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _flush(self, batch: List[schemas.SensorDataCreate]):
+        started = time.perf_counter()
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                ids = self._write(batch)
+                break
+            except Exception:
+                with self._lock:
+                    self.flush_errors += 1
+                if attempt == self.max_attempts:
+                    logger.exception("Falha ao gravar lote de %d leituras; descartado após %d tentativas", len(batch), attempt)
+                    metrics.INGEST_READINGS.labels("dropped").inc(len(batch))
+                    with self._lock:
+                        self.dropped += len(batch)
+                    return
+                delay = self.retry_delay * 2 ** (attempt - 1)
+                logger.warning("Falha ao gravar lote de %d leituras; nova tentativa em %.1fs", len(batch), delay, exc_info=True)
+                time.sleep(delay)
+
+        written = [item for item, data_id in zip(batch, ids) if data_id is not None]
+        record_accepted(written)
+        metrics.INGEST_READINGS.labels("duplicate").inc(len(batch) - len(written))
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.flushes += 1
+            self.flushed += len(written)
+            self.duplicates += len(batch) - len(written)
+            self.last_flush_seconds = elapsed
+            self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+            self.total_flush_seconds += elapsed
+
+buffer = IngestBuffer(
+    max_size=INGEST_QUEUE_MAX_SIZE,
+    flush_max_items=INGEST_FLUSH_MAX_ITEMS,
+    flush_interval=INGEST_FLUSH_INTERVAL_SECONDS,
+    max_attempts=INGEST_FLUSH_MAX_ATTEMPTS,
+    retry_delay=INGEST_FLUSH_RETRY_SECONDS,
+)
@@ -0,0 +1,140 @@
+import asyncio
+import os
+import threading
+from collections import deque
+from typing import Dict, List, Optional, Set
+import orjson
+from app import crud
+
+# Mensagens que cada cliente pode ter pendentes; quem passar disso é desconectado.
+LIVE_BUFFER_MAX_MESSAGES = int(os.getenv("LIVE_BUFFER_MAX_MESSAGES", "1000"))
+LIVE_MAX_SUBSCRIBERS = int(os.getenv("LIVE_MAX_SUBSCRIBERS", "1000"))
+
+class Subscription:
+    """Fila limitada de mensagens de um cliente, consumida no event loop dele.
+
+    `offer` pode ser chamado de qualquer thread; quando a fila está cheia a
+    assinatura é marcada como atrasada e `get` passa a retornar None.
+    """
+
+    def __init__(self, server_ulid: Optional[str], sensor_type: Optional[str], max_messages: int):
+        self.server_ulid = server_ulid
+        self.sensor_type = sensor_type
+        self.max_messages = max_messages
+        self.overflowed = False
+        self._loop = asyncio.get_running_loop()
+        self._ready = asyncio.Event()
+        self._lock = threading.Lock()
+        self._messages = deque()
+
+    def matches(self, reading) -> bool:
+        return self.sensor_type is None or getattr(reading, self.sensor_type, None) is not None
+
+    def offer(self, message: bytes) -> bool:
+        with self._lock:
+            if self.overflowed:
+                return False
+            if len(self._messages) >= self.max_messages:
+                self.overflowed = True
+                self._messages.clear()
+            else:
+                self._messages.append(message)
+        try:
+            self._loop.call_soon_threadsafe(self._ready.set)
+        except RuntimeError:
+            # O event loop do cliente já foi encerrado; a assinatura sai em unsubscribe.
+            return False
+        return not self.overflowed
+
+    async def get(self) -> Optional[List[bytes]]:
+        """Todas as mensagens pendentes, esperando se não houver nenhuma; None se o cliente ficou para trás."""
+        while True:
+            await self._ready.wait()
+            with self._lock:
+                self._ready.clear()
+                if self.overflowed:
+                    return None
+                if self._messages:
+                    messages = list(self._messages)
+                    self._messages.clear()
+                    return messages
+
+class LiveBroker:
+    """Distribui em memória as leituras gravadas para os clientes inscritos.
+
+    Cada leitura é serializada uma vez e entregue às assinaturas do servidor
+    dela e às assinaturas sem filtro de servidor. Publicar nunca espera por
+    um cliente: quem não consome rápido o bastante é descartado. Como o
+    registro de health, o broker é por processo e só vê as leituras gravadas
+    pelo próprio worker.
+    """
+
+    def __init__(self, max_subscribers: int, max_messages: int):
+        self.max_subscribers = max_subscribers
+        self.max_messages = max_messages
+        self._lock = threading.Lock()
+        self._by_server: Dict[Optional[str], Set[Subscription]] = {}
+        self.subscribers = 0
+        self.published = 0
+        self.delivered = 0
+        self.dropped_subscribers = 0
+
+    def subscribe(self, server_ulid: Optional[str] = None, sensor_type: Optional[str] = None) -> Optional[Subscription]:
+        if sensor_type not in crud.SENSOR_FIELDS:
+            sensor_type = None
+        with self._lock:
+            if self.subscribers >= self.max_subscribers:
+                return None
+            subscription = Subscription(server_ulid or None, sensor_type, self.max_messages)
+            self._by_server.setdefault(subscription.server_ulid, set()).add(subscription)
+            self.subscribers += 1
+            return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            subscriptions = self._by_server.get(subscription.server_ulid)
+            if subscriptions is None or subscription not in subscriptions:
+                return
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._by_server[subscription.server_ulid]
+            self.subscribers -= 1
+            if subscription.overflowed:
+                self.dropped_subscribers += 1
+
+    def publish(self, readings):
+        if not self.subscribers:
+            return
+        delivered = 0
+        published = 0
+        with self._lock:
+            for reading in readings:
+                published += 1
+                targets = [
+                    subscription
+                    for key in (reading.server_ulid, None)
+                    for subscription in self._by_server.get(key, ())
+                    if subscription.matches(reading)
+                ]
+                if not targets:
+                    continue
+                message = orjson.dumps({
+                    "server_ulid": reading.server_ulid,
+                    **{column: getattr(reading, column) for column in crud.SENSOR_DATA_COLUMNS}
+                })
+                for subscription in targets:
+                    delivered += subscription.offer(message)
+            self.published += published
+            self.delivered += delivered
+
+    def stats(self):
+        with self._lock:
+            return {
+                "subscribers": self.subscribers,
+                "published": self.published,
+                "delivered": self.delivered,
+                "dropped_subscribers": self.dropped_subscribers,
+                "buffer_max_messages": self.max_messages,
+            }
+
+broker = LiveBroker(max_subscribers=LIVE_MAX_SUBSCRIBERS, max_messages=LIVE_BUFFER_MAX_MESSAGES)
@@ -1,13 +1,48 @@
-from fastapi import FastAPI, Depends, HTTPException, status, Query
+from contextlib import asynccontextmanager
+import asyncio
+from fastapi import FastAPI, Depends, HTTPException, status, Query, Header, Response, WebSocket
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import ValidationError
 from sqlalchemy.orm import Session
 from datetime import timedelta, datetime
-from typing import Optional, List
-from app import models, schemas, crud, auth
-from .database import SessionLocal, engine
+from typing import Optional, List, Dict, Any
+import orjson
+from app import models, schemas, crud, auth, ingest, streaming, rollups, health, export, downsampling, aggregates, live, metrics, retention, partitions, payloads, admission, alerts
+from .database import SessionLocal, engine, get_data_db, run_db
+from . import database
 
 models.Base.metadata.create_all(bind=engine)
 
-app = FastAPI()
+def seed_health_registry():
+    db = SessionLocal()
+    try:
+        health.registry.seed(crud.get_servers_last_seen(db), crud.get_server_names(db))
+    finally:
+        db.close()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await run_in_threadpool(partitions.manager.check_table)
+    await run_in_threadpool(seed_health_registry)
+    if ingest.INGEST_MODE == "buffered":
+        ingest.buffer.start()
+    rollups.refresher.start()
+    retention.worker.start()
+    partitions.manager.start()
+    yield
+    await run_in_threadpool(ingest.buffer.stop)
+    await run_in_threadpool(rollups.refresher.stop)
+    await run_in_threadpool(retention.worker.stop)
+    await run_in_threadpool(partitions.manager.stop)
+    await run_in_threadpool(auth.shutdown_hash_executor)
+    await database.dispose_async_engines()
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(metrics.MetricsMiddleware)
+
+BATCH_MAX_ITEMS = 10000
+PAGE_MAX_LIMIT = 10000
 
 def get_db():
     db = SessionLocal()
@@ -16,14 +51,32 @@ def get_db():
     finally:
         db.close()
 
+def get_read_db(current_user: schemas.User = Depends(auth.get_current_user)):
+    db = database.open_read_session(current_user.username)
+    try:
+        yield db
+    finally:
+        db.close()
+
+async def get_async_read_db(current_user: schemas.User = Depends(auth.get_current_user)):
+    db = database.open_async_read_session(current_user.username)
+    try:
+        yield db
+    finally:
+        await db.close()
+
+# Rotas só de leitura usam as réplicas de DATABASE_READ_URLS, quando configuradas.
+get_read_data_db = get_async_read_db if database.DATABASE_ASYNC else get_read_db
+
 @app.post("/auth/register", response_model=schemas.User)
-def register_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    db_user = crud.create_user(db=db, user=user)
+async def register_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
+    hashed_password = await auth.get_password_hash_async(user.password)
+    db_user = await run_in_threadpool(crud.create_user, db=db, user=user, hashed_password=hashed_password)
     return db_user
 
 @app.post("/auth/login", response_model=schemas.Token)
-def login_for_access_token(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    authenticated_user = auth.authenticate_user(db, user.username, user.password)
+async def login_for_access_token(user: schemas.UserCreate, db: Session = Depends(get_db)):
+    authenticated_user = await auth.authenticate_user_async(db, user.username, user.password)
     if not authenticated_user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -32,90 +85,420 @@ def login_for_access_token(user: schemas.UserCreate, db: Session = Depends(get_d
         )
     access_token_expires = timedelta(minutes=auth.ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = auth.create_access_token(
-        data={"sub": authenticated_user.username}, expires_delta=access_token_expires
+        data={"sub": authenticated_user.username, "uid": authenticated_user.id},
+        expires_delta=access_token_expires
     )
     return {"access_token": access_token, "token_type": "bearer"}
 
-@app.post("/data", response_model=schemas.SensorData)
-def create_sensor_data(
-    data: schemas.SensorDataCreate,
-    db: Session = Depends(get_db),
+# A vaga de admission.ingest_slot vem antes das outras dependências: sob saturação o 429 sai sem ler o corpo.
+@app.post(
+    "/data",
+    response_model=schemas.SensorData,
+    dependencies=[Depends(admission.ingest_slot)],
+    openapi_extra=payloads.openapi_body(schemas.SensorDataCreate.model_json_schema())
+)
+async def create_sensor_data(
+    data: schemas.SensorDataCreate = Depends(payloads.sensor_data_body),
+    db: Session = Depends(get_data_db),
     current_user: schemas.User = Depends(auth.get_current_user)
 ):
-    existing_data = crud.get_sensor_data_by_server_ulid(db, server_ulid=data.server_ulid)
-    if existing_data:
+    if data.temperature is None and data.humidity is None and data.voltage is None and data.current is None:
+        metrics.INGEST_READINGS.labels("rejected").inc()
+        raise HTTPException(status_code=400, detail="Pelo menos um valor de sensor deve ser enviado.")
+
+    admission.controller.check_rate(current_user.username, [data.server_ulid])
+    database.recent_writes.note(current_user.username)
+    if ingest.INGEST_MODE == "buffered":
+        if not ingest.buffer.put(data):
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Fila de ingestão cheia, tente novamente.",
+                headers={"Retry-After": "1"}
+            )
+        return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content={"status": "queued"})
+
+    db_data = await run_db(db, crud.create_sensor_data, data=data)
+    if db_data is None:
+        metrics.INGEST_READINGS.labels("duplicate").inc()
         raise HTTPException(
             status_code=400,
-            detail="Já existem dados para este server_ulid."
+            detail="Já existem dados para este server_ulid e timestamp."
         )
-    
-    if data.temperature is None and data.humidity is None and data.voltage is None and data.current is None:
-        raise HTTPException(status_code=400, detail="Pelo menos um valor de sensor deve ser enviado.")
-    return crud.create_sensor_data(db=db, data=data)
+    await run_in_threadpool(ingest.record_accepted, [db_data])
+    return db_data
 
-@app.get("/data", response_model=List[schemas.SensorDataResponse])
-def get_sensor_data(
+def _validate_batch(items: List[Dict[str, Any]]):
+    results = []
+    valid_items = []
+    for index, item in enumerate(items):
+        try:
+            valid_items.append(schemas.SensorDataCreate.model_validate(item))
+        except ValidationError as e:
+            detail = "; ".join(error["msg"] for error in e.errors())
+            results.append(schemas.SensorDataBatchItemResult(index=index, status="rejected", detail=detail))
+            continue
+        results.append(schemas.SensorDataBatchItemResult(index=index, status="accepted"))
+    return results, valid_items
+
+@app.post(
+    "/data/batch",
+    response_model=schemas.SensorDataBatchResponse,
+    dependencies=[Depends(admission.ingest_slot)],
+    openapi_extra=payloads.openapi_body(
+        {"type": "array", "items": schemas.SensorDataCreate.model_json_schema()},
+        description="Lista de leituras no formato de POST /data."
+    )
+)
+async def create_sensor_data_batch(
+    items: List[Dict[str, Any]] = Depends(payloads.sensor_data_batch_body),
+    db: Session = Depends(get_data_db),
+    current_user: schemas.User = Depends(auth.get_current_user)
+):
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"O lote deve ter no máximo {BATCH_MAX_ITEMS} leituras."
+        )
+
+    results, valid_items = await run_in_threadpool(_validate_batch, items)
+    admission.controller.check_rate(current_user.username, (item.server_ulid for item in valid_items))
+    database.recent_writes.note(current_user.username)
+    ids = await run_db(db, crud.create_sensor_data_batch, items=valid_items)
+    # Invalidar o cache, serializar para o live e avaliar alertas de até BATCH_MAX_ITEMS leituras não cabe no event loop.
+    await run_in_threadpool(
+        ingest.record_accepted, [item for item, data_id in zip(valid_items, ids) if data_id is not None]
+    )
+    valid_results = [result for result in results if result.status == "accepted"]
+    for result, data_id in zip(valid_results, ids):
+        if data_id is None:
+            result.status = "duplicate"
+            result.detail = "Já existem dados para este server_ulid e timestamp."
+        else:
+            result.id = data_id
+    accepted = [result for result in valid_results if result.status == "accepted"]
+    metrics.INGEST_READINGS.labels("duplicate").inc(len(valid_results) - len(accepted))
+    metrics.INGEST_READINGS.labels("rejected").inc(len(results) - len(valid_results))
+
+    return {
+        "accepted": len(accepted),
+        "rejected": len(results) - len(accepted),
+        "results": results
+    }
+
+def _stream_sensor_data(
+    stream_format: str,
+    client: Optional[str] = None,
+    aggregation: Optional[str] = None,
+    stats: Optional[List[str]] = None,
+    group_by_server: bool = False,
+    **filters
+):
+    # A sessão é aberta aqui porque o corpo é enviado depois que as dependências da rota já terminaram.
+    db = database.open_read_session(client)
+    try:
+        if aggregation:
+            rows = crud.get_aggregated_sensor_data(
+                db=db, aggregation=aggregation, stats=stats, group_by_server=group_by_server, **filters
+            )
+            columns = crud.aggregation_columns(stats, group_by_server)
+        else:
+            rows = crud.iter_sensor_data(db=db, **filters)
+            columns = crud.SENSOR_DATA_COLUMNS
+        yield from streaming.encode(stream_format, columns, rows)
+    finally:
+        db.close()
+
+def _sensor_data_responses():
+    """Formatos de resposta de GET /data para o OpenAPI; a rota serializa com orjson, sem response_model."""
+    nullable_number = {"anyOf": [{"type": "number"}, {"type": "null"}]}
+    aggregated_row = {
+        "type": "object",
+        "description": "Com stats, uma coluna <sensor>_<estatística> por sensor; com group_by=server, também server_ulid.",
+        "properties": {"timestamp": {"type": "string", "format": "date-time"}, "server_ulid": {"type": "string"}},
+        "additionalProperties": nullable_number,
+    }
+    columns = {
+        "type": "object",
+        "description": "shape=columns: as mesmas colunas das linhas, cada uma como uma lista.",
+        "additionalProperties": {"type": "array", "items": {}},
+    }
+    downsampled = {
+        "type": "object",
+        "description": "max_points: a série reduzida de cada sensor.",
+        "additionalProperties": {
+            "type": "object",
+            "properties": {
+                "timestamp": {"type": "array", "items": {"type": "string", "format": "date-time"}},
+                "value": {"type": "array", "items": {"type": "number"}},
+            },
+        },
+    }
+    rows = {"type": "array", "items": schemas.SensorDataResponse.model_json_schema()}
+    return {
+        200: {
+            "description": "Leituras ou agregações; o formato depende de aggregation, stats, group_by, shape, max_points e format.",
+            "content": {
+                "application/json": {"schema": {"oneOf": [rows, {"type": "array", "items": aggregated_row}, columns, downsampled]}},
+                **{media_type: {"schema": {"type": "string"}} for media_type in streaming.STREAM_FORMATS.values()},
+            },
+        }
+    }
+
+@app.get("/data", responses=_sensor_data_responses())
+async def get_sensor_data(
     server_ulid: Optional[str] = Query(None, description="Filtra por um servidor específico."),
     start_time: Optional[datetime] = Query(None, description="Início do intervalo de tempo."),
     end_time: Optional[datetime] = Query(None, description="Fim do intervalo de tempo."),
     sensor_type: Optional[str] = Query(None, description="Tipo de sensor (ex: temperature, humidity)."),
-    aggregation: Optional[str] = Query(None, description="Granularidade da agregação (minute, hour, day)."),
-    db: Session = Depends(get_db),
+    aggregation: Optional[str] = Query(None, description="Intervalo da agregação (minute, hour, day ou ex: 5m, 15m, 2h)."),
+    stats: Optional[str] = Query(None, description="Estatísticas da agregação separadas por vírgula (avg, min, max, count, sum, stddev, p50, p95...)."),
+    group_by: Optional[str] = Query(None, description="Agrupa a agregação também por servidor (server)."),
+    response_format: Optional[str] = Query(None, alias="format", description="Resposta em streaming (ndjson, csv)."),
+    shape: str = Query("rows", description="Formato do JSON: rows (lista de objetos) ou columns (uma lista por coluna)."),
+    limit: Optional[int] = Query(None, ge=1, le=PAGE_MAX_LIMIT, description="Quantidade máxima de leituras por página."),
+    cursor: Optional[str] = Query(None, description="Cursor retornado em X-Next-Cursor pela página anterior."),
+    max_points: Optional[int] = Query(None, ge=3, le=PAGE_MAX_LIMIT, description="Reduz cada série do servidor a no máximo este número de pontos (LTTB); exige server_ulid."),
+    accept: Optional[str] = Header(None),
+    db: Session = Depends(get_read_data_db),
     current_user: schemas.User = Depends(auth.get_current_user)
 ):
+    try:
+        stream_format = streaming.negotiate_format(response_format, accept)
+        after = crud.decode_page_cursor(cursor) if cursor else None
+        if aggregation:
+            crud.parse_interval(aggregation)
+        stat_names = crud.parse_stats(stats)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if shape not in streaming.JSON_SHAPES:
+        raise HTTPException(status_code=400, detail="Shape deve ser 'rows' ou 'columns'.")
+    if group_by not in (None, "server"):
+        raise HTTPException(status_code=400, detail="group_by deve ser 'server'.")
+    if (stat_names or group_by) and not aggregation:
+        raise HTTPException(status_code=400, detail="stats e group_by exigem aggregation.")
+    group_by_server = group_by == "server"
+
+    paginated = limit is not None or after is not None
+    if paginated and (stream_format or aggregation):
+        raise HTTPException(
+            status_code=400,
+            detail="Paginação (limit/cursor) só é suportada na consulta sem aggregation e sem streaming."
+        )
+    if max_points is not None and (paginated or stream_format or aggregation):
+        raise HTTPException(
+            status_code=400,
+            detail="max_points não pode ser combinado com aggregation, streaming ou paginação."
+        )
+    if max_points is not None and not server_ulid:
+        # Leituras de vários servidores intercaladas por timestamp não formam uma série que o LTTB consiga preservar.
+        raise HTTPException(status_code=400, detail="max_points exige server_ulid.")
+
+    if stream_format:
+        return StreamingResponse(
+            _stream_sensor_data(
+                stream_format,
+                client=current_user.username,
+                server_ulid=server_ulid,
+                start_time=start_time,
+                end_time=end_time,
+                sensor_type=sensor_type,
+                aggregation=aggregation,
+                stats=stat_names,
+                group_by_server=group_by_server
+            ),
+            media_type=streaming.STREAM_FORMATS[stream_format]
+        )
+
+    if max_points is not None:
+        series = await run_db(
+            db,
+            downsampling.downsample_sensor_data,
+            max_points=max_points,
+            server_ulid=server_ulid,
+            start_time=start_time,
+            end_time=end_time,
+            sensor_type=sensor_type
+        )
+        return Response(content=orjson.dumps(series), media_type="application/json")
+
+    # As linhas são serializadas direto com orjson; os formatos possíveis estão em _sensor_data_responses.
+    headers = {}
+    columns = crud.SENSOR_DATA_COLUMNS
     if aggregation:
-        results = crud.get_aggregated_sensor_data(
-            db=db,
+        results = await run_db(
+            db,
+            aggregates.cache.get_aggregated_sensor_data,
             server_ulid=server_ulid,
             start_time=start_time,
             end_time=end_time,
             sensor_type=sensor_type,
-            aggregation=aggregation
+            aggregation=aggregation,
+            stats=stat_names,
+            group_by_server=group_by_server
         )
-        return [
-            schemas.AggregatedSensorDataResponse(
-                timestamp=row.timestamp,
-                temperature=row.temperature,
-                humidity=row.humidity,
-                voltage=row.voltage,
-                current=row.current
-            )
-            for row in results
-        ]
+        columns = crud.aggregation_columns(stat_names, group_by_server)
     else:
-        results = crud.get_sensor_data(
-            db=db,
+        results = await run_db(
+            db,
+            crud.get_sensor_data_rows,
             server_ulid=server_ulid,
             start_time=start_time,
             end_time=end_time,
-            sensor_type=sensor_type
+            sensor_type=sensor_type,
+            limit=limit + 1 if limit is not None else None,
+            after=after
         )
-        return results
+        if paginated:
+            has_more = limit is not None and len(results) > limit
+            results = results[:limit]
+            headers["X-Has-More"] = "true" if has_more else "false"
+            if has_more:
+                headers["X-Next-Cursor"] = crud.encode_page_cursor(results[-1].timestamp, results[-1].id)
+
+    return Response(
+        content=streaming.encode_json(columns, results, shape),
+        media_type="application/json",
+        headers=headers
+    )
+
+@app.get("/data/export")
+def export_sensor_data(
+    export_format: str = Query("parquet", alias="format", description="Formato colunar (parquet, arrow)."),
+    server_ulid: Optional[str] = Query(None, description="Filtra por um servidor específico."),
+    start_time: Optional[datetime] = Query(None, description="Início do intervalo de tempo."),
+    end_time: Optional[datetime] = Query(None, description="Fim do intervalo de tempo."),
+    sensor_type: Optional[str] = Query(None, description="Tipo de sensor (ex: temperature, humidity)."),
+    current_user: schemas.User = Depends(auth.get_current_user)
+):
+    if export.pa is None:
+        raise HTTPException(status_code=501, detail="A exportação colunar requer o pacote pyarrow.")
+    if export_format not in export.EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="Formato deve ser 'parquet' ou 'arrow'.")
+
+    return StreamingResponse(
+        export.iter_export(
+            export_format,
+            client=current_user.username,
+            server_ulid=server_ulid,
+            start_time=start_time,
+            end_time=end_time,
+            sensor_type=sensor_type
+        ),
+        media_type=export.EXPORT_FORMATS[export_format],
+        headers={"Content-Disposition": f'attachment; filename="sensor_data.{export_format}"'}
+    )
+
+def _websocket_user(token: Optional[str]):
+    db = SessionLocal()
+    try:
+        return auth.get_current_user(db=db, token=token)
+    except HTTPException:
+        return None
+    finally:
+        db.close()
+
+async def _wait_disconnect(websocket: WebSocket):
+    while (await websocket.receive())["type"] != "websocket.disconnect":
+        pass
+
+@app.websocket("/data/live")
+async def live_sensor_data(
+    websocket: WebSocket,
+    server_ulid: Optional[str] = Query(None, description="Recebe só as leituras deste servidor."),
+    sensor_type: Optional[str] = Query(None, description="Recebe só as leituras com este sensor preenchido."),
+    token: Optional[str] = Query(None, description="Token de acesso, quando o cliente não consegue enviar o header Authorization.")
+):
+    """Envia cada leitura gravada que corresponde aos filtros, uma mensagem JSON por leitura.
+
+    Clientes que acumulam mais de LIVE_BUFFER_MAX_MESSAGES mensagens sem ler
+    são desconectados com o código 1013 e devem se reconectar.
+    """
+    authorization = websocket.headers.get("authorization", "")
+    if token is None and authorization.lower().startswith("bearer "):
+        token = authorization[7:]
+    if not token or await run_in_threadpool(_websocket_user, token) is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    subscription = live.broker.subscribe(server_ulid, sensor_type)
+    if subscription is None:
+        await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+        return
+
+    await websocket.accept()
+    disconnected = asyncio.create_task(_wait_disconnect(websocket))
+    try:
+        while True:
+            pending = asyncio.create_task(subscription.get())
+            done, _ = await asyncio.wait({disconnected, pending}, return_when=asyncio.FIRST_COMPLETED)
+            if disconnected in done:
+                pending.cancel()
+                return
+            messages = pending.result()
+            if messages is None:
+                await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER, reason="Cliente atrasado.")
+                return
+            for message in messages:
+                await websocket.send_text(message.decode())
+    finally:
+        disconnected.cancel()
+        live.broker.unsubscribe(subscription)
 
 @app.post("/servers", response_model=schemas.ServerResponse)
-def register_server(
+async def register_server(
     server: schemas.ServerCreate,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_data_db),
     current_user: schemas.User = Depends(auth.get_current_user)
 ):
-    db_server = crud.create_server(db, server_name=server.server_name)
+    database.recent_writes.note(current_user.username)
+    db_server = await run_db(db, crud.create_server, server_name=server.server_name)
+    health.registry.set_name(db_server.server_ulid, db_server.server_name)
     return db_server
 
 @app.get("/health/{server_ulid}", response_model=schemas.ServerHealthResponse)
 def get_server_health(
     server_ulid: str,
-    db: Session = Depends(get_db),
     current_user: schemas.User = Depends(auth.get_current_user)
 ):
-    server_health = crud.get_server_health(db, server_ulid=server_ulid)
+    server_health = health.registry.get(server_ulid)
     if not server_health:
         raise HTTPException(status_code=404, detail="Servidor não encontrado.")
     return server_health
 
 @app.get("/healths/all", response_model=schemas.AllServersHealthResponse)
 def get_all_servers_health(
-    db: Session = Depends(get_db),
     current_user: schemas.User = Depends(auth.get_current_user)
 ):
-    servers_health = crud.get_all_servers_health(db)
-    return {"servers": servers_health}
\ No newline at end of file
+    servers_health = health.registry.all()
+    return {"servers": servers_health}
+
+@app.get("/monitoring", response_model=schemas.MonitoringResponse)
+def get_monitoring(
+    server_ulid: Optional[str] = None,
+    current_user: schemas.User = Depends(auth.get_current_user)
+):
+    """Estatísticas móveis por servidor e sensor e alertas ativos, mantidos em memória pela ingestão."""
+    return alerts.monitor.snapshot(server_ulid)
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    """Métricas no formato do Prometheus, sem autenticação para que o scraper consiga ler."""
+    content, media_type = metrics.render()
+    return Response(content=content, media_type=media_type)
+
+@app.get("/stats")
+def get_stats(current_user: schemas.User = Depends(auth.get_current_user)):
+    return {
+        "ingest": ingest.buffer.stats(),
+        "ingest_admission": admission.controller.stats(),
+        "rollups": {"folded": rollups.refresher.folded},
+        "retention": retention.worker.stats(),
+        "partitions": partitions.manager.stats(),
+        "user_cache": auth.user_cache.stats(),
+        "aggregate_cache": aggregates.cache.stats(),
+        "live": live.broker.stats(),
+        "database_pool": database.pool_stats(),
+        "read_routing": database.read_routing_stats(),
+        "alerts": alerts.monitor.stats()
+    }
@@ -0,0 +1,136 @@
+import functools
+import os
+import sys
+import time
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Consultas SQL são atribuídas à função deste arquivo que as disparou.
+CRUD_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), "crud.py")
+CALLER_MAX_DEPTH = 40
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Tempo de resposta por rota, do recebimento ao último byte enviado.",
+    ["method", "route", "status"],
+)
+STAGE_LATENCY = Histogram(
+    "app_stage_duration_seconds",
+    "Tempo gasto em etapas da requisição fora do SQL (auth, serialize).",
+    ["stage"],
+    buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+SQL_LATENCY = Histogram(
+    "sql_query_duration_seconds",
+    "Tempo de execução das consultas SQL, por função de crud.",
+    ["function"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+)
+SQL_ROWS = Histogram(
+    "sql_query_rows",
+    "Linhas retornadas ou afetadas por consulta, por função de crud.",
+    ["function"],
+    buckets=(0, 1, 10, 100, 1000, 10000, 100000, 1000000),
+)
+POOL_WAIT = Histogram(
+    "db_pool_checkout_wait_seconds",
+    "Tempo de espera por uma conexão do pool.",
+    ["pool"],
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0),
+)
+INGEST_READINGS = Counter(
+    "ingest_readings_total",
+    "Leituras recebidas pela ingestão, por resultado (accepted, duplicate, rejected, dropped).",
+    ["result"],
+)
+INGEST_IN_FLIGHT = Gauge(
+    "ingest_in_flight_requests",
+    "Requisições de ingestão gravando no banco agora.",
+)
+INGEST_ADMISSION_REJECTED = Counter(
+    "ingest_admission_rejected_total",
+    "Requisições de ingestão recusadas com 429, por motivo (queue_full, queue_timeout, user_rate, server_rate).",
+    ["reason"],
+)
+ALERTS_FIRED = Counter(
+    "alerts_fired_total",
+    "Alertas disparados pelas regras avaliadas na ingestão, por regra.",
+    ["rule"],
+)
+
+def _crud_caller() -> str:
+    frame = sys._getframe(2)
+    for _ in range(CALLER_MAX_DEPTH):
+        if frame is None:
+            break
+        # Funções auxiliares (_prefixo) são atribuídas à função pública de crud que as chamou.
+        if frame.f_code.co_filename == CRUD_FILENAME and not frame.f_code.co_name.startswith("_"):
+            return frame.f_code.co_name
+        frame = frame.f_back
+    return "other"
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append((time.perf_counter(), _crud_caller()))
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started, function = conn.info["query_started"].pop()
+    SQL_LATENCY.labels(function).observe(time.perf_counter() - started)
+    # Cursores no servidor (yield_per) não sabem a quantidade de linhas e informam -1.
+    if cursor.rowcount is not None and cursor.rowcount >= 0:
+        SQL_ROWS.labels(function).observe(cursor.rowcount)
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    if context.connection is not None and context.connection.info.get("query_started"):
+        context.connection.info["query_started"].pop()
+
+def timed(stage: str):
+    """Decorador que registra a duração da função em app_stage_duration_seconds."""
+    histogram = STAGE_LATENCY.labels(stage)
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+class MetricsMiddleware:
+    """Middleware ASGI que mede cada requisição HTTP pelo template da rota (ex: /health/{server_ulid})."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            REQUEST_LATENCY.labels(
+                scope["method"],
+                route.path if route is not None else "unmatched",
+                str(status_code),
+            ).observe(time.perf_counter() - started)
+
+def render():
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -1,18 +1,61 @@
-from sqlalchemy import Column, Integer, Float, String, DateTime, Boolean
+import os
+from sqlalchemy import Column, Integer, BigInteger, SmallInteger, Float, REAL, String, DateTime, Boolean, Index, text
 from .database import Base
 from datetime import datetime
 
+# "heap" mantém sensor_data em uma tabela só; "partitioned" particiona por faixa de timestamp
+# (ver app/partitions.py), guarda os valores em real e não repete server_name em cada leitura.
+SENSOR_DATA_STORAGE = os.getenv("SENSOR_DATA_STORAGE", "heap")
+
+# sensor_data.fold_status: leitura ainda fora dos rollups, já incorporada, ou reescrita
+# (SENSOR_DATA_CONFLICT_POLICY=update) depois de incorporada com os valores antigos.
+FOLD_PENDING = 0
+FOLD_DONE = 1
+FOLD_REWRITTEN = 2
+
+def _unfolded_index():
+    # Índice parcial pequeno: quase todas as leituras já estão incorporadas.
+    where = text(f"fold_status <> {FOLD_DONE}")
+    return Index("ix_sensor_data_unfolded", "id", postgresql_where=where, sqlite_where=where)
+
 class SensorData(Base):
     __tablename__ = "sensor_data"
 
-    id = Column(Integer, primary_key=True, index=True)
-    server_ulid = Column(String, index=True) 
-    server_name = Column(String, index=True)  
-    timestamp = Column(DateTime)  
-    temperature = Column(Float, nullable=True)  
-    humidity = Column(Float, nullable=True) 
-    voltage = Column(Float, nullable=True) 
-    current = Column(Float, nullable=True)
+    if SENSOR_DATA_STORAGE == "partitioned":
+        # A chave de partição precisa fazer parte da chave primária e dos índices únicos.
+        __table_args__ = (
+            Index("ix_sensor_data_server_ulid_timestamp", "server_ulid", "timestamp", unique=True),
+            Index("ix_sensor_data_timestamp", "timestamp", postgresql_using="brin"),
+            _unfolded_index(),
+            {"postgresql_partition_by": "RANGE (timestamp)"},
+        )
+
+        id = Column(BigInteger, primary_key=True, autoincrement=True)
+        server_ulid = Column(String, nullable=False)
+        timestamp = Column(DateTime, primary_key=True)
+        temperature = Column(REAL, nullable=True)
+        humidity = Column(REAL, nullable=True)
+        voltage = Column(REAL, nullable=True)
+        current = Column(REAL, nullable=True)
+        fold_status = Column(SmallInteger, nullable=False, default=FOLD_PENDING, server_default=str(FOLD_PENDING))
+    else:
+        __table_args__ = (
+            Index("ix_sensor_data_server_ulid_timestamp", "server_ulid", "timestamp", unique=True),
+            Index("ix_sensor_data_timestamp", "timestamp"),
+            _unfolded_index(),
+            # No SQLite o id não é reaproveitado depois da retenção, como nas sequências do Postgres.
+            {"sqlite_autoincrement": True},
+        )
+
+        id = Column(Integer, primary_key=True, index=True)
+        server_ulid = Column(String) 
+        server_name = Column(String, index=True)  
+        timestamp = Column(DateTime)  
+        temperature = Column(Float, nullable=True)  
+        humidity = Column(Float, nullable=True) 
+        voltage = Column(Float, nullable=True) 
+        current = Column(Float, nullable=True)
+        fold_status = Column(SmallInteger, nullable=False, default=FOLD_PENDING, server_default=str(FOLD_PENDING))
 
 class User(Base):
     __tablename__ = "users"
@@ -29,3 +72,53 @@ class Server(Base):
     server_ulid = Column(String, unique=True, index=True)
     server_name = Column(String, index=True) 
     created_at = Column(DateTime, default=datetime.utcnow)  
+
+class SensorDataRollup(Base):
+    """Soma, contagem, mínimo e máximo por servidor e intervalo de tempo.
+
+    `sensor_mask` guarda quais sensores vieram preenchidos nas leituras
+    agregadas (bit 1 temperature, 2 humidity, 4 voltage, 8 current), para que
+    o filtro por sensor_type continue igual ao da consulta sobre sensor_data.
+    """
+    __tablename__ = "sensor_data_rollups"
+    __table_args__ = (
+        Index(
+            "ix_sensor_data_rollups_key",
+            "granularity", "server_ulid", "bucket", "sensor_mask",
+            unique=True
+        ),
+    )
+
+    id = Column(Integer, primary_key=True)
+    granularity = Column(String, nullable=False)
+    server_ulid = Column(String, nullable=False)
+    bucket = Column(DateTime, nullable=False)
+    sensor_mask = Column(Integer, nullable=False)
+    temperature_sum = Column(Float)
+    temperature_count = Column(Integer, nullable=False, default=0)
+    temperature_min = Column(Float)
+    temperature_max = Column(Float)
+    humidity_sum = Column(Float)
+    humidity_count = Column(Integer, nullable=False, default=0)
+    humidity_min = Column(Float)
+    humidity_max = Column(Float)
+    voltage_sum = Column(Float)
+    voltage_count = Column(Integer, nullable=False, default=0)
+    voltage_min = Column(Float)
+    voltage_max = Column(Float)
+    current_sum = Column(Float)
+    current_count = Column(Integer, nullable=False, default=0)
+    current_min = Column(Float)
+    current_max = Column(Float)
+
+class RollupState(Base):
+    """Linha travada por quem incorpora leituras aos rollups; last_id é o maior id do último lote.
+
+    `raw_deleted_before` é o maior corte já aplicado pela retenção de
+    sensor_data: antes dele as leituras brutas podem ter sido apagadas.
+    """
+    __tablename__ = "rollup_state"
+
+    name = Column(String, primary_key=True)
+    last_id = Column(BigInteger, nullable=False, default=0)
+    raw_deleted_before = Column(DateTime, nullable=True)
@@ -0,0 +1,218 @@
+import logging
+import os
+import re
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Optional, Tuple
+from sqlalchemy.exc import IntegrityError
+from app import models
+from .database import DATABASE_ASYNC, engine
+
+logger = logging.getLogger(__name__)
+
+# Só valem com SENSOR_DATA_STORAGE=partitioned. Cada partição cobre um dia ou um mês de timestamp.
+SENSOR_DATA_PARTITION_INTERVAL = os.getenv("SENSOR_DATA_PARTITION_INTERVAL", "day")
+SENSOR_DATA_PARTITIONS_AHEAD = int(os.getenv("SENSOR_DATA_PARTITIONS_AHEAD", "3"))
+PARTITION_MAINTENANCE_INTERVAL_SECONDS = float(os.getenv("PARTITION_MAINTENANCE_INTERVAL_SECONDS", "3600"))
+# Criar ou apagar partição trava sensor_data; se o lock não vier logo, desiste em vez de enfileirar as consultas.
+PARTITION_LOCK_TIMEOUT = os.getenv("PARTITION_LOCK_TIMEOUT", "5s")
+
+PARTITION_NAME = re.compile(r"sensor_data_p(\d{6}|\d{8})")
+
+def partition_start(timestamp: datetime, interval: str = SENSOR_DATA_PARTITION_INTERVAL) -> datetime:
+    if interval == "month":
+        return datetime(timestamp.year, timestamp.month, 1)
+    return datetime(timestamp.year, timestamp.month, timestamp.day)
+
+def partition_end(start: datetime, interval: str = SENSOR_DATA_PARTITION_INTERVAL) -> datetime:
+    if interval == "month":
+        return datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+    return start + timedelta(days=1)
+
+def partition_name(start: datetime, interval: str = SENSOR_DATA_PARTITION_INTERVAL) -> str:
+    return f"sensor_data_p{start:%Y%m}" if interval == "month" else f"sensor_data_p{start:%Y%m%d}"
+
+def parse_partition_name(name: str) -> Optional[Tuple[datetime, datetime]]:
+    """Faixa [início, fim) de uma partição pelo nome, nos formatos diário e mensal."""
+    match = PARTITION_NAME.fullmatch(name)
+    if match is None:
+        return None
+    digits = match.group(1)
+    if len(digits) == 6:
+        start = datetime.strptime(digits, "%Y%m")
+        return start, partition_end(start, "month")
+    start = datetime.strptime(digits, "%Y%m%d")
+    return start, partition_end(start, "day")
+
+def is_missing_partition(error: IntegrityError) -> bool:
+    return "no partition of relation" in str(getattr(error, "orig", error))
+
+class PartitionManager:
+    """Cria as partições de sensor_data antes que as leituras precisem delas.
+
+    A thread de manutenção mantém criadas as partições do período atual e dos
+    próximos `ahead` períodos; leituras fora dessa janela (atrasadas ou
+    importadas) criam a sua partição na hora pelo caminho de ingestão. As
+    partições conhecidas ficam em memória, então o custo por leitura é só
+    calcular o início do período.
+    """
+
+    def __init__(self, interval: str, ahead: int, maintenance_interval: float):
+        self.enabled = models.SENSOR_DATA_STORAGE == "partitioned"
+        self.interval = interval
+        self.ahead = ahead
+        self.maintenance_interval = maintenance_interval
+        self._lock = threading.Lock()
+        self._known: Optional[Dict[str, Tuple[datetime, datetime]]] = None
+        self._stop = threading.Event()
+        self._thread = None
+        self.created = 0
+        self.dropped = 0
+
+    def _connect(self):
+        conn = engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+        conn.exec_driver_sql(f"SET lock_timeout = '{PARTITION_LOCK_TIMEOUT}'")
+        return conn
+
+    def _partitions(self, conn) -> Dict[str, Tuple[datetime, datetime]]:
+        names = conn.exec_driver_sql(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE parent.relname = 'sensor_data'"
+        ).scalars()
+        partitions = {}
+        for name in names:
+            bounds = parse_partition_name(name)
+            if bounds is not None:
+                partitions[name] = bounds
+        return partitions
+
+    def check_table(self):
+        """Falha se sensor_data já existe como tabela comum (trocar de modo exige migrar os dados) ou se a configuração não suporta partições."""
+        if not self.enabled:
+            return
+        if engine.dialect.name != "postgresql":
+            raise RuntimeError("SENSOR_DATA_STORAGE=partitioned só é suportado com Postgres.")
+        if DATABASE_ASYNC:
+            # Com AsyncSession a gravação roda em run_sync no event loop, e ensure criaria partições com o engine síncrono ali.
+            raise RuntimeError("SENSOR_DATA_STORAGE=partitioned não é suportado com DATABASE_ASYNC=1.")
+        with engine.connect() as conn:
+            kind = conn.exec_driver_sql("SELECT relkind FROM pg_class WHERE relname = 'sensor_data'").scalar()
+        if kind is not None and kind != "p":
+            raise RuntimeError(
+                "SENSOR_DATA_STORAGE=partitioned, mas sensor_data já existe como tabela não particionada."
+            )
+
+    def forget(self):
+        """Descarta as partições conhecidas, para recarregar do banco (ex: outro processo apagou alguma)."""
+        with self._lock:
+            self._known = None
+
+    def ensure(self, timestamps: Iterable[datetime]):
+        if not self.enabled:
+            return
+        starts = {partition_start(timestamp, self.interval) for timestamp in timestamps}
+        with self._lock:
+            if self._known is not None and all(partition_name(start, self.interval) in self._known for start in starts):
+                return
+            with self._connect() as conn:
+                if self._known is None:
+                    self._known = self._partitions(conn)
+                for start in sorted(starts):
+                    name = partition_name(start, self.interval)
+                    if name in self._known:
+                        continue
+                    end = partition_end(start, self.interval)
+                    try:
+                        conn.exec_driver_sql(
+                            f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF sensor_data "
+                            f"FOR VALUES FROM ('{start.isoformat(sep=' ')}') TO ('{end.isoformat(sep=' ')}')"
+                        )
+                    except Exception:
+                        # Outro processo pode ter criado a mesma partição ao mesmo tempo.
+                        if name not in self._partitions(conn):
+                            raise
+                    else:
+                        self.created += 1
+                        logger.info("Partição %s criada", name)
+                    self._known[name] = (start, end)
+
+    def drop_expired(self, older_than: datetime) -> Tuple[int, int]:
+        """Apaga as partições que terminam antes de `older_than` e já foram incorporadas aos rollups.
+
+        Retorna quantas partições e quantas leituras saíram.
+        """
+        if not self.enabled:
+            return 0, 0
+        dropped = 0
+        rows = 0
+        with self._lock, self._connect() as conn:
+            partitions = self._partitions(conn)
+            for name, (start, end) in sorted(partitions.items(), key=lambda item: item[1]):
+                if end > older_than:
+                    continue
+                count, unfolded = conn.exec_driver_sql(
+                    f"SELECT count(*), count(*) FILTER (WHERE fold_status <> {models.FOLD_DONE}) FROM {name}"
+                ).one()
+                if unfolded:
+                    # Ainda há leituras que o RollupRefresher não incorporou; fica para a próxima execução.
+                    continue
+                with engine.begin() as locked:
+                    # Uma leitura atrasada ou reescrita pode ter chegado depois da contagem. Com sensor_data
+                    # travada (só a tabela pai, por onde passa toda escrita) a verificação e o DROP não têm
+                    # nada entre eles; a contagem sem trava acima evita segurar a trava durante o count(*).
+                    locked.exec_driver_sql(f"SET LOCAL lock_timeout = '{PARTITION_LOCK_TIMEOUT}'")
+                    locked.exec_driver_sql("LOCK TABLE ONLY sensor_data IN ACCESS EXCLUSIVE MODE")
+                    if locked.exec_driver_sql(f"SELECT 1 FROM {name} WHERE fold_status <> {models.FOLD_DONE} LIMIT 1").first():
+                        continue
+                    locked.exec_driver_sql(f"DROP TABLE {name}")
+                partitions.pop(name)
+                dropped += 1
+                rows += count
+                logger.info("Partição %s apagada (%d leituras)", name, count)
+            self._known = partitions
+            self.dropped += dropped
+        return dropped, rows
+
+    def start(self):
+        if not self.enabled or self.maintenance_interval <= 0 or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="partition-manager", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                start = partition_start(datetime.utcnow(), self.interval)
+                starts = [start]
+                for _ in range(self.ahead):
+                    starts.append(partition_end(starts[-1], self.interval))
+                self.ensure(starts)
+            except Exception:
+                logger.exception("Falha ao criar as partições de sensor_data")
+            self._stop.wait(self.maintenance_interval)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "interval": self.interval,
+                "partitions": len(self._known) if self._known is not None else None,
+                "created": self.created,
+                "dropped": self.dropped,
+            }
+
+manager = PartitionManager(
+    interval=SENSOR_DATA_PARTITION_INTERVAL,
+    ahead=SENSOR_DATA_PARTITIONS_AHEAD,
+    maintenance_interval=PARTITION_MAINTENANCE_INTERVAL_SECONDS,
+)
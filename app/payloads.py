@@ -0,0 +1,167 @@
+"""Corpo das rotas de ingestão: JSON ou MessagePack, opcionalmente comprimido com gzip ou zstd.
+
+O formato vem de Content-Type (application/json, o padrão, ou
+application/msgpack) e a compressão de Content-Encoding. O resultado é o
+mesmo objeto Python que o JSON produziria, validado depois pelos mesmos
+schemas.
+"""
+import gzip
+import io
+import os
+import zlib
+from typing import Any, Dict, List
+import orjson
+from fastapi import HTTPException, Request, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
+from app import schemas
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Limite do corpo já descomprimido; protege contra bombas de compressão.
+INGEST_MAX_BODY_BYTES = int(os.getenv("INGEST_MAX_BODY_BYTES", str(64 * 1024 * 1024)))
+# Limite do corpo como chega pela rede, verificado em Content-Length e durante a leitura.
+INGEST_MAX_REQUEST_BYTES = int(os.getenv("INGEST_MAX_REQUEST_BYTES", str(INGEST_MAX_BODY_BYTES)))
+DECOMPRESS_CHUNK_BYTES = 64 * 1024
+
+MSGPACK_CONTENT_TYPES = {"application/msgpack", "application/x-msgpack", "application/vnd.msgpack"}
+CONTENT_ENCODINGS = {"identity", "gzip", "x-gzip", "zstd"}
+DECOMPRESS_ERRORS = (OSError, EOFError, zlib.error) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+def _too_large(max_bytes: int, decompressed: bool = True):
+    return HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=f"O corpo da requisição deve ter no máximo {max_bytes} bytes{' descomprimido' if decompressed else ''}."
+    )
+
+def _read_limited(reader, max_bytes: int) -> bytes:
+    chunks = []
+    size = 0
+    while True:
+        chunk = reader.read(DECOMPRESS_CHUNK_BYTES)
+        if not chunk:
+            return b"".join(chunks)
+        size += len(chunk)
+        if size > max_bytes:
+            raise _too_large(max_bytes)
+        chunks.append(chunk)
+
+def decompress(body: bytes, content_encoding: str, max_bytes: int = INGEST_MAX_BODY_BYTES) -> bytes:
+    """Desfaz as codificações de Content-Encoding, da última aplicada para a primeira."""
+    encodings = [encoding.strip().lower() for encoding in content_encoding.split(",") if encoding.strip()]
+    unsupported = [encoding for encoding in encodings if encoding not in CONTENT_ENCODINGS]
+    if unsupported:
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail="Content-Encoding deve ser 'gzip' ou 'zstd'.",
+            headers={"Accept-Encoding": "gzip, zstd" if zstandard is not None else "gzip"}
+        )
+    for encoding in reversed(encodings):
+        if encoding == "identity":
+            continue
+        try:
+            if encoding == "zstd":
+                if zstandard is None:
+                    raise HTTPException(status_code=501, detail="Content-Encoding zstd requer o pacote zstandard.")
+                body = _read_limited(zstandard.ZstdDecompressor().stream_reader(body, read_across_frames=True), max_bytes)
+            else:
+                body = _read_limited(gzip.GzipFile(fileobj=io.BytesIO(body)), max_bytes)
+        except HTTPException:
+            raise
+        except DECOMPRESS_ERRORS:
+            raise HTTPException(status_code=400, detail=f"Corpo {encoding} inválido ou truncado.")
+    if len(body) > max_bytes:
+        raise _too_large(max_bytes)
+    return body
+
+def decode(body: bytes, content_type: str) -> Any:
+    media_type = content_type.split(";", 1)[0].strip().lower()
+    if media_type in MSGPACK_CONTENT_TYPES:
+        if msgpack is None:
+            raise HTTPException(status_code=501, detail="Corpo MessagePack requer o pacote msgpack.")
+        try:
+            # timestamp=3 devolve a extensão de timestamp do MessagePack como datetime em UTC.
+            return msgpack.unpackb(body, timestamp=3)
+        except (ValueError, msgpack.UnpackException) as e:
+            raise RequestValidationError([
+                {"type": "msgpack_invalid", "loc": ("body",), "msg": "MessagePack decode error", "input": {}, "ctx": {"error": str(e)}}
+            ])
+    if media_type and media_type != "application/json" and not media_type.endswith("+json"):
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail="Content-Type deve ser application/json ou application/msgpack."
+        )
+    try:
+        return orjson.loads(body)
+    except orjson.JSONDecodeError as e:
+        raise RequestValidationError([
+            {"type": "json_invalid", "loc": ("body", e.pos), "msg": "JSON decode error", "input": {}, "ctx": {"error": e.msg}}
+        ])
+
+async def receive_body(request: Request, max_bytes: int = INGEST_MAX_REQUEST_BYTES) -> bytes:
+    """Lê o corpo como veio pela rede, recusando com 413 antes de passar de `max_bytes`."""
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > max_bytes:
+        raise _too_large(max_bytes, decompressed=False)
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > max_bytes:
+            raise _too_large(max_bytes, decompressed=False)
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+def parse_body(body: bytes, content_encoding: str, content_type: str) -> Any:
+    return decode(decompress(body, content_encoding), content_type)
+
+def _parse_sensor_data(body: bytes, content_encoding: str, content_type: str) -> schemas.SensorDataCreate:
+    try:
+        return schemas.SensorDataCreate.model_validate(parse_body(body, content_encoding, content_type))
+    except ValidationError as e:
+        raise RequestValidationError([
+            {**error, "loc": ("body", *error["loc"])} for error in e.errors(include_url=False)
+        ])
+
+def _parse_sensor_data_batch(body: bytes, content_encoding: str, content_type: str) -> List[Dict[str, Any]]:
+    items = parse_body(body, content_encoding, content_type)
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        raise RequestValidationError([
+            {"type": "list_type", "loc": ("body",), "msg": "Input should be a valid list of objects", "input": None}
+        ])
+    return items
+
+async def _parse_request(request: Request, parse):
+    # Descomprimir, decodificar e validar são CPU puro; no threadpool não travam o event loop das outras requisições.
+    body = await receive_body(request, INGEST_MAX_REQUEST_BYTES)
+    return await run_in_threadpool(
+        parse, body, request.headers.get("content-encoding", ""), request.headers.get("content-type", "")
+    )
+
+async def sensor_data_body(request: Request) -> schemas.SensorDataCreate:
+    """Dependência de POST /data: uma leitura em qualquer dos formatos aceitos."""
+    return await _parse_request(request, _parse_sensor_data)
+
+async def sensor_data_batch_body(request: Request) -> List[Dict[str, Any]]:
+    """Dependência de POST /data/batch: a lista de leituras, validadas uma a uma pela rota."""
+    return await _parse_request(request, _parse_sensor_data_batch)
+
+def openapi_body(schema: Dict[str, Any], description: str = None) -> Dict[str, Any]:
+    """requestBody do OpenAPI para as rotas que leem o corpo por receive_body."""
+    media = {"schema": schema}
+    request_body = {
+        "required": True,
+        "content": {"application/json": media, "application/msgpack": media},
+    }
+    if description:
+        request_body["description"] = description
+    return {"requestBody": request_body}
@@ -0,0 +1,164 @@
+"""Retenção de sensor_data: apaga leituras brutas antigas que já estão nos rollups.
+
+Roda como thread da aplicação a cada RETENTION_INTERVAL_SECONDS ou uma vez
+pela linha de comando:
+
+    python -m app.retention --raw-days 30
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from app import crud, partitions
+from .database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+# Rollups por minuto mais antigos que isso também são apagados; hour e day ficam para sempre (0 guarda tudo).
+ROLLUP_MINUTE_RETENTION_DAYS = float(os.getenv("ROLLUP_MINUTE_RETENTION_DAYS", "0"))
+RETENTION_INTERVAL_SECONDS = float(os.getenv("RETENTION_INTERVAL_SECONDS", "3600"))
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "5000"))
+# Pausa entre lotes para não disputar I/O e locks com a ingestão.
+RETENTION_BATCH_PAUSE_SECONDS = float(os.getenv("RETENTION_BATCH_PAUSE_SECONDS", "0.05"))
+
+def compact(
+    raw_days: float,
+    minute_rollup_days: float = 0,
+    batch_size: int = RETENTION_BATCH_SIZE,
+    pause: float = RETENTION_BATCH_PAUSE_SECONDS,
+    stop: threading.Event = None
+):
+    """Apaga em lotes as leituras brutas e os rollups por minuto fora da retenção.
+
+    Cada lote é uma transação curta; entre lotes há uma pausa de `pause`
+    segundos. Leituras ainda não incorporadas pelo RollupRefresher ficam para
+    a próxima execução. Retorna quantas linhas saíram de cada tabela e quanto
+    tempo levou.
+    """
+    started = time.perf_counter()
+    now = datetime.utcnow()
+    report = {"raw_deleted": 0, "minute_rollups_deleted": 0, "batches": 0, "partitions_dropped": 0}
+    jobs = []
+    db = SessionLocal()
+    try:
+        if raw_days > 0:
+            # O corte fica gravado antes de apagar: consultas agregadas e o refresher leem dali, seja qual
+            # for o RAW_RETENTION_DAYS do processo deles.
+            crud.set_raw_retention_horizon(db, now - timedelta(days=raw_days))
+        if raw_days > 0 and partitions.manager.enabled:
+            # Com sensor_data particionada a retenção apaga partições inteiras em vez de linhas.
+            report["partitions_dropped"], report["raw_deleted"] = partitions.manager.drop_expired(now - timedelta(days=raw_days))
+        elif raw_days > 0:
+            jobs.append(("raw_deleted", crud.delete_compacted_sensor_data, (now - timedelta(days=raw_days),)))
+        if minute_rollup_days > 0:
+            jobs.append(("minute_rollups_deleted", crud.delete_sensor_data_rollups, ("minute", now - timedelta(days=minute_rollup_days))))
+
+        for counter, delete_batch, args in jobs:
+            while stop is None or not stop.is_set():
+                deleted = delete_batch(db, *args, batch_size)
+                report[counter] += deleted
+                report["batches"] += 1
+                if deleted < batch_size:
+                    break
+                if pause > 0:
+                    time.sleep(pause)
+    finally:
+        db.close()
+    report["seconds"] = time.perf_counter() - started
+    return report
+
+class RetentionWorker:
+    """Thread que aplica a retenção periodicamente e guarda o resultado da última execução."""
+
+    def __init__(self, interval: float, batch_size: int, pause: float):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.raw_deleted = 0
+        self.minute_rollups_deleted = 0
+        self.last_run = None
+
+    @property
+    def enabled(self):
+        return self.interval > 0 and (crud.RAW_RETENTION_DAYS > 0 or ROLLUP_MINUTE_RETENTION_DAYS > 0)
+
+    def start(self):
+        if not self.enabled or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def run_once(self):
+        report = compact(
+            crud.RAW_RETENTION_DAYS,
+            ROLLUP_MINUTE_RETENTION_DAYS,
+            batch_size=self.batch_size,
+            pause=self.pause,
+            stop=self._stop
+        )
+        report["finished_at"] = datetime.utcnow().isoformat()
+        with self._lock:
+            self.runs += 1
+            self.raw_deleted += report["raw_deleted"]
+            self.minute_rollups_deleted += report["minute_rollups_deleted"]
+            self.last_run = report
+        logger.info(
+            "Retenção: %d leituras e %d rollups por minuto apagados em %.1fs",
+            report["raw_deleted"], report["minute_rollups_deleted"], report["seconds"]
+        )
+        return report
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("Falha ao aplicar a retenção de sensor_data")
+            self._stop.wait(self.interval)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "raw_retention_days": crud.RAW_RETENTION_DAYS,
+                "minute_rollup_retention_days": ROLLUP_MINUTE_RETENTION_DAYS,
+                "runs": self.runs,
+                "raw_deleted": self.raw_deleted,
+                "minute_rollups_deleted": self.minute_rollups_deleted,
+                "last_run": self.last_run,
+            }
+
+worker = RetentionWorker(
+    interval=RETENTION_INTERVAL_SECONDS,
+    batch_size=RETENTION_BATCH_SIZE,
+    pause=RETENTION_BATCH_PAUSE_SECONDS,
+)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--raw-days", type=float, default=crud.RAW_RETENTION_DAYS)
+    parser.add_argument("--minute-rollup-days", type=float, default=ROLLUP_MINUTE_RETENTION_DAYS)
+    parser.add_argument("--batch-size", type=int, default=RETENTION_BATCH_SIZE)
+    parser.add_argument("--pause", type=float, default=RETENTION_BATCH_PAUSE_SECONDS)
+    args = parser.parse_args()
+    if args.raw_days <= 0 and args.minute_rollup_days <= 0:
+        parser.error("Informe --raw-days ou --minute-rollup-days (ou RAW_RETENTION_DAYS).")
+    print(json.dumps(compact(args.raw_days, args.minute_rollup_days, args.batch_size, args.pause)))
+
+if __name__ == "__main__":
+    main()
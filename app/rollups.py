@@ -0,0 +1,57 @@
+import logging
+import os
+import threading
+from app import crud
+from .database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+# 0 desliga a atualização em segundo plano; as consultas agregadas continuam corretas lendo sensor_data.
+ROLLUP_REFRESH_INTERVAL_SECONDS = float(os.getenv("ROLLUP_REFRESH_INTERVAL_SECONDS", "30"))
+ROLLUP_BATCH_SIZE = int(os.getenv("ROLLUP_BATCH_SIZE", "50000"))
+
+class RollupRefresher:
+    """Thread que incorpora periodicamente as leituras novas aos rollups.
+
+    Cada leitura é marcada em sensor_data.fold_status na mesma transação que a
+    soma aos rollups, então transações de ingestão que terminam fora de ordem
+    não deixam leituras para trás.
+    """
+
+    def __init__(self, interval: float, batch_size: int):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._stop = threading.Event()
+        self._thread = None
+        self.folded = 0
+
+    def start(self):
+        if self.interval <= 0 or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="rollup-refresher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            db = SessionLocal()
+            try:
+                self.folded += crud.refresh_sensor_data_rollups(db, self.batch_size)
+            except Exception:
+                db.rollback()
+                logger.exception("Falha ao atualizar os rollups de sensor_data")
+            finally:
+                db.close()
+            self._stop.wait(self.interval)
+
+refresher = RollupRefresher(
+    interval=ROLLUP_REFRESH_INTERVAL_SECONDS,
+    batch_size=ROLLUP_BATCH_SIZE,
+)
@@ -1,6 +1,6 @@
 from pydantic import BaseModel, Field, field_validator, model_validator, ConfigDict
-from datetime import datetime
-from typing import Optional, List
+from datetime import datetime, timezone
+from typing import Optional, List, Dict
 
 
 class SensorDataBase(BaseModel):
@@ -15,6 +15,8 @@ class SensorDataBase(BaseModel):
     def validate_timestamp(cls, value):
         if not value:
             raise ValueError("O timestamp é obrigatório.")
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
         return value
 
     @field_validator("server_ulid")
@@ -46,6 +48,17 @@ class SensorData(SensorDataBase):
 
     model_config = ConfigDict(from_attributes=True)
 
+class SensorDataBatchItemResult(BaseModel):
+    index: int
+    status: str
+    id: Optional[int] = None
+    detail: Optional[str] = None
+
+class SensorDataBatchResponse(BaseModel):
+    accepted: int
+    rejected: int
+    results: List[SensorDataBatchItemResult]
+
 class SensorDataResponse(BaseModel):
     timestamp: datetime
     temperature: Optional[float]
@@ -98,4 +111,48 @@ class ServerResponse(BaseModel):
     created_at: datetime
 
     class Config:
-        orm_mode = True
\ No newline at end of file
+        orm_mode = True
+
+class AlertRule(BaseModel):
+    name: Optional[str] = Field(None, description="Nome da regra nos alertas; por padrão derivado do sensor e dos limites.")
+    sensor: str = Field(..., description="Sensor avaliado (temperature, humidity, voltage ou current).")
+    server_ulid: Optional[str] = Field(None, description="Restringe a regra a um servidor.")
+    min: Optional[float] = Field(None, description="Alerta quando o valor fica abaixo deste limite.")
+    max: Optional[float] = Field(None, description="Alerta quando o valor passa deste limite.")
+    zscore: Optional[float] = Field(None, gt=0, description="Alerta quando o valor se afasta da média da janela por este número de desvios padrão.")
+    min_samples: int = Field(10, ge=2, description="Leituras na janela antes de avaliar o z-score.")
+
+    @model_validator(mode="after")
+    def validate_limits(self):
+        if self.min is None and self.max is None and self.zscore is None:
+            raise ValueError("A regra precisa de min, max ou zscore.")
+        if self.name is None:
+            limits = [f"{key}={getattr(self, key):g}" for key in ("min", "max", "zscore") if getattr(self, key) is not None]
+            self.name = f"{self.sensor}:{','.join(limits)}"
+        return self
+
+class SensorRollingStats(BaseModel):
+    count: int
+    mean: Optional[float]
+    stddev: Optional[float]
+    min: Optional[float]
+    max: Optional[float]
+    last_value: Optional[float]
+    last_timestamp: Optional[datetime]
+
+class AlertResponse(BaseModel):
+    rule: str
+    server_ulid: str
+    sensor: str
+    kind: str
+    value: float
+    threshold: float
+    zscore: Optional[float] = None
+    started_at: datetime
+    last_seen: datetime
+    readings: int
+
+class MonitoringResponse(BaseModel):
+    window_seconds: float
+    servers: Dict[str, Dict[str, SensorRollingStats]]
+    alerts: List[AlertResponse]
@@ -0,0 +1,89 @@
+"""Backend embarcado: SQLite em modo WAL, para gateways sem Postgres.
+
+Ativado por DATABASE_URL=sqlite:///caminho/do/arquivo.db. Cada conexão nova
+recebe os PRAGMAs abaixo e as agregações que o SQLite não tem (stddev_samp e
+percentile_cont), implementadas em Python. O intervalo de agregação é
+calculado em segundos desde a época, equivalente ao date_bin do Postgres.
+"""
+import math
+import os
+from datetime import datetime
+from sqlalchemy import DateTime, Integer, cast, func, literal_column, type_coerce
+
+# WAL deixa leituras seguirem enquanto a ingestão grava; NORMAL só sincroniza o disco nos checkpoints.
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+# Quanto uma escrita espera pelo lock do arquivo antes de falhar com "database is locked".
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536"))
+
+EPOCH = datetime(1970, 1, 1)
+
+class StddevSamp:
+    """stddev_samp(x) do Postgres: desvio padrão amostral, NULL com menos de dois valores."""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def step(self, value):
+        if value is None:
+            return
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def finalize(self):
+        if self.count < 2:
+            return None
+        return math.sqrt(self.m2 / (self.count - 1))
+
+class PercentileCont:
+    """percentile_cont(x, fração): percentil com interpolação linear, como o do Postgres."""
+
+    def __init__(self):
+        self.values = []
+        self.fraction = None
+
+    def step(self, value, fraction):
+        self.fraction = fraction
+        if value is not None:
+            self.values.append(value)
+
+    def finalize(self):
+        if not self.values:
+            return None
+        self.values.sort()
+        position = self.fraction * (len(self.values) - 1)
+        lower = math.floor(position)
+        upper = math.ceil(position)
+        return self.values[lower] + (self.values[upper] - self.values[lower]) * (position - lower)
+
+def configure_connection(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+    cursor.close()
+    dbapi_connection.create_aggregate("stddev_samp", 1, StddevSamp)
+    dbapi_connection.create_aggregate("percentile_cont", 2, PercentileCont)
+
+def bin_expr(width_seconds: int, column, origin: datetime):
+    """Início do intervalo de `width_seconds` alinhado a `origin` que contém `column`.
+
+    O DateTime do SQLAlchemy grava texto 'AAAA-MM-DD HH:MM:SS.ffffff' no
+    SQLite; o resultado usa o mesmo formato, então pode ser comparado e
+    gravado junto com os timestamps das tabelas.
+    """
+    seconds = cast(func.strftime(literal_column("'%s'"), column), Integer)
+    width = literal_column(str(width_seconds))
+    offset = seconds - literal_column(str(int((origin - EPOCH).total_seconds())))
+    # O % do SQLite mantém o sinal do dividendo; somar a largura arredonda para baixo antes da origem também.
+    start = seconds - (offset % width + width) % width
+    return type_coerce(
+        func.datetime(start, literal_column("'unixepoch'")).concat(literal_column("'.000000'")),
+        DateTime
+    )
@@ -0,0 +1,78 @@
+import csv
+import io
+from datetime import datetime
+from typing import Iterable, List, Sequence
+import orjson
+from . import metrics
+
+STREAM_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+STREAM_CHUNK_ROWS = 1000
+
+JSON_SHAPES = ("rows", "columns")
+
+def negotiate_format(requested: str, accept: str):
+    """Escolhe o formato de streaming pelo parâmetro `format` ou pelo header Accept.
+
+    Retorna None quando a resposta deve ser o JSON padrão.
+    """
+    if requested:
+        if requested not in STREAM_FORMATS:
+            raise ValueError("Formato deve ser 'ndjson' ou 'csv'.")
+        return requested
+    for name, media_type in STREAM_FORMATS.items():
+        if media_type in (accept or ""):
+            return name
+    return None
+
+def _chunks(rows: Iterable[Sequence]):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= STREAM_CHUNK_ROWS:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def iter_ndjson(columns: List[str], rows: Iterable[Sequence]):
+    for chunk in _chunks(rows):
+        yield b"".join(
+            orjson.dumps(dict(zip(columns, row)), option=orjson.OPT_APPEND_NEWLINE)
+            for row in chunk
+        )
+
+def iter_csv(columns: List[str], rows: Iterable[Sequence]):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for chunk in _chunks(rows):
+        writer.writerows(
+            [value.isoformat() if isinstance(value, datetime) else value for value in row]
+            for row in chunk
+        )
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+def encode(format: str, columns: List[str], rows: Iterable[Sequence]):
+    if format == "csv":
+        return iter_csv(columns, rows)
+    return iter_ndjson(columns, rows)
+
+@metrics.timed("serialize")
+def encode_json(columns: List[str], rows: Sequence[Sequence], shape: str = "rows") -> bytes:
+    """Serializa tuplas direto para JSON, sem passar por modelos Pydantic.
+
+    Colunas excedentes em cada tupla (como o id usado na paginação) são
+    ignoradas. Com shape="columns" o resultado é um objeto com uma lista por
+    coluna em vez de uma lista de objetos.
+    """
+    if shape == "columns":
+        return orjson.dumps({column: [row[index] for row in rows] for index, column in enumerate(columns)})
+    return orjson.dumps([dict(zip(columns, row)) for row in rows])
@@ -0,0 +1,110 @@
+"""Compara tamanho no fio e custo de leitura dos formatos aceitos por POST /data/batch.
+
+Para cada combinação de formato (JSON, MessagePack) e compressão (nenhuma,
+gzip, zstd) mede os bytes enviados, o tempo de descomprimir e decodificar o
+corpo e o tempo total até as leituras validadas por SensorDataCreate. A linha
+de base é o caminho anterior: json.loads da biblioteca padrão, como o FastAPI
+faz com corpos JSON.
+
+Uso: python -m benchmarks.ingest_payloads --readings 1000 --repeat 20
+"""
+import argparse
+import gzip
+import json
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from app import payloads, schemas
+
+def _synthetic_readings(count: int):
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    return [
+        {
+            "server_ulid": f"01HQ{index % 20:022d}",
+            "timestamp": start + timedelta(seconds=index),
+            "temperature": round(random.uniform(15, 40), 2),
+            "humidity": round(random.uniform(20, 90), 2),
+            "voltage": round(random.uniform(210, 230), 2) if index % 2 else None,
+            "current": round(random.uniform(0, 10), 2) if index % 3 else None,
+        }
+        for index in range(count)
+    ]
+
+def _bodies(readings):
+    as_json = json.dumps([{**reading, "timestamp": reading["timestamp"].isoformat()} for reading in readings]).encode()
+    bodies = {("json", ""): as_json}
+    if payloads.msgpack is not None:
+        bodies[("msgpack", "")] = payloads.msgpack.packb(readings, datetime=True)
+    for (body_format, _), body in list(bodies.items()):
+        bodies[(body_format, "gzip")] = gzip.compress(body)
+        if payloads.zstandard is not None:
+            bodies[(body_format, "zstd")] = payloads.zstandard.ZstdCompressor().compress(body)
+    return bodies
+
+def _content_type(body_format: str):
+    return "application/msgpack" if body_format == "msgpack" else "application/json"
+
+def _validate(items):
+    return [schemas.SensorDataCreate.model_validate(item) for item in items]
+
+def _stdlib_path(body: bytes):
+    return _validate(json.loads(body))
+
+def _decode_path(body: bytes, body_format: str, encoding: str):
+    return payloads.parse_body(body, encoding, _content_type(body_format))
+
+def _best_of(repeat: int, func, *args):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--readings", type=int, default=1000, help="Leituras por lote.")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--json", action="store_true", help="Imprime o resultado em JSON.")
+    args = parser.parse_args()
+
+    readings = _synthetic_readings(args.readings)
+    bodies = _bodies(readings)
+    baseline_body = bodies[("json", "")]
+
+    results = {
+        "json_stdlib": {
+            "bytes": len(baseline_body),
+            "decode_seconds": _best_of(args.repeat, json.loads, baseline_body),
+            "total_seconds": _best_of(args.repeat, _stdlib_path, baseline_body),
+        }
+    }
+    for (body_format, encoding), body in bodies.items():
+        decode = lambda: _decode_path(body, body_format, encoding)
+        results[f"{body_format}+{encoding}" if encoding else body_format] = {
+            "bytes": len(body),
+            "decode_seconds": _best_of(args.repeat, decode),
+            "total_seconds": _best_of(args.repeat, lambda: _validate(decode())),
+        }
+
+    baseline = results["json_stdlib"]
+    for result in results.values():
+        result["bytes_ratio"] = result["bytes"] / baseline["bytes"]
+        result["speedup"] = baseline["total_seconds"] / result["total_seconds"]
+        result["us_per_reading"] = result["total_seconds"] / args.readings * 1e6
+
+    if args.json:
+        print(json.dumps({"readings": args.readings, "results": results}, indent=2))
+        return
+
+    print(f"{args.readings} leituras por lote, melhor de {args.repeat} execuções")
+    print(f"{'formato':<16} {'bytes':>9} {'fio':>6} {'decode':>10} {'total':>10} {'us/leit.':>9} {'speedup':>8}")
+    for name, result in results.items():
+        print(
+            f"{name:<16} {result['bytes']:9d} {result['bytes_ratio']:6.2f} "
+            f"{result['decode_seconds'] * 1000:7.2f} ms {result['total_seconds'] * 1000:7.2f} ms "
+            f"{result['us_per_reading']:9.2f} {result['speedup']:7.2f}x"
+        )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+"""Carga sintética sobre ingestão, consultas e health, com latências em JSON.
+
+Popula o banco de DATABASE_URL com uma frota sintética (servidores x leituras
+por segundo x dias) e dispara POST /data, GET /data (bruto e agregado),
+/health/{server_ulid} e /healths/all em cada nível de concorrência pedido.
+Sem --base-url a aplicação roda no próprio processo (ASGI, sem rede); com
+--base-url as requisições vão para um servidor já em execução.
+
+Uso:
+    python -m benchmarks.load --servers 20 --rate 0.1 --days 1 --concurrency 1,8,32 --output atual.json
+    python -m benchmarks.load --skip-seed --baseline atual.json --tolerance 0.1
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+import httpx
+from app import crud, models, schemas
+from app.database import SessionLocal, engine
+
+SEED_CHUNK_ROWS = 10000
+# Todas as leituras semeadas terminam neste instante, para que execuções repetidas usem os mesmos dados.
+SEED_END = datetime(2024, 1, 1)
+SCENARIOS = ["ingest", "query_raw", "query_aggregated", "health_one", "health_all"]
+
+def server_ulids(servers: int):
+    return [f"bench-{index:05d}" for index in range(servers)]
+
+def seed(servers: int, rate: float, days: float, random_seed: int, reset: bool):
+    """Grava as leituras sintéticas e incorpora tudo aos rollups; leituras já existentes são ignoradas."""
+    if reset:
+        models.Base.metadata.drop_all(bind=engine)
+    models.Base.metadata.create_all(bind=engine)
+
+    rng = random.Random(random_seed)
+    ulids = server_ulids(servers)
+    interval = timedelta(seconds=1 / rate)
+    start = SEED_END - timedelta(days=days)
+    db = SessionLocal()
+    try:
+        for index, server_ulid in enumerate(ulids):
+            db.merge(models.Server(server_ulid=server_ulid, server_name=f"Bench {index}", created_at=start))
+        db.commit()
+
+        written = 0
+        chunk = []
+        timestamp = start
+        while timestamp < SEED_END:
+            for server_ulid in ulids:
+                chunk.append(schemas.SensorDataCreate(
+                    server_ulid=server_ulid,
+                    timestamp=timestamp,
+                    temperature=rng.uniform(15, 40),
+                    humidity=rng.uniform(20, 90),
+                    voltage=rng.uniform(210, 230) if rng.random() < 0.5 else None,
+                    current=rng.uniform(0, 10) if rng.random() < 0.5 else None,
+                ))
+            if len(chunk) >= SEED_CHUNK_ROWS:
+                written += sum(data_id is not None for data_id in crud.create_sensor_data_batch(db, chunk))
+                chunk = []
+            timestamp += interval
+        if chunk:
+            written += sum(data_id is not None for data_id in crud.create_sensor_data_batch(db, chunk))
+        crud.refresh_sensor_data_rollups(db)
+        return written
+    finally:
+        db.close()
+
+def _percentile(sorted_values, fraction: float):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def _request_factory(scenario: str, ulids, days: float):
+    range_start = (SEED_END - timedelta(days=days)).isoformat()
+    range_end = SEED_END.isoformat()
+    counter = iter(range(10 ** 12))
+    # Ingestão usa timestamps a partir do início da execução, então nunca colide com dados anteriores.
+    ingest_start = datetime.utcnow()
+
+    def build():
+        number = next(counter)
+        server_ulid = ulids[number % len(ulids)]
+        if scenario == "ingest":
+            return "POST", "/data", {
+                "server_ulid": server_ulid,
+                "timestamp": (ingest_start + timedelta(milliseconds=number)).isoformat(),
+                "temperature": 25.0,
+                "humidity": 60.0,
+            }
+        if scenario == "query_raw":
+            return "GET", f"/data?server_ulid={server_ulid}&start_time={range_start}&end_time={range_end}&limit=1000", None
+        if scenario == "query_aggregated":
+            return "GET", f"/data?server_ulid={server_ulid}&start_time={range_start}&end_time={range_end}&aggregation=hour", None
+        if scenario == "health_one":
+            return "GET", f"/health/{server_ulid}", None
+        return "GET", "/healths/all", None
+
+    return build
+
+async def run_scenario(client: httpx.AsyncClient, build, concurrency: int, requests: int, headers):
+    latencies = []
+    errors = 0
+    remaining = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for _ in remaining:
+            method, url, body = build()
+            started = time.perf_counter()
+            response = await client.request(method, url, json=body, headers=headers)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": errors,
+        "seconds": elapsed,
+        "throughput_rps": requests / elapsed if elapsed else 0.0,
+        "p50_ms": _percentile(latencies, 0.50) * 1000,
+        "p95_ms": _percentile(latencies, 0.95) * 1000,
+        "p99_ms": _percentile(latencies, 0.99) * 1000,
+        "max_ms": latencies[-1] * 1000,
+    }
+
+async def _authenticate(client: httpx.AsyncClient):
+    credentials = {"username": "benchmark", "password": "benchmark"}
+    response = await client.post("/auth/login", json=credentials)
+    if response.status_code == 401:
+        await client.post("/auth/register", json=credentials)
+        response = await client.post("/auth/login", json=credentials)
+    response.raise_for_status()
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+async def run(args):
+    ulids = server_ulids(args.servers)
+    if args.base_url:
+        client = httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout)
+        lifespan = None
+    else:
+        from app.main import app
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark", timeout=args.timeout)
+        lifespan = app.router.lifespan_context(app)
+        await lifespan.__aenter__()
+
+    results = {}
+    try:
+        async with client:
+            headers = await _authenticate(client)
+            for scenario in args.scenarios:
+                results[scenario] = {}
+                build = _request_factory(scenario, ulids, args.days)
+                for concurrency in args.concurrency:
+                    # Aquecimento fora da medição: conexões do pool, caches e planos de consulta.
+                    await run_scenario(client, build, concurrency, min(args.requests, concurrency * 2), headers)
+                    results[scenario][str(concurrency)] = await run_scenario(client, build, concurrency, args.requests, headers)
+    finally:
+        if lifespan is not None:
+            await lifespan.__aexit__(None, None, None)
+    return results
+
+def compare(results, baseline, tolerance: float):
+    """Razões em relação à linha de base e a lista de cenários que pioraram além de `tolerance`."""
+    comparison = {}
+    regressions = []
+    for scenario, levels in results.items():
+        for concurrency, current in levels.items():
+            previous = baseline.get("results", {}).get(scenario, {}).get(concurrency)
+            if previous is None:
+                continue
+            ratios = {
+                "throughput_ratio": current["throughput_rps"] / previous["throughput_rps"] if previous["throughput_rps"] else None,
+                "p95_ratio": current["p95_ms"] / previous["p95_ms"] if previous["p95_ms"] else None,
+                "p99_ratio": current["p99_ms"] / previous["p99_ms"] if previous["p99_ms"] else None,
+            }
+            comparison.setdefault(scenario, {})[concurrency] = ratios
+            if (ratios["throughput_ratio"] is not None and ratios["throughput_ratio"] < 1 - tolerance) or (
+                ratios["p95_ratio"] is not None and ratios["p95_ratio"] > 1 + tolerance
+            ):
+                regressions.append(f"{scenario}@{concurrency}")
+    return comparison, regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--servers", type=int, default=20)
+    parser.add_argument("--rate", type=float, default=0.1, help="Leituras por segundo de cada servidor.")
+    parser.add_argument("--days", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=42, help="Semente dos valores sintéticos.")
+    parser.add_argument("--reset", action="store_true", help="Recria as tabelas antes de popular (apaga os dados!).")
+    parser.add_argument("--skip-seed", action="store_true", help="Usa os dados já gravados por uma execução anterior.")
+    parser.add_argument("--concurrency", default="1,8,32", help="Níveis de concorrência separados por vírgula.")
+    parser.add_argument("--requests", type=int, default=500, help="Requisições medidas por cenário e nível.")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--base-url", help="Servidor em execução; sem isso a aplicação roda no processo.")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--output", help="Arquivo onde gravar o resultado em JSON (além da saída padrão).")
+    parser.add_argument("--baseline", help="Resultado anterior em JSON para comparar.")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Piora relativa aceita antes de acusar regressão.")
+    args = parser.parse_args()
+    args.concurrency = [int(level) for level in args.concurrency.split(",") if level]
+    args.scenarios = [scenario for scenario in args.scenarios.split(",") if scenario]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Cenários desconhecidos: {', '.join(sorted(unknown))}")
+
+    seeded = None
+    if not args.skip_seed:
+        started = time.perf_counter()
+        seeded = {"rows": seed(args.servers, args.rate, args.days, args.seed, args.reset), "seconds": time.perf_counter() - started}
+
+    output = {
+        "config": {
+            "servers": args.servers,
+            "rate": args.rate,
+            "days": args.days,
+            "seed": args.seed,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "target": args.base_url or "in-process",
+        },
+        "seeded": seeded,
+        "results": asyncio.run(run(args)),
+    }
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            output["comparison"], regressions = compare(output["results"], json.load(baseline_file), args.tolerance)
+        output["regressions"] = regressions
+
+    text = json.dumps(output, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(text + "\n")
+    print(text)
+    if regressions:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
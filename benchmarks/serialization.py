@@ -0,0 +1,80 @@
+"""Compara a serialização de GET /data pelo response_model com o caminho rápido (orjson).
+
+Uso: python -m benchmarks.serialization --rows 100000 --repeat 5
+"""
+import argparse
+import json
+import random
+import time
+from datetime import datetime, timedelta
+from typing import List
+from pydantic import TypeAdapter
+from app import crud, models, schemas, streaming
+
+def _synthetic_rows(count: int):
+    start = datetime(2024, 1, 1)
+    return [
+        (
+            start + timedelta(seconds=index),
+            random.uniform(15, 40),
+            random.uniform(20, 90),
+            random.uniform(210, 230) if index % 2 else None,
+            random.uniform(0, 10) if index % 3 else None,
+            index + 1,
+        )
+        for index in range(count)
+    ]
+
+def _pydantic_path(objects):
+    # Mesmo caminho do FastAPI com response_model: valida, converte para JSON-compatível e serializa.
+    adapter = TypeAdapter(List[schemas.SensorDataResponse])
+    validated = adapter.validate_python(objects, from_attributes=True)
+    return json.dumps(adapter.dump_python(validated, mode="json")).encode()
+
+def _best_of(repeat: int, func, *args):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        payload = func(*args)
+        timings.append(time.perf_counter() - started)
+    return min(timings), len(payload)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="Imprime o resultado em JSON.")
+    args = parser.parse_args()
+
+    rows = _synthetic_rows(args.rows)
+    objects = [
+        models.SensorData(id=row[5], server_ulid="server_1", **dict(zip(crud.SENSOR_DATA_COLUMNS, row)))
+        for row in rows
+    ]
+
+    results = {}
+    for name, func, data in (
+        ("pydantic_response_model", _pydantic_path, objects),
+        ("orjson_rows", lambda r: streaming.encode_json(crud.SENSOR_DATA_COLUMNS, r, "rows"), rows),
+        ("orjson_columns", lambda r: streaming.encode_json(crud.SENSOR_DATA_COLUMNS, r, "columns"), rows),
+    ):
+        seconds, size = _best_of(args.repeat, func, data)
+        results[name] = {"seconds": seconds, "bytes": size, "rows_per_second": args.rows / seconds}
+
+    baseline = results["pydantic_response_model"]["seconds"]
+    for result in results.values():
+        result["speedup"] = baseline / result["seconds"]
+
+    if args.json:
+        print(json.dumps({"rows": args.rows, "results": results}, indent=2))
+        return
+
+    print(f"{args.rows} linhas, melhor de {args.repeat} execuções")
+    for name, result in results.items():
+        print(
+            f"{name:<25} {result['seconds'] * 1000:9.1f} ms "
+            f"{result['bytes'] / 1024:9.0f} KiB {result['speedup']:6.1f}x"
+        )
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,21 @@
+from fastapi import HTTPException
 from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
 from app.main import app
+from app import admission, aggregates, alerts, auth, crud, database, health, ingest, live, payloads, retention, schemas
 from app.database import SessionLocal, engine
+from app import models
 from app.models import Base
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+import asyncio
+import gzip
+import io
+import json
+import math
 import time
 import pytest
+from sqlalchemy import text
+from passlib.context import CryptContext
 
 @pytest.fixture
 def client():
@@ -16,6 +27,7 @@ def clean_database():
     """Fixture para limpar o banco de dados antes de cada teste."""
     Base.metadata.drop_all(bind=engine)
     Base.metadata.create_all(bind=engine)
+    aggregates.cache.clear()
     yield
 
 def get_auth_token(client):
@@ -183,4 +195,879 @@ def test_get_server_health_invalid(client):
     headers = {"Authorization": f"Bearer {get_auth_token(client)}"}
     response = client.get("/health/invalid_server", headers=headers)
     assert response.status_code == 404
-    assert "Servidor não encontrado." in response.json()["detail"]
\ No newline at end of file
+    assert "Servidor não encontrado." in response.json()["detail"]
+
+def test_create_sensor_data_batch(client):
+    headers = {"Authorization": f"Bearer {get_auth_token(client)}"}
+    response = client.post(
+        "/data/batch",
+        json=[
+            {"server_ulid": "server_1", "timestamp": "2024-02-19T12:00:00Z", "temperature": 25.5},
+            {"server_ulid": "server_1", "timestamp": "2024-02-19T12:00:01Z", "humidity": {"value": 60.0}},
+            {"server_ulid": "server_1", "timestamp": "2024-02-19T12:00:02Z"}
+        ],
+        headers=headers
+    )
+    assert response.status_code == 200
+    body = response.json()
+    assert body["accepted"] == 2
+    assert body["rejected"] == 1
+    assert [item["status"] for item in body["results"]] == ["accepted", "accepted", "rejected"]
+    assert body["results"][0]["id"] is not None
+    assert "Pelo menos um valor de sensor deve ser enviado." in body["results"][2]["detail"]
+
+    response = client.get("/data?server_ulid=server_1", headers=headers)
+    assert len(response.json()) == 2
+
+def test_create_sensor_data_buffered(client, monkeypatch):
+    headers = {"Authorization": f"Bearer {get_auth_token(client)}"}
+    monkeypatch.setattr(ingest, "INGEST_MODE", "buffered")
+    ingest.buffer.start()
+    for second in range(3):
+        response = client.post(
+            "/data",
+            json={
+                "server_ulid": "server_1",
+                "timestamp": f"2024-02-19T12:00:0{second}Z",
+                "temperature": 25.5
+            },
+            headers=headers
+        )
+        assert response.status_code == 202
+    ingest.buffer.stop()
+
+    response = client.get("/data?server_ulid=server_1", headers=headers)
+    assert len(response.json()) == 3
+
+    stats = client.get("/stats", headers=headers).json()["ingest"]
+    assert stats["queue_depth"] == 0
+    assert stats["flushed"] >= 3
+
+    # Uma falha passageira do banco não perde o lote, e leituras duplicadas não contam como gravadas.
+    flaky = ingest.IngestBuffer(max_size=10, flush_max_items=10, flush_interval=0.01, max_attempts=3, retry_delay=0)
+    create_batch = crud.create_sensor_data_batch
+    failures = []
+
+    def fail_once(db, items):
+        if not failures:
+            failures.append(len(items))
+            raise RuntimeError("banco fora do ar")
+        return create_batch(db, items)
+
+    monkeypatch.setattr(crud, "create_sensor_data_batch", fail_once)
+    batch = [
+        schemas.SensorDataCreate.model_validate({"server_ulid": "server_1", "timestamp": f"2024-02-19T12:00:0{second}Z", "temperature": 25.5})
+        for second in (2, 5)
+    ]
+    flaky._flush(batch)
+    stats = flaky.stats()
+    assert (stats["flushed"], stats["duplicates"], stats["dropped"], stats["flush_errors"]) == (1, 1, 0, 1)
+
+    def always_fail(db, items):
+        raise RuntimeError("banco fora do ar")
+
+    monkeypatch.setattr(crud, "create_sensor_data_batch", always_fail)
+    flaky._flush(batch)
+    stats = flaky.stats()
+    assert (stats["flushed"], stats["dropped"], stats["flush_errors"]) == (1, 2, 4)
+
+def test_create_sensor_data_duplicate_timestamp(client):
+    headers = {"Authorization": f"Bearer {get_auth_token(client)}"}
+    reading = {"server_ulid": "server_1", "timestamp": "2024-02-19T12:00:00Z", "temperature": 25.5}
+    response = client.post("/data", json=reading, headers=headers)
+    assert response.status_code == 200
+
+    response = client.post("/data", json=reading, headers=headers)
+    assert response.status_code == 400
+
+    response = client.post("/data", json={**reading, "timestamp": "2024-02-19T12:00:01Z"}, headers=headers)
+    assert response.status_code == 200
+
+    response = client.post("/data/batch", json=[reading, reading], headers=headers)
+    body = response.json()
+    assert body["accepted"] == 0
+    assert [item["status"] for item in body["results"]] == ["duplicate", "duplicate"]
+
+def test_get_sensor_data_streaming(client):
+    headers = {"Authorization": f"Bearer {get_auth_token(client)}"}
+    client.post(
+        "/data/batch",
+        json=[
+            {"server_ulid": "server_1", "timestamp": "2024-02-19T12:00:00Z", "temperature": 25.5},
+            {"server_ulid": "server_1", "timestamp": "2024-02-19T12:00:01Z", "humidity": 60.0}
+        ],
+        headers=headers
+    )
+
+    response = client.get("/data?format=ndjson", headers=headers)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert len(lines) == 2
+    assert {line["temperature"] for line in lines} == {25.5, None}
+
+    response = client.get("/data", headers={**headers, "Accept": "text/csv"})
+    assert response.status_code == 200
+    rows = response.text.splitlines()
+    assert rows[0] == "timestamp,temperature,humidity,voltage,current"
+    assert len(rows) == 3
+
+    response = client.get("/data?format=xml", headers=headers)
+    assert response.status_code == 400
+
+def test_get_sensor_data_paginated(client):
+    headers = {"Authorization": f"Bearer {get_auth_token(client)}"}
+    client.post(
+        "/data/batch",
+        json=[
+            {"server_ulid": "server_1", "timestamp": f"2024-02-19T12:00:0{second}Z", "temperature": float(second)}
+            for second in range(5)
+        ],
+        headers=headers
+    )
+
+    temperatures = []
+    cursor = None
+    while True:
+        url = "/data?server_ulid=server_1&limit=2" + (f"&cursor={cursor}" if cursor else "")
+        response = client.get(url, headers=headers)
+        assert response.status_code == 200
+        assert len(response.json()) <= 2
+        temperatures += [row["temperature"] for row in response.json()]
+        if response.headers["X-Has-More"] == "false":
+            break
+        cursor = response.headers["X-Next-Cursor"]
+
+    assert temperatures == [0.0, 1.0, 2.0, 3.0, 4.0]
+
+    response = client.get("/data?cursor=invalido", headers=headers)
+    assert response.status_code == 400
+
+def test_get_aggregated_sensor_data_from_rollups(client):
+    headers = {"Authorization": f"Bearer {get_auth_token(client)}"}
+    client.post(
+        "/data/batch",
+        json=[
+            {"server_ulid": "server_1", "timestamp": "2024-02-19T12:00:00Z", "temperature": 20.0, "humidity": 50.0},
+            {"server_ulid": "server_1", "timestamp": "2024-02-19T12:30:00Z", "humidity": 70.0},
+            {"server_ulid": "server_1", "timestamp": "2024-02-19T13:00:00Z", "temperature": 30.0}
+        ],
+        headers=headers
+    )
+    db = SessionLocal()
+    try:
+        crud.refresh_sensor_data_rollups(db)
+    finally:
+        db.close()
+    client.post(
+        "/data",
+        json={"server_ulid": "server_1", "timestamp": "2024-02-19T12:45:00Z", "temperature": 40.0},
+        headers=headers
+    )
+
+    response = client.get("/data?aggregation=hour", headers=headers)
+    rows = {row["timestamp"]: row for row in response.json()}
+    assert rows["2024-02-19T12:00:00"]["temperature"] == 30.0
+    assert rows["2024-02-19T12:00:00"]["humidity"] == 60.0
+    assert rows["2024-02-19T13:00:00"]["temperature"] == 30.0
+
+    response = client.get("/data?aggregation=hour&sensor_type=temperature", headers=headers)
+    rows = {row["timestamp"]: row for row in response.json()}
+    assert rows["2024-02-19T12:00:00"]["humidity"] == 50.0
+
+    response = client.get("/data?aggregation=hour&start_time=2024-02-19T12:15:00Z", headers=headers)
+    rows = {row["timestamp"]: row for row in response.json()}
+    assert rows["2024-02-19T12:00:00"]["temperature"] == 40.0
+    assert rows["2024-02-19T12:00:00"]["humidity"] == 70.0
+
+def test_rollups_fold_late_commits_and_rewrites(client, monkeypatch):
+    headers = {"Authorization": f"Bearer {get_auth_token(client)}"}
+    readings = [
+        {"server_ulid": "server_1", "timestamp": f"2024-02-19T12:{minute:02d}:00", "temperature": float(minute)}
+        for minute in range(3)
+    ]
+    ids = [item["id"] for item in client.post("/data/batch", json=readings, headers=headers).json()["results"]]
+
+    # Simula uma transação de ingestão com id menor que termina depois do refresher.
+    db = SessionLocal()
+    try:
+        db.execute(text("DELETE FROM sensor_data WHERE id = :id"), {"id": ids[1]})
+        db.commit()
+        assert crud.refresh_sensor_data_rollups(db) == 2
+        db.execute(
+            text("INSERT INTO sensor_data (id, server_ulid, timestamp, temperature) VALUES (:id, 'server_1', :timestamp, 1.0)"),
+            {"id": ids[1], "timestamp": datetime(2024, 2, 19, 12, 1)}
+        )
+        db.commit()
+    finally:
+        db.close()
+
+    def hour_stats():
+        response = client.get("/data?aggregation=hour&stats=count,sum&start_time=2024-02-19T12:00:00Z&end_time=2024-02-19T13:00:00Z", headers=headers)
+        row = response.json()[0]
+        return row["temperature_count"], row["temperature_sum"]
+
+    assert hour_stats() == (3, 3.0)
+    db = SessionLocal()
+    try:
+        assert crud.refresh_sensor_data_rollups(db) == 1
+    finally:
+        db.close()
+    assert hour_stats() == (3, 3.0)
+
+    monkeypatch.setattr(crud, "SENSOR_DATA_CONFLICT_POLICY", "update")
+    client.post("/data", json={**readings[2], "temperature": 10.0}, headers=headers)
+    # Até o próximo ciclo a leitura reescrita aparece com o valor antigo, sem contar duas vezes.
+    assert hour_stats() == (3, 3.0)
+    db = SessionLocal()
+    try:
+        assert crud.refresh_sensor_data_rollups(db) == 1
+        unfolded = db.execute(text("SELECT count(*) FROM sensor_data WHERE fold_status <> 1")).scalar()
+    finally:
+        db.close()
+    assert unfolded == 0
+    assert hour_stats() == (3, 11.0)
+
+def test_server_health_registry_seeded_at_startup(monkeypatch):
+    db = SessionLocal()
+    try:
+        crud.create_sensor_data(db, schemas.SensorDataCreate(
+            server_ulid="server_1",
+            timestamp=datetime.utcnow(),
+            temperature=25.5
+        ))
+    finally:
+        db.close()
+
+    with TestClient(app) as client:
+        headers = {"Authorization": f"Bearer {get_auth_token(client)}"}
+        response = client.get("/health/server_1", headers=headers)
+        assert response.status_code == 200
+        assert response.json()["status"] == "online"
+        assert response.json()["server_name"] == "Unknown"
+
+        monkeypatch.setattr(health, "HEALTH_ONLINE_THRESHOLD_SECONDS", -1)
+        response = client.get("/healths/all", headers=headers)
+        assert [server["status"] for server in response.json()["servers"]] == ["offline"]
+        executor = auth._hash_executor
+    # O pool de processos do bcrypt sai junto com os demais workers no fim do lifespan.
+    assert auth._hash_executor is None
+    with pytest.raises(RuntimeError):
+        executor.submit(abs, -1)
+
+def test_current_user_cache(client):
+    client.post("/auth/register", json={"username": "cacheuser", "password": "testpass"})
+    token = client.post("/auth/login", json={"username": "cacheuser", "password": "testpass"}).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+
+    hits = auth.user_cache.hits
+    assert client.get("/healths/all", headers=headers).status_code == 200
+    assert client.get("/healths/all", headers=headers).status_code == 200
+    assert auth.user_cache.hits > hits
+
+    db = SessionLocal()
+    try:
+        crud.set_user_active(db, "cacheuser", False)
+    finally:
+        db.close()
+    assert client.get("/healths/all", headers=headers).status_code == 401
+
+def test_login_rehashes_password_with_configured_cost(client):
+    db = SessionLocal()
+    try:
+        weak_hash = CryptContext(schemes=["bcrypt"], bcrypt__rounds=4).hash("testpass")
+        crud.create_user(db, schemas.UserCreate(username="rehashuser", password="testpass"), hashed_password=weak_hash)
+    finally:
+        db.close()
+
+    response = client.post("/auth/login", json={"username": "rehashuser", "password": "testpass"})
+    assert response.status_code == 200
+
+    db = SessionLocal()
+    try:
+        user = db.query(Base.metadata.tables["users"]).filter_by(username="rehashuser").one()
+        assert not auth.pwd_context.needs_update(user.hashed_password)
+    finally:
+        db.close()
+
+def test_login_rejected_when_hash_queue_full(client, monkeypatch):
+    client.post("/auth/register", json={"username": "testuser", "password": "testpass"})
+    monkeypatch.setattr(auth, "PASSWORD_HASH_QUEUE_LIMIT", 0)
+    response = client.post("/auth/login", json={"username": "testuser", "password": "testpass"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+
+def test_stats_reports_pool_checkout_wait(client):
+    headers = {"Authorization": f"Bearer {get_auth_token(client)}"}
+    response = client.get("/stats", headers=headers)
+    assert response.status_code == 200
+    pool = response.json()["database_pool"]["sync"]
+    assert pool["checkouts"] > 0
+    assert pool["max_wait_ms"] >= pool["avg_wait_ms"] >= 0
+
+def test_export_sensor_data(client):
+    pa = pytest.importorskip("pyarrow")
+    pq = pytest.importorskip("pyarrow.parquet")
+    headers = {"Authorization": f"Bearer {get_auth_token(client)}"}
+    client.post(
+        "/data/batch",
+        json=[
+            {"server_ulid": "server_1", "timestamp": "2024-02-19T12:00:00Z", "temperature": 25.5},
+            {"server_ulid": "server_2", "timestamp": "2024-02-19T12:00:01Z", "humidity": 60.0}
+        ],
+        headers=headers
+    )
+
+    response = client.get("/data/export?format=parquet&server_ulid=server_1", headers=headers)
+    assert response.status_code == 200
+    table = pq.read_table(io.BytesIO(response.content))
+    assert table.column("temperature").to_pylist() == [25.5]
+    assert table.column("voltage").to_pylist() == [None]
+
+    response = client.get("/data/export?format=arrow", headers=headers)
+    assert response.status_code == 200
+    table = pa.ipc.open_stream(response.content).read_all()
+    assert sorted(table.column("server_ulid").to_pylist()) == ["server_1", "server_2"]
+
+def test_get_sensor_data_columns_shape(client):
+    headers = {"Authorization": f"Bearer {get_auth_token(client)}"}
+    client.post(
+        "/data/batch",
+        json=[
+            {"server_ulid": "server_1", "timestamp": "2024-02-19T12:00:00Z", "temperature": 25.5},
+            {"server_ulid": "server_1", "timestamp": "2024-02-19T12:00:01Z", "temperature": 26.5}
+        ],
+        headers=headers
+    )
+
+    response = client.get("/data?server_ulid=server_1&shape=columns&limit=10", headers=headers)
+    assert response.status_code == 200
+    body = response.json()
+    assert body["timestamp"] == ["2024-02-19T12:00:00", "2024-02-19T12:00:01"]
+    assert body["temperature"] == [25.5, 26.5]
+    assert body["humidity"] == [None, None]
+
+    content = client.get("/openapi.json").json()["paths"]["/data"]["get"]["responses"]["200"]["content"]
+    assert len(content["application/json"]["schema"]["oneOf"]) == 4
+    assert {"application/x-ndjson", "text/csv"} <= set(content)
+
+def test_get_sensor_data_downsampled(client):
+    headers = {"Authorization": f"Bearer {get_auth_token(client)}"}
+    client.post(
+        "/data/batch",
+        json=[
+            {"server_ulid": "server_1", "timestamp": f"2024-02-19T12:{i // 60:02d}:{i % 60:02d}Z", "temperature": float(i % 7)}
+            for i in range(200)
+        ],
+        headers=headers
+    )
+
+    response = client.get("/data?server_ulid=server_1&sensor_type=temperature&max_points=20", headers=headers)
+    assert response.status_code == 200
+    series = response.json()["temperature"]
+    assert len(series["timestamp"]) == len(series["value"]) == 20
+    assert series["timestamp"][0] == "2024-02-19T12:00:00"
+    assert series["timestamp"][-1] == "2024-02-19T12:03:19"
+    assert series["timestamp"] == sorted(series["timestamp"])
+
+    response = client.get("/data?max_points=20&aggregation=hour", headers=headers)
+    assert response.status_code == 400
+    response = client.get("/data?sensor_type=temperature&max_points=20", headers=headers)
+    assert response.status_code == 400
+
+def test_get_aggregated_sensor_data_statistics(client):
+    headers = {"Authorization": f"Bearer {get_auth_token(client)}"}
+    client.post(
+        "/data/batch",
+        json=[
+            {"server_ulid": server_ulid, "timestamp": f"2024-02-19T12:{minute:02d}:00Z", "temperature": float(minute * factor)}
+            for server_ulid, factor in (("server_1", 1), ("server_2", 2))
+            for minute in range(10)
+        ],
+        headers=headers
+    )
+    db = SessionLocal()
+    try:
+        crud.refresh_sensor_data_rollups(db)
+    finally:
+        db.close()
+    client.post(
+        "/data",
+        json={"server_ulid": "server_1", "timestamp": "2024-02-19T12:04:30Z", "temperature": 10.0},
+        headers=headers
+    )
+
+    response = client.get(
+        "/data?aggregation=5m&stats=min,max,avg,count&group_by=server&start_time=2024-02-19T12:01:00Z",
+        headers=headers
+    )
+    assert response.status_code == 200
+    rows = [row for row in response.json() if row["server_ulid"] == "server_1"]
+    assert [row["timestamp"] for row in rows] == ["2024-02-19T12:00:00", "2024-02-19T12:05:00"]
+    assert rows[0]["temperature_min"] == 1.0
+    assert rows[0]["temperature_max"] == 10.0
+    assert rows[0]["temperature_count"] == 5
+    assert rows[0]["temperature_avg"] == 4.0
+    assert rows[1]["temperature_avg"] == 7.0
+
+    response = client.get("/data?aggregation=10m&stats=stddev,p50&server_ulid=server_2", headers=headers)
+    assert response.status_code == 200
+    row = response.json()[0]
+    assert row["temperature_p50"] == 9.0
+    assert round(row["temperature_stddev"], 4) == 6.0553
+
+    response = client.get("/data?aggregation=7x", headers=headers)
+    assert response.status_code == 400
+    for aggregation in ["366d", "5000000d", "99999999999d"]:
+        response = client.get(f"/data?aggregation={aggregation}&start_time=2024-02-19T12:00:00Z", headers=headers)
+        assert response.status_code == 400
+    response = client.get("/data?aggregation=365d&start_time=2024-02-19T12:00:00Z", headers=headers)
+    assert response.status_code == 200
+    response = client.get("/data?aggregation=hour&stats=median", headers=headers)
+    assert response.status_code == 400
+
+def test_aggregated_sensor_data_cache(client, monkeypatch):
+    headers = {"Authorization": f"Bearer {get_auth_token(client)}"}
+    client.post(
+        "/data/batch",
+        json=[
+            {"server_ulid": "server_1", "timestamp": f"2024-02-19T{hour:02d}:00:00Z", "temperature": float(hour)}
+            for hour in range(10, 14)
+        ],
+        headers=headers
+    )
+    url = "/data?aggregation=hour&server_ulid=server_1&start_time=2024-02-19T10:00:00Z&end_time=2024-02-19T14:00:00Z"
+
+    hits, invalidated = aggregates.cache.stats()["hits"], aggregates.cache.stats()["invalidated"]
+    first = client.get(url, headers=headers).json()
+    assert aggregates.cache.stats()["hits"] == hits
+    assert client.get(url, headers=headers).json() == first
+    assert aggregates.cache.stats()["hits"] == hits + 4
+
+    client.post(
+        "/data",
+        json={"server_ulid": "server_1", "timestamp": "2024-02-19T11:30:00Z", "temperature": 12.0},
+        headers=headers
+    )
+    stats = aggregates.cache.stats()
+    assert stats["invalidated"] == invalidated + 1
+    rows = {row["timestamp"]: row for row in client.get(url, headers=headers).json()}
+    assert rows["2024-02-19T11:00:00"]["temperature"] == 11.5
+    assert rows["2024-02-19T10:00:00"]["temperature"] == 10.0
+    assert aggregates.cache.stats()["hits"] == stats["hits"] + 3
+
+    # Um escopo sai junto com o último intervalo dele; server_ulid arbitrários não acumulam escopos.
+    small = aggregates.AggregateCache(max_buckets=4, ttl=3600, max_query_buckets=100)
+    monkeypatch.setattr(aggregates, "cache", small)
+    for server_ulid in ["server_1", "server_2", "server_3"]:
+        client.get(url.replace("server_1", server_ulid), headers=headers)
+    assert small.stats()["scopes"] == 1
+    assert small.stats()["evictions"] == 8
+    client.post(
+        "/data",
+        json={"server_ulid": "server_3", "timestamp": "2024-02-19T10:30:00Z", "temperature": 1.0},
+        headers=headers
+    )
+    assert small.stats()["invalidated"] == 1
+    client.post(
+        "/data/batch",
+        json=[
+            {"server_ulid": "server_3", "timestamp": f"2024-02-19T{hour:02d}:15:00Z", "temperature": 1.0}
+            for hour in range(11, 14)
+        ],
+        headers=headers
+    )
+    assert small.stats()["scopes"] == 0
+
+def test_live_sensor_data_websocket(client, monkeypatch):
+    token = get_auth_token(client)
+    headers = {"Authorization": f"Bearer {token}"}
+
+    with client.websocket_connect(f"/data/live?server_ulid=server_1&token={token}") as websocket:
+        client.post(
+            "/data/batch",
+            json=[
+                {"server_ulid": "server_2", "timestamp": "2024-02-19T12:00:00Z", "temperature": 20.0},
+                {"server_ulid": "server_1", "timestamp": "2024-02-19T12:00:01Z", "temperature": 25.5}
+            ],
+            headers=headers
+        )
+        message = websocket.receive_json()
+        assert message["server_ulid"] == "server_1"
+        assert message["temperature"] == 25.5
+        assert message["timestamp"] == "2024-02-19T12:00:01"
+
+    monkeypatch.setattr(live.broker, "max_messages", 2)
+    with client.websocket_connect("/data/live", headers=headers) as websocket:
+        client.post(
+            "/data/batch",
+            json=[
+                {"server_ulid": "server_1", "timestamp": f"2024-02-19T12:01:0{i}Z", "temperature": 20.0}
+                for i in range(5)
+            ],
+            headers=headers
+        )
+        with pytest.raises(WebSocketDisconnect) as closed:
+            while True:
+                websocket.receive_json()
+        assert closed.value.code == 1013
+    assert live.broker.stats()["dropped_subscribers"] >= 1
+
+    with pytest.raises(WebSocketDisconnect):
+        with client.websocket_connect("/data/live?token=invalido") as websocket:
+            websocket.receive_json()
+
+def test_metrics_endpoint(client):
+    headers = {"Authorization": f"Bearer {get_auth_token(client)}"}
+    client.post(
+        "/data",
+        json={"server_ulid": "server_1", "timestamp": "2024-02-19T12:00:00Z", "temperature": 25.5},
+        headers=headers
+    )
+    client.get("/health/server_1", headers=headers)
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    body = response.text
+    assert 'http_request_duration_seconds_count{method="GET",route="/health/{server_ulid}",status="200"}' in body
+    assert 'sql_query_duration_seconds_count{function="create_sensor_data"}' in body
+    assert 'ingest_readings_total{result="accepted"}' in body
+    assert 'db_pool_checkout_wait_seconds_count{pool="sync"}' in body
+    assert 'app_stage_duration_seconds_count{stage="auth"}' in body
+
+@pytest.mark.skipif(models.SENSOR_DATA_STORAGE == "partitioned", reason="Com partições a retenção apaga partições inteiras.")
+def test_retention_deletes_compacted_raw_data(client):
+    headers = {"Authorization": f"Bearer {get_auth_token(client)}"}
+    old = datetime.utcnow().replace(hour=12, minute=0, second=0, microsecond=0) - timedelta(days=10)
+    client.post(
+        "/data/batch",
+        json=[
+            {"server_ulid": "server_1", "timestamp": (old + timedelta(minutes=minute)).isoformat(), "temperature": float(minute)}
+            for minute in range(4)
+        ] + [{"server_ulid": "server_1", "timestamp": datetime.utcnow().isoformat(), "temperature": 30.0}],
+        headers=headers
+    )
+    db = SessionLocal()
+    try:
+        crud.refresh_sensor_data_rollups(db)
+    finally:
+        db.close()
+    client.post(
+        "/data",
+        json={"server_ulid": "server_1", "timestamp": (old + timedelta(minutes=5)).isoformat(), "temperature": 9.0},
+        headers=headers
+    )
+
+    # Como `python -m app.retention --raw-days 5` com a aplicação rodando sem RAW_RETENTION_DAYS.
+    assert crud.RAW_RETENTION_DAYS == 0
+    report = retention.compact(5, batch_size=3, pause=0)
+    assert report["raw_deleted"] == 4
+    assert report["batches"] == 2
+
+    response = client.get(f"/data?server_ulid=server_1&start_time={old.isoformat()}&end_time={(old + timedelta(days=1)).isoformat()}", headers=headers)
+    assert [row["temperature"] for row in response.json()] == [9.0]
+
+    start_time = (old + timedelta(minutes=30)).isoformat()
+    response = client.get(f"/data?server_ulid=server_1&aggregation=hour&start_time={old.isoformat()}&end_time={start_time}", headers=headers)
+    assert response.json()[0]["temperature"] == 3.0
+
+    # Leitura antiga gravada por uma transação que terminou depois do refresher, com id já usado pelas apagadas.
+    db = SessionLocal()
+    try:
+        db.execute(
+            text("INSERT INTO sensor_data (id, server_ulid, timestamp, temperature) VALUES (1, 'server_1', :timestamp, 6.0)"),
+            {"timestamp": old + timedelta(minutes=10)}
+        )
+        db.commit()
+        assert retention.compact(5, pause=0)["raw_deleted"] == 0
+        crud.refresh_sensor_data_rollups(db)
+    finally:
+        db.close()
+    # A leitura tardia e a de 9.0, gravada depois do primeiro refresh, saem juntas.
+    assert retention.compact(5, pause=0)["raw_deleted"] == 2
+
+@pytest.mark.skipif(models.SENSOR_DATA_STORAGE != "partitioned", reason="Requer SENSOR_DATA_STORAGE=partitioned.")
+def test_partitioned_storage(client):
+    headers = {"Authorization": f"Bearer {get_auth_token(client)}"}
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    old_days = [today - timedelta(days=10), today - timedelta(days=9)]
+    client.post(
+        "/data/batch",
+        json=[
+            {"server_ulid": "server_1", "timestamp": (day + timedelta(hours=12)).isoformat(), "temperature": 20.5}
+            for day in old_days + [today]
+        ],
+        headers=headers
+    )
+    db = SessionLocal()
+    try:
+        crud.refresh_sensor_data_rollups(db)
+        plan = "\n".join(db.execute(text(
+            "EXPLAIN SELECT * FROM sensor_data WHERE timestamp >= :start AND timestamp < :end"
+        ), {"start": old_days[0], "end": old_days[1]}).scalars())
+    finally:
+        db.close()
+    assert plan.count("sensor_data_p") == 1
+
+    db = SessionLocal()
+    try:
+        db.execute(
+            text("INSERT INTO sensor_data (server_ulid, timestamp, temperature) VALUES ('server_1', :timestamp, 20.5)"),
+            {"timestamp": old_days[0] + timedelta(hours=13)}
+        )
+        db.commit()
+        report = retention.compact(raw_days=5, pause=0)
+        assert report["partitions_dropped"] == 1
+        assert report["raw_deleted"] == 1
+        crud.refresh_sensor_data_rollups(db)
+    finally:
+        db.close()
+
+    report = retention.compact(raw_days=5, pause=0)
+    assert report["partitions_dropped"] == 1
+    assert report["raw_deleted"] == 2
+
+    response = client.get("/data?server_ulid=server_1", headers=headers)
+    assert [row["temperature"] for row in response.json()] == [20.5]
+    response = client.get(f"/data?aggregation=day&start_time={old_days[0].isoformat()}", headers=headers)
+    assert [row["temperature"] for row in response.json()] == [20.5, 20.5, 20.5]
+
+def test_create_sensor_data_compressed_and_msgpack(client, monkeypatch):
+    headers = {"Authorization": f"Bearer {get_auth_token(client)}"}
+    reading = {"server_ulid": "server_1", "timestamp": "2024-02-19T12:00:00Z", "temperature": 25.5}
+    response = client.post(
+        "/data",
+        content=gzip.compress(json.dumps(reading).encode()),
+        headers={**headers, "Content-Type": "application/json", "Content-Encoding": "gzip"}
+    )
+    assert response.status_code == 200
+    assert response.json()["temperature"] == 25.5
+
+    items = [
+        {"server_ulid": "server_1", "timestamp": datetime(2024, 2, 19, 12, 0, 1, tzinfo=timezone.utc), "humidity": {"value": 60.0}},
+        {"server_ulid": "server_1", "timestamp": "2024-02-19T12:00:02Z"},
+    ]
+    response = client.post(
+        "/data/batch",
+        content=payloads.zstandard.ZstdCompressor().compress(payloads.msgpack.packb(items, datetime=True)),
+        headers={**headers, "Content-Type": "application/msgpack", "Content-Encoding": "zstd"}
+    )
+    assert response.status_code == 200
+    assert [item["status"] for item in response.json()["results"]] == ["accepted", "rejected"]
+
+    response = client.get("/data?server_ulid=server_1", headers=headers)
+    assert [row["humidity"] for row in response.json()] == [None, 60.0]
+
+    response = client.post("/data", content=b"corrompido", headers={**headers, "Content-Encoding": "gzip"})
+    assert response.status_code == 400
+    response = client.post("/data", content=json.dumps(reading), headers={**headers, "Content-Encoding": "br"})
+    assert response.status_code == 415
+
+    monkeypatch.setattr(payloads, "INGEST_MAX_REQUEST_BYTES", 64)
+    body = gzip.compress(json.dumps([reading] * 50).encode())
+    response = client.post("/data/batch", content=body, headers={**headers, "Content-Encoding": "gzip"})
+    assert response.status_code == 413
+
+    # Sem Content-Length o limite vale durante a leitura.
+    response = client.post("/data/batch", content=iter([body[:60], body[60:]]), headers={**headers, "Content-Encoding": "gzip"})
+    assert response.status_code == 413
+
+def test_ingest_admission_control(client, monkeypatch):
+    headers = {"Authorization": f"Bearer {get_auth_token(client)}"}
+    controller = admission.IngestAdmission(
+        max_concurrency=2, max_queue=10, queue_timeout=1, user_rate=0, server_rate=1, burst_seconds=2, max_keys=100
+    )
+    monkeypatch.setattr(admission, "controller", controller)
+    statuses = []
+    for second in range(3):
+        response = client.post(
+            "/data",
+            json={"server_ulid": "server_1", "timestamp": f"2024-02-19T12:00:0{second}Z", "temperature": 25.5},
+            headers=headers
+        )
+        statuses.append(response.status_code)
+    assert statuses == [200, 200, 429]
+    assert int(response.headers["Retry-After"]) >= 1
+
+    response = client.post(
+        "/data/batch",
+        json=[{"server_ulid": "server_2", "timestamp": f"2024-02-19T12:00:0{second}Z", "temperature": 25.5} for second in range(3)],
+        headers=headers
+    )
+    assert response.json()["accepted"] == 3
+    response = client.post(
+        "/data",
+        json={"server_ulid": "server_2", "timestamp": "2024-02-19T12:00:05Z", "temperature": 25.5},
+        headers=headers
+    )
+    assert response.status_code == 429
+
+    stats = client.get("/stats", headers=headers).json()["ingest_admission"]
+    assert stats["rejected"]["server_rate"] == 2
+    assert stats["in_flight"] == 0
+    assert stats["admitted"] == 5
+
+    # Sem vaga, o 429 sai antes de autenticar e de ler o corpo.
+    full = admission.IngestAdmission(
+        max_concurrency=1, max_queue=0, queue_timeout=1, user_rate=0, server_rate=0, burst_seconds=1, max_keys=100
+    )
+    monkeypatch.setattr(admission, "controller", full)
+    asyncio.run(full.acquire())
+    response = client.post("/data/batch", content=b"not json", headers={"Content-Type": "application/json"})
+    assert response.status_code == 429
+    assert full.stats()["rejected"]["queue_full"] == 1
+    full.release()
+    assert client.post("/data/batch", json=[], headers=headers).status_code == 200
+
+    async def saturate():
+        limited = admission.IngestAdmission(
+            max_concurrency=1, max_queue=1, queue_timeout=0.05, user_rate=0, server_rate=0, burst_seconds=1, max_keys=100
+        )
+        await limited.acquire()
+        waiting = asyncio.ensure_future(limited.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as rejected:
+            await limited.acquire()
+        assert rejected.value.status_code == 429
+        with pytest.raises(HTTPException):
+            await waiting
+
+        waiting = asyncio.ensure_future(limited.acquire())
+        await asyncio.sleep(0)
+        limited.release()
+        await waiting
+        return limited.stats()
+
+    stats = asyncio.run(saturate())
+    assert stats["in_flight"] == 1
+    assert stats["queued"] == 0
+    assert stats["rejected"]["queue_full"] == 1
+    assert stats["rejected"]["queue_timeout"] == 1
+
+def test_read_replica_routing(client, monkeypatch):
+    headers = {"Authorization": f"Bearer {get_auth_token(client)}"}
+    unreachable = database.create_replica_engine("postgresql://postgres@127.0.0.1:1/replica", 0)
+    replica = database.create_replica_engine(database.DATABASE_URL, 1)
+    monkeypatch.setattr(database, "read_router", database.ReadRouter(engine, [unreachable, replica], retry_after=60))
+    monkeypatch.setattr(database, "recent_writes", database.RecentWrites(window=60, max_clients=100))
+
+    client.post(
+        "/data",
+        json={"server_ulid": "server_1", "timestamp": "2024-02-19T12:00:00Z", "temperature": 25.5},
+        headers=headers
+    )
+    response = client.get("/data?server_ulid=server_1", headers=headers)
+    assert [row["temperature"] for row in response.json()] == [25.5]
+    assert database.read_router.stats()["pinned"] == 1
+
+    monkeypatch.setattr(database.recent_writes, "window", 0)
+    for _ in range(3):
+        response = client.get("/data?server_ulid=server_1&format=ndjson", headers=headers)
+        assert json.loads(response.text.splitlines()[0])["temperature"] == 25.5
+    stats = client.get("/stats", headers=headers).json()["read_routing"]
+    assert stats["replicas_down"] == [0]
+    assert stats["replica_errors"] == 1
+    assert stats["replica_retries"] == 1
+    assert stats["replica"] == 3
+    assert stats["primary"] == 0
+
+    if database.DATABASE_BACKEND == "postgresql":
+        # Réplica que derruba a conexão no meio da consulta: a mesma consulta é repetida no primário.
+        dropping = database.create_replica_engine(f"{database.DATABASE_URL}?application_name=replica", 0)
+        router = database.ReadRouter(engine, [dropping], retry_after=60)
+        session = database.ReadSession(router=router)
+        try:
+            assert session.execute(text(
+                "SELECT CASE WHEN current_setting('application_name') = 'replica' "
+                "THEN pg_terminate_backend(pg_backend_pid()) ELSE true END"
+            )).scalar() is True
+            assert session.reads_primary()
+        finally:
+            session.close()
+            dropping.dispose()
+        assert router.stats()["replica_retries"] == 1
+        assert router.stats()["replicas_down"] == [0]
+
+    # Agregações lidas na réplica não entram no cache compartilhado; as do primário (fixado pela escrita) entram.
+    url = "/data?aggregation=hour&server_ulid=server_1&start_time=2024-02-19T10:00:00Z&end_time=2024-02-19T14:00:00Z"
+    assert client.get(url, headers=headers).json()[0]["temperature"] == 25.5
+    assert aggregates.cache.stats()["size"] == 0
+    assert aggregates.cache.stats()["replica_reads"] == 1
+    monkeypatch.setattr(database.recent_writes, "window", 60)
+    assert client.get(url, headers=headers).json()[0]["temperature"] == 25.5
+    assert aggregates.cache.stats()["size"] == 4
+    replica.dispose()
+
+def test_rolling_stats_and_alerts(client, monkeypatch):
+    headers = {"Authorization": f"Bearer {get_auth_token(client)}"}
+    rules = alerts.parse_rules(
+        '[{"name": "hot", "sensor": "temperature", "max": 50},'
+        ' {"name": "spike", "sensor": "current", "zscore": 3, "min_samples": 5}]'
+    )
+    monkeypatch.setattr(alerts, "monitor", alerts.AlertMonitor(rules, window=300, max_readings=1000, max_servers=2))
+
+    start = datetime.utcnow().replace(microsecond=0) - timedelta(seconds=60)
+    for index, (temperature, current) in enumerate([(20, 1.0), (22, 1.2), (24, 0.8), (26, 1.1), (28, 0.9), (60, 9.0)]):
+        response = client.post(
+            "/data",
+            json={
+                "server_ulid": "server_1",
+                "timestamp": (start + timedelta(seconds=index)).isoformat(),
+                "temperature": temperature,
+                "current": current
+            },
+            headers=headers
+        )
+        assert response.status_code == 200
+
+    monitoring = client.get("/monitoring?server_ulid=server_1", headers=headers).json()
+    temperature = monitoring["servers"]["server_1"]["temperature"]
+    assert temperature["count"] == 6
+    assert temperature["mean"] == pytest.approx(30.0)
+    assert temperature["stddev"] == pytest.approx(math.sqrt(224))
+    assert (temperature["min"], temperature["max"], temperature["last_value"]) == (20, 60, 60)
+    assert "humidity" not in monitoring["servers"]["server_1"]
+    active = {alert["rule"]: alert for alert in monitoring["alerts"]}
+    assert set(active) == {"hot", "spike"}
+    assert active["hot"]["kind"] == "max"
+    assert active["spike"]["zscore"] > 3
+
+    client.post(
+        "/data",
+        json={"server_ulid": "server_1", "timestamp": (start + timedelta(seconds=6)).isoformat(), "temperature": 30},
+        headers=headers
+    )
+    monitoring = client.get("/monitoring", headers=headers).json()
+    assert [alert["rule"] for alert in monitoring["alerts"]] == ["spike"]
+    stats = client.get("/stats", headers=headers).json()["alerts"]
+    assert (stats["fired"], stats["resolved"], stats["active"]) == (2, 1, 1)
+
+    # Leituras fora da janela pelo relógio somem de /monitoring; acima de max_servers sai o servidor parado há mais tempo.
+    for server_ulid, age in [("server_2", 3600), ("server_3", 0), ("server_4", 0)]:
+        client.post(
+            "/data",
+            json={"server_ulid": server_ulid, "timestamp": (datetime.utcnow() - timedelta(seconds=age)).isoformat(), "temperature": 20},
+            headers=headers
+        )
+    monitoring = client.get("/monitoring", headers=headers).json()
+    assert sorted(monitoring["servers"]) == ["server_3", "server_4"]
+    assert monitoring["alerts"] == []
+    assert alerts.monitor.stats()["expired"] == 1
+
+    window = alerts.RollingWindow(window=10, max_readings=3)
+    for second, value in enumerate([5.0, 1.0, 3.0, 2.0]):
+        window.add(start + timedelta(seconds=second), value)
+    assert window.stats()["count"] == 3
+    assert (window.stats()["min"], window.stats()["max"]) == (1.0, 3.0)
+    assert window.add(start + timedelta(seconds=20), 7.0)
+    assert not window.add(start, 0.0)
+    assert window.stats()["count"] == 1
+
+    # Depois de um intervalo sem leituras a janela antiga não entra no z-score.
+    window = alerts.RollingWindow(window=10, max_readings=100)
+    for second, value in enumerate([1.0, 1.2, 0.8, 1.1, 0.9]):
+        window.add(start + timedelta(seconds=second), value)
+    assert abs(window.zscore(9.0)) > 3
+    window.expire(start + timedelta(seconds=100))
+    assert window.zscore(9.0) is None
+    assert window.stats()["count"] == 0